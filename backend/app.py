@@ -3,25 +3,66 @@
 import os
 import threading
 import time
-from flask import Flask, jsonify, request
-from dotenv import load_dotenv
-from recorder import AudioRecorder
-from speech_to_text_test import SpeechToText
-from text_to_speech_test import ResponseSpeaker
-from command_classifier_claude import CommandClassifier
+import startup
+from flask import Flask, jsonify, request, Response, stream_with_context
+from pipeline import Pipeline, Stage
+from speculation import SpeculativeClassifier
+from event_stream import EventChannel, format_sse, parse_last_event_id, HEARTBEAT
+import tracing
 from flask_cors import CORS
 
 # 載入環境變數
-load_dotenv(os.path.join(os.path.dirname(__file__), 'config', '.env'))
+startup.load_env()
 
 app = Flask(__name__)
 CORS(app)  # ✅ 開啟全域 CORS 支援
 
-# 初始化主要元件
-recorder = AudioRecorder()
-transcriber = SpeechToText()
-speaker = ResponseSpeaker()
-classifier = CommandClassifier()
+
+def handle_keyword(label):
+    """本地關鍵字辨識到的控制指令（不經雲端 ASR）"""
+    events.publish("keyword", text=label)
+    process_command(label)
+
+
+def attach_barge_in(recorder):
+    """插話：播放中持續聆聽（回音抑制），使用者一開口就降低音量，「停」「慢一點」等在本地辨識"""
+    global barge_in
+    if os.getenv('BARGE_IN', '0') == '1':
+        from barge_in import BargeIn
+        barge_in = BargeIn.from_env(speaker, on_keyword=handle_keyword, sample_rate=recorder.sample_rate)
+        recorder.barge_in = barge_in
+
+
+# 初始化主要元件：sounddevice／pygame／boto3／OpenCC 等在第一次使用或背景預熱時才載入（LAZY_INIT=0 時立即建立）
+barge_in = None
+speaker = startup.component("speaker", "text_to_speech_test", "ResponseSpeaker")
+recorder = startup.component("recorder", "recorder", "AudioRecorder", on_ready=attach_barge_in)
+transcriber = startup.component("transcriber", "speech_to_text_test", "SpeechToText")
+classifier = startup.component("classifier", "command_classifier_claude", "CommandClassifier")
+
+# 常用固定回覆：啟動時在背景預先合成，之後直接從語音快取播放
+PREWARM_PHRASES = ["⚠️ 無法識別命令", "無法獲取模型回應"]
+PREWARM_PHRASES += [p for p in os.getenv('TTS_PREWARM_PHRASES', '').split(',') if p]
+
+
+def prewarm_startup(port=None):
+    """背景預熱：建立各元件、打開 AWS／Google 連線，再預先合成常用語音（與缺少錄音範本的關鍵字範本）
+
+    指定 port 時先等 HTTP 伺服器開始接受連線，預熱不拖慢啟動。
+    """
+    if port and startup.wait_for_port(port):
+        startup.mark("serving")
+    startup.warm([classifier, transcriber, speaker, recorder])
+    if os.getenv('AWS_PREWARM', '1') == '1':
+        from aws_clients import prewarm as prewarm_connections
+        with startup.timed("warm", "connections"):
+            prewarm_connections()
+    startup.mark("warm")
+    startup.print_report()
+    speaker.prewarm(PREWARM_PHRASES)
+    if barge_in and barge_in.spotter:
+        barge_in.spotter.ensure_templates(speaker)
+
 
 # ====== 持續監聽控制參數 ======
 listening_thread = None
@@ -29,63 +70,269 @@ stop_listening = False
 cur_state = "idle"
 latest_response_text = ""
 has_new_response = False
+# 狀態／部分辨識／回覆的推播頻道（/events），取代輪詢 /audio_status
+events = EventChannel()
+# 串流辨識：錄音時即送出 PCM 片段，不寫 WAV 檔
+streaming_asr = os.getenv('STREAMING_ASR', '0') == '1'
+# 管線模式：擷取 → ASR → 分類 → 回應 → TTS → 播放 各自有佇列與執行緒，錄音執行緒永不被阻塞（PIPELINE_MODE=1 開啟）
+pipeline_mode = os.getenv('PIPELINE_MODE', '0') == '1'
+voice_pipeline = None
+# 串流回覆：聊天/查詢的模型輸出逐句送進 Polly，第一句生成完就開始播放
+streaming_tts = os.getenv('STREAMING_TTS', '0') == '1'
+# 推測分類：串流辨識的部分結果穩定後就先分類（查詢則先搜尋），句尾文字相符時直接沿用
+# （合併模式已是單次呼叫，不另外推測）
+# （合併模式設定在分類器裡，開始聆聽時才建立，見 init_speculator）
+speculator = None
 # ====== 核心功能 ======
 
 
+def init_speculator():
+    global speculator
+    if speculator is None and streaming_asr and os.getenv('SPECULATIVE_CLASSIFY', '0') == '1' \
+            and not classifier.fused_enabled:
+        speculator = SpeculativeClassifier(classifier)
+
+
+def set_state(state):
+    """切換狀態並推播（狀態沒變時不送事件）"""
+    global cur_state
+    if state != cur_state:
+        cur_state = state
+        events.publish("state", state=state)
+
+
+def refresh_state():
+    if cur_state == "talking" and speaker.check_audio() == False:
+        set_state("idle")
+
+
+def watch_playback(interval=0.2):
+    """背景檢查播放是否結束，結束時主動推播 idle（輪詢時代由 /audio_status 順便檢查）"""
+    while True:
+        refresh_state()
+        time.sleep(interval)
+
+
+threading.Thread(target=watch_playback, daemon=True).start()
+
+
 def handle_heard_audio(audio_path):
-    global cur_state, stop_listening, latest_response_text, has_new_response
+    """同步處理一句語音（舊流程，與管線共用各階段函式）"""
+    run_turn({"audio_path": audio_path})
+
+
+def handle_transcript(transcript_text):
+    run_turn({"transcript": transcript_text})
+
 
+def begin_turn(turn):
+    """為這句話建立追蹤紀錄（turn ID）；錄音端量到的句尾判定延遲記為 vad_endpoint"""
+    turn.setdefault("t0", time.time())
+    turn["trace"] = tracing.start_turn()
+    if "endpoint_delay" in turn:
+        tracing.record("vad_endpoint", turn["endpoint_delay"], trace=turn["trace"], offset=-turn["endpoint_delay"])
+    return turn
+
+
+def transcript_turn(text, utterance_id=None):
+    """串流辨識的一句話；帶上這句話（utterance_id）的推測分類（若與最終文字相符）"""
+    return {"transcript": text, "speculation": speculator.take(text, utterance_id) if speculator else None}
+
+
+def complete_turn(turn, status="done"):
+    """一輪離開流程：沒走到播放的（控制指令、播放中被略過）記為 skipped"""
+    if turn.get("speculation"):
+        turn["speculation"].cancel()
+    if status == "done" and not turn.get("completed"):
+        status = "skipped"
+    tracing.finish(turn.get("trace"), status)
+
+
+def run_stage(name, handler, turn):
+    """在該輪的追蹤內容中執行一個階段，並記錄 stage_<name> span"""
+    with tracing.activate(turn.get("trace")), tracing.span(f"stage_{name}"):
+        return handler(turn)
+
+
+def run_turn(turn):
+    if "trace" not in turn:
+        begin_turn(turn)
+    current, status = turn, "error"
+    try:
+        for name, stage in (("asr", stage_asr), ("classify", stage_classify), ("respond", stage_respond),
+                            ("tts", stage_tts), ("playback", stage_playback)):
+            current = run_stage(name, stage, current)
+            if current is None:
+                break
+        status = "done"
+    finally:
+        complete_turn(turn, status)
+
+
+def stage_asr(turn):
+    """語音轉文字；語速/中斷控制指令在此直接處理，不進入後續階段"""
     if stop_listening:
-        return
-    
-    transcript_text = transcriber.transcribe_file(audio_path)
+        return None
+
+    transcript_text = turn.get("transcript")
+    if transcript_text is None:
+        if "audio_path" in turn:
+            transcript_text = transcriber.transcribe_file(turn["audio_path"])
+        else:
+            # 零複製切片：辨識前後都要確認沒有被之後的錄音覆蓋（ASR 落後超過半個環形緩衝區時才會發生）
+            utterance = turn["utterance"]
+            if utterance.valid():
+                transcript_text = transcriber.transcribe_pcm(utterance.data, recorder.sample_rate)
+            if not utterance.valid():
+                print("⚠️ 語句在辨識前已被之後的錄音覆蓋，略過這句")
+                return None
     if not transcript_text:
-        return
+        return None
 
     if process_command(transcript_text):
-        return
+        return None
     if speaker.check_audio():
-        return
-    
-    cur_state = "thinking"
-    command_type = classifier.classify_command(transcript_text)
-
-    response = ""
-    if command_type == '聊天':
-        response = classifier.chat_with_gemini(transcript_text)
-        classifier.save_chat_history(transcript_text, response, command_type)
-    elif command_type == '查詢':
-        response = classifier.handle_query(transcript_text)
-        classifier.save_query_history(transcript_text, response, command_type)
-    elif command_type == '行動':
-        response = classifier.handle_movement(transcript_text)
-        classifier.save_movement_history(transcript_text, response, command_type)
-
-    if command_type == "行動" and isinstance(response, dict) and "說明" in response and "動作順序" in response:
-        description_list = response["說明"]
-        code_list = response["動作順序"]
-        combined = [f"{code}，{desc}" for code, desc in zip(code_list, description_list)]
-        response_text = "\n".join(combined)
-    elif isinstance(response, str):
-        response_text = response
+        return None
+
+    turn["transcript"] = transcript_text
+    events.publish("transcript", text=transcript_text)
+    return turn
+
+
+def stage_classify(turn):
+    set_state("thinking")
+
+    cache = classifier.response_cache
+    if cache:
+        command_type, response, decision = cache.lookup(turn["transcript"])
+        turn["cache"] = decision
+        if response is not None:
+            print(f"💾 回覆快取命中（{decision}）")
+            turn["command_type"], turn["response"], turn["mode"] = command_type, response, "cache"
+            return turn
+
+    speculation = turn.get("speculation")
+    if speculation:
+        command_type = speculator.command_type(speculation)
+        if command_type:
+            print(f"🔮 沿用推測分類: {command_type}")
+            turn["command_type"], turn["mode"], turn["speculative"] = command_type, "two_call", True
+            return turn
+
+    if classifier.fused_enabled:
+        # 單次呼叫同時取得分類與回覆；回覆為 None 時由 stage_respond 走原本流程
+        turn["command_type"], turn["response"] = classifier.classify_and_respond(turn["transcript"])
+        turn["mode"] = "fused" if turn["response"] is not None else "two_call"
     else:
-        response_text = "⚠️ 無法識別命令"
-
-    speaker.speak(response_text)
-    cur_state = "talking"
-
-    latest_response_text = response_text
+        turn["command_type"] = classifier.classify_command(turn["transcript"])
+        turn["mode"] = "two_call"
+    return turn
+
+
+def stage_respond(turn):
+    transcript_text = turn["transcript"]
+    command_type = turn["command_type"]
+
+    response = turn.get("response")
+    search_results = None
+    if response is None and command_type == '查詢' and turn.get("speculation"):
+        search_results = speculator.search_results(turn["speculation"])
+
+    if response is None and streaming_tts and command_type in ('聊天', '查詢'):
+        from text_to_speech_test import split_sentences
+        # 只建立串流，實際生成與朗讀在播放階段進行
+        if command_type == '聊天':
+            turn["sentences"] = split_sentences(classifier.chat_stream(transcript_text))
+        else:
+            turn["sentences"] = split_sentences(classifier.handle_query_stream(transcript_text, search_results))
+        turn["mode"] = "stream"
+        return turn
+
+    if response is None:
+        start = time.time()
+        if command_type == '聊天':
+            response = classifier.chat_with_gemini(transcript_text)
+        elif command_type == '查詢':
+            response = classifier.handle_query(transcript_text, search_results)
+        elif command_type == '行動':
+            response = classifier.handle_movement(transcript_text)
+        classifier.record_mode("two_call", command_type, time.time() - start)
+
+    turn["response"] = response
+    turn["response_text"] = classifier.format_response(command_type, response)
+    save_turn_history(turn)
+    return turn
+
+
+def save_turn_history(turn):
+    extra = {"mode": turn.get("mode", "two_call")}
+    if "cache" in turn:
+        extra["cache"] = turn["cache"]
+    if turn.get("speculative"):
+        extra["speculative"] = True
+    if turn.get("cancelled"):
+        extra["cancelled"] = True
+    classifier.save_turn_history(turn["transcript"], turn["response"], turn["command_type"], extra)
+
+
+def stage_tts(turn):
+    if "sentences" in turn:
+        return turn
+    turn["audio_stream"] = speaker.synthesize(turn["response_text"])
+    return turn
+
+
+def stage_playback(turn):
+    global latest_response_text, has_new_response
+
+    if "sentences" in turn:
+        speaker.wait_until_done()
+
+        def on_first_audio(latency):
+            set_state("talking")
+            if "t0" in turn:
+                print(f"⏱️ 句尾到首句語音：{time.time() - turn['t0']:.2f}s")
+
+        response_text, cancelled = speaker.speak_stream(turn.pop("sentences"), on_first_audio=on_first_audio)
+        turn["response"] = turn["response_text"] = response_text
+        if cancelled:
+            turn["cancelled"] = True
+        save_turn_history(turn)
+    elif turn.get("audio_stream"):
+        speaker.wait_until_done()
+        speaker.play(turn["audio_stream"], turn["response_text"])
+    set_state("talking")
+
+    latest_response_text = turn["response_text"]
     has_new_response = True
-
-
+    events.publish("reply", text=turn["response_text"])
+    turn["completed"] = True
+    return None
+
+
+def build_pipeline():
+    """建立各階段管線；擷取端用 drop_oldest，確保錄音執行緒不會被阻塞
+
+    每個階段只有一個工作執行緒，句子依說出的順序辨識、回覆與播放（「停」等控制指令不會超車前面的句子）；
+    已生成的回覆不丟棄，播放佇列滿時 TTS 階段等候播放完成。
+    """
+    def traced(name, handler):
+        return lambda turn: run_stage(name, handler, turn)
+
+    return Pipeline([
+        Stage("asr", traced("asr", stage_asr), workers=1, maxsize=4, drop_policy="drop_oldest"),
+        Stage("classify", traced("classify", stage_classify), workers=1, maxsize=4, drop_policy="block"),
+        Stage("respond", traced("respond", stage_respond), workers=1, maxsize=4, drop_policy="block"),
+        Stage("tts", traced("tts", stage_tts), workers=1, maxsize=4, drop_policy="block"),
+        Stage("playback", traced("playback", stage_playback), workers=1, maxsize=2, drop_policy="block", put_timeout=None),
+    ], on_complete=complete_turn)
     
 
 def process_command(text):
     """根據語音指令調整朗讀速度或中斷朗讀"""
-    global cur_state
     if "停" in text:
         speaker.stop_audio()
-        cur_state = "idle"
+        set_state("idle")
         return True
     elif "慢一點" in text:
         speaker.set_rate("80%")
@@ -101,16 +348,46 @@ def process_command(text):
     
 
 def listen_forever():
-    global cur_state,stop_listening
+    global stop_listening, voice_pipeline
     stop_listening = False
+    init_speculator()
+
+    def on_partial(text, utterance_id):
+        events.publish("partial", text=text)
+        if speculator:
+            speculator.observe(text, utterance_id)
+
+    if pipeline_mode:
+        if voice_pipeline is None:
+            voice_pipeline = build_pipeline()
+            voice_pipeline.start()
+
+        def submit(turn):
+            refresh_state()
+            turn["t0"] = time.time()
+            turn["endpoint_delay"] = recorder.last_endpoint_delay
+            voice_pipeline.submit(begin_turn(turn))
+
+        if streaming_asr:
+            recorder.listen_streaming(transcriber, on_partial=on_partial,
+                                      on_transcript=lambda text, utterance_id: submit(transcript_turn(text, utterance_id)))
+        else:
+            # 交出環形緩衝區的零複製切片（RingSlice），ASR 階段使用前後確認沒有被之後的錄音覆蓋
+            recorder.listen_forever(on_audio=lambda utterance: submit({"utterance": utterance}))
+        return
 
     def on_frame_captured(audio_path):
-        global cur_state
-        if(cur_state == "talking" and speaker.check_audio() == False):
-            cur_state = "idle"
-        handle_heard_audio(audio_path)
+        refresh_state()
+        run_turn({"audio_path": audio_path, "endpoint_delay": recorder.last_endpoint_delay})
+
+    def on_transcript(text, utterance_id):
+        refresh_state()
+        run_turn({**transcript_turn(text, utterance_id), "endpoint_delay": recorder.last_endpoint_delay})
 
-    recorder.listen_forever(on_heard_callback=on_frame_captured)
+    if streaming_asr:
+        recorder.listen_streaming(transcriber, on_transcript=on_transcript, on_partial=on_partial)
+    else:
+        recorder.listen_forever(on_heard_callback=on_frame_captured)
 
 # ====== API ======
 
@@ -153,10 +430,9 @@ def process_audio():
 cunt = 0
 @app.route('/audio_status', methods=['GET'])
 def audio_status():
-    global cur_state,cunt, latest_response_text, has_new_response
+    global cunt, latest_response_text, has_new_response
 
-    if cur_state == "talking" and speaker.check_audio() == False:
-        cur_state = "idle"
+    refresh_state()
 
     response = {
         "state": cur_state,
@@ -167,7 +443,99 @@ def audio_status():
     latest_response_text = ""
     return jsonify(response)
 
+@app.route('/events', methods=['GET'])
+def event_stream():
+    """Server-Sent Events：推播 state / partial / transcript / reply 事件
+
+    每個事件帶序號；重連時瀏覽器自動送出 Last-Event-ID（或用 ?last_event_id=），從重播緩衝區補送漏掉的事件。
+    新連線會先收到目前狀態。
+    """
+    last_seq = events.resume_point(parse_last_event_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id')))
+
+    def generate(last_seq):
+        if last_seq == 0:
+            last_seq = events.seq
+            yield format_sse({"seq": last_seq, "type": "state", "data": {"state": cur_state}})
+        while True:
+            pending = events.wait(last_seq, timeout=15)
+            if not pending:
+                yield HEARTBEAT
+                continue
+            for event in pending:
+                last_seq = event["seq"]
+                yield format_sse(event)
+
+    return Response(stream_with_context(generate(last_seq)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/pipeline_stats', methods=['GET'])
+def pipeline_stats():
+    """各階段佇列深度、丟棄數與延遲，供監控使用"""
+    if voice_pipeline is None:
+        return jsonify({"enabled": pipeline_mode, "stages": []})
+    return jsonify({"enabled": True, "stages": voice_pipeline.stats()})
+
+@app.route('/barge_in_stats', methods=['GET'])
+def barge_in_stats():
+    """插話次數、本地關鍵字命中與誤觸發統計"""
+    return jsonify(barge_in.get_stats() if barge_in else {"enabled": False})
+
+@app.route('/speculation_stats', methods=['GET'])
+def speculation_stats():
+    """推測分類的啟動／沿用／作廢次數與預先搜尋的命中數"""
+    return jsonify(speculator.get_stats() if speculator else {"enabled": False})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus 格式：各步驟與整輪延遲直方圖、錯誤計數，以及管線佇列深度／丟棄數"""
+    body = tracing.metrics.render()
+    if voice_pipeline is not None:
+        stages = voice_pipeline.stats()
+        body += tracing.format_gauges("voice_pipeline_queue_depth", "各階段佇列中等待的筆數",
+                              {f'stage="{s["stage"]}"': s["depth"] for s in stages})
+        body += tracing.format_gauges("voice_pipeline_dropped_total", "各階段因佇列滿而丟棄的筆數",
+                              {f'stage="{s["stage"]}"': s["dropped"] for s in stages}, metric_type="counter")
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+@app.route('/tts_cache_stats', methods=['GET'])
+def tts_cache_stats():
+    """語音快取命中／未命中統計"""
+    return jsonify(speaker.cache.get_stats() if speaker.cache else {"enabled": False})
+
+@app.route('/response_cache_stats', methods=['GET'])
+def response_cache_stats():
+    """回覆快取各層命中統計"""
+    cache = classifier.response_cache
+    return jsonify(cache.get_stats() if cache else {"enabled": False})
+
+@app.route('/classifier_stats', methods=['GET'])
+def classifier_stats():
+    """合併模式與兩段式模式的延遲／分類一致率、本地分類的升級率，以及搜尋的快取與對沖統計"""
+    local = classifier.local_classifier.get_stats() if classifier.local_classifier else None
+    plans = classifier.plan_library.get_stats() if classifier.plan_library else None
+    return jsonify({"fused_types": classifier.fused_types, "modes": classifier.get_mode_stats(), "local": local,
+                    "search": classifier.retriever.get_stats(), "plans": plans})
+
+@app.route('/asr_stats', methods=['GET'])
+def asr_stats():
+    """上傳 ASR 前的音訊準備（原始與實際上傳的位元組、音訊秒數），以及本機／雲端引擎的路由與延遲"""
+    return jsonify({**transcriber.prep.get_stats(), "routing": transcriber.router.get_stats()})
+
+@app.route('/startup_stats', methods=['GET'])
+def startup_stats():
+    """啟動時間報告：各模組匯入與元件建立的耗時"""
+    return jsonify(startup.report())
+
+
+startup.mark("imported")
+
 if __name__ == '__main__':
     #listen_forever()
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    # debug 模式由重新載入器另開子行程服務請求，只在該行程預熱
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        threading.Thread(target=prewarm_startup, args=(5001,), daemon=True).start()
+    app.run(host='0.0.0.0', port=5001, debug=True, threaded=True)
+else:
+    # 被其他程式匯入（WSGI 伺服器、benchmark）時直接在背景預熱
+    threading.Thread(target=prewarm_startup, daemon=True).start()
     
@@ -2,7 +2,7 @@ import sounddevice as sd
 import numpy as np
 from scipy.io.wavfile import write
 import time
-import boto3
+from aws_clients import get_client
 import json
 import os
 from dotenv import load_dotenv
@@ -52,7 +52,7 @@ def process_audio():
 
         endpoint_name = "jumpstart-dft-hf-asr-whisper-large-20250426-025518"
         region = "us-west-2"
-        runtime = boto3.client("sagemaker-runtime", region_name=region)
+        runtime = get_client("sagemaker-runtime", region)
 
         with open("demo.wav", "rb") as f:
             audio_bytes = f.read()
@@ -75,7 +75,7 @@ def process_audio():
         # ---------- Step 3: 呼叫 Claude 模型 ----------
         print("🤖 呼叫 Claude 模型分析內容...")
 
-        bedrock = boto3.client(service_name="bedrock-runtime", region_name=region)
+        bedrock = get_client("bedrock-runtime", region)
 
         body = json.dumps({
             "max_tokens": 512,
@@ -115,7 +115,7 @@ def process_audio():
         # ---------- Step 4: Text-to-Speech ----------
         print("🔊 使用 Polly 將回應轉語音...")
 
-        polly = boto3.client("polly", region_name=region)
+        polly = get_client("polly", region)
 
         response = polly.synthesize_speech(
             Text=reply_text,
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+import numpy as np
+import tracing
+
+
+class SageMakerASR:
+    """雲端引擎：SageMaker 上的 Whisper-large；上傳前由 AudioPrep 依設定的格式編碼"""
+
+    name = "sagemaker"
+
+    def __init__(self, runtime, endpoint_name, prep):
+        self.runtime = runtime
+        self.endpoint_name = endpoint_name
+        self.prep = prep
+
+    def invoke(self, audio_bytes, content_type="audio/wav"):
+        """呼叫 Whisper 端點，回傳 (原始文字, 信心值)"""
+        with tracing.span("asr", bytes=len(audio_bytes)):
+            response = self.runtime.invoke_endpoint(
+                EndpointName=self.endpoint_name,
+                ContentType=content_type,
+                Body=audio_bytes
+            )
+            response_body = response["Body"].read().decode("utf-8")
+        result = json.loads(response_body)
+
+        transcript_text = ""
+        confidence = 0.9
+
+        if "text" in result and isinstance(result["text"], list) and len(result["text"]) > 0:
+            transcript_text = result["text"][0]
+            confidence = result.get("confidence", 0.9)
+
+        return transcript_text, confidence
+
+    def transcribe(self, pcm, sample_rate):
+        return self.invoke(*self.prep.encode(pcm, sample_rate))
+
+
+class LocalWhisperASR:
+    """本機引擎：CPU 上以 int8 量化的小型 Whisper（faster-whisper／CTranslate2）；需安裝 faster-whisper
+
+    信心值取各段平均對數機率（依長度加權）的 exp，再乘上「有說話」的機率。
+    """
+
+    name = "local"
+
+    def __init__(self, model=None, compute_type=None, threads=None, language="zh"):
+        from faster_whisper import WhisperModel
+        model = model or os.getenv('ASR_LOCAL_MODEL', 'small')
+        with tracing.span("asr_local_load"):
+            self.model = WhisperModel(model, device="cpu",
+                                      compute_type=compute_type or os.getenv('ASR_LOCAL_COMPUTE', 'int8'),
+                                      cpu_threads=threads or int(os.getenv('ASR_LOCAL_THREADS', '4')))
+        self.language = language
+        # CPU 推論一次一句；同時送來的句子排隊，避免互搶核心
+        self._lock = threading.Lock()
+        print(f"🧠 本機 ASR 模型已載入：{model}")
+
+    def transcribe(self, pcm, sample_rate):
+        audio = pcm.reshape(-1).astype(np.float32) / 32768.0
+        if sample_rate != 16000:
+            positions = np.arange(0, len(audio), sample_rate / 16000)
+            audio = np.interp(positions, np.arange(len(audio)), audio).astype(np.float32)
+        with self._lock, tracing.span("asr_local"):
+            segments, _ = self.model.transcribe(audio, language=self.language, beam_size=1,
+                                                condition_on_previous_text=False)
+            segments = list(segments)
+        if not segments:
+            return "", 0.0
+        weights = [max(segment.end - segment.start, 0.01) for segment in segments]
+        logprob = np.average([segment.avg_logprob for segment in segments], weights=weights)
+        no_speech = np.average([segment.no_speech_prob for segment in segments], weights=weights)
+        text = "".join(segment.text for segment in segments).strip()
+        return text, round(float(np.exp(logprob) * (1 - no_speech)), 3)
+
+
+ASR_ENGINES = {
+    "sagemaker": SageMakerASR,
+    "local": LocalWhisperASR,
+}
+
+
+def make_asr(name, **kwargs):
+    """依名稱建立 ASR 引擎"""
+    if name not in ASR_ENGINES:
+        raise ValueError(f"未知的 ASR 引擎：{name}（可用：{', '.join(ASR_ENGINES)}）")
+    return ASR_ENGINES[name](**kwargs)
+
+
+class ASRRouter:
+    """混合辨識路由：短句（裁切後不超過 max_seconds 秒）先交給本機引擎，信心低於 min_confidence 才升級到雲端
+
+    「停」「慢一點」這類控制指令不必等雲端端點；長句與本機沒把握的句子照舊走 Whisper-large。
+    沒有本機引擎時全部送雲端，仍統計各引擎的延遲。
+    """
+
+    def __init__(self, cloud, local=None, max_seconds=2.5, min_confidence=0.6):
+        self.cloud = cloud
+        self.local = local
+        self.max_seconds = max_seconds
+        self.min_confidence = min_confidence
+
+        self.routed_local = 0     # 送本機的句數
+        self.local_hits = 0       # 本機結果直接採用
+        self.escalated = 0        # 本機信心不足或出錯，升級到雲端
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, cloud):
+        local = None
+        if os.getenv('ASR_LOCAL', '0') == '1':
+            try:
+                local = make_asr("local")
+            except Exception as e:
+                print(f"⚠️ 無法載入本機 ASR（{e}），全部送雲端辨識")
+        return cls(
+            cloud,
+            local,
+            max_seconds=float(os.getenv('ASR_LOCAL_MAX_SECONDS', '2.5')),
+            min_confidence=float(os.getenv('ASR_LOCAL_MIN_CONFIDENCE', '0.6')),
+        )
+
+    def _call(self, engine, pcm, sample_rate):
+        start = time.perf_counter()
+        error = True
+        try:
+            result = engine.transcribe(pcm, sample_rate)
+            error = False
+            return result
+        finally:
+            with self._lock:
+                stats = self.stats.setdefault(engine.name, {"calls": 0, "errors": 0, "latency": deque(maxlen=200)})
+                stats["calls"] += 1
+                stats["errors"] += error
+                if not error:
+                    stats["latency"].append(time.perf_counter() - start)
+
+    def transcribe(self, pcm, sample_rate, cloud_only=False):
+        """PCM（已裁切）→ (原始文字, 信心值)；cloud_only 時不經本機引擎（仍計入統計）"""
+        if not cloud_only and self.local is not None and len(pcm) <= self.max_seconds * sample_rate:
+            with self._lock:
+                self.routed_local += 1
+            try:
+                text, confidence = self._call(self.local, pcm, sample_rate)
+            except Exception as e:
+                text, confidence = "", 0.0
+                print(f"本機辨識錯誤: {str(e)}")
+            if text and confidence >= self.min_confidence:
+                with self._lock:
+                    self.local_hits += 1
+                return text, confidence
+            with self._lock:
+                self.escalated += 1
+            print(f"☁️ 本機辨識信心不足（{confidence:.2f}：{text}），改送雲端")
+        return self._call(self.cloud, pcm, sample_rate)
+
+    def get_stats(self):
+        with self._lock:
+            backends = {}
+            for name, stats in self.stats.items():
+                latency = np.array(stats["latency"]) if stats["latency"] else np.zeros(1)
+                backends[name] = {
+                    "calls": stats["calls"],
+                    "errors": stats["errors"],
+                    "p50": round(float(np.percentile(latency, 50)), 3),
+                    "p95": round(float(np.percentile(latency, 95)), 3),
+                }
+            return {
+                "local_enabled": self.local is not None,
+                "routed_local": self.routed_local,
+                "local_hits": self.local_hits,
+                "escalated": self.escalated,
+                "local_hit_rate": round(self.local_hits / self.routed_local, 3) if self.routed_local else None,
+                "backends": backends,
+            }
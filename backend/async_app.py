@@ -0,0 +1,243 @@
+# ===== 非同步多工作階段伺服器 =====
+# python async_app.py：單一行程以 asyncio 同時服務多台語音裝置（機台／機器人），
+# 每台裝置一個工作階段；/process_audio 與 /audio_status 保留給使用本機麥克風的舊前端。
+
+import io
+import os
+import wave
+import asyncio
+import numpy as np
+from aiohttp import web
+from recorder import AudioRecorder
+from speech_to_text_test import SpeechToText
+from text_to_speech_test import ResponseSpeaker
+from command_classifier_claude import CommandClassifier
+from voice_session import SessionManager
+from aws_clients import prewarm as prewarm_connections
+from event_stream import format_sse, parse_last_event_id, HEARTBEAT
+import tracing
+import startup
+
+# 載入環境變數
+startup.load_env()
+
+LOCAL_SESSION = "local"
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "*",
+    "Access-Control-Allow-Methods": "GET, POST, DELETE, OPTIONS",
+}
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """✅ 開啟全域 CORS 支援（與 Flask 版的 flask_cors 相同效果）"""
+    if request.method == "OPTIONS":
+        response = web.Response()
+    else:
+        response = await handler(request)
+    if not response.prepared:
+        # 串流回應（SSE）的標頭在 prepare 時就已送出，由 handler 自行帶上
+        response.headers.update(CORS_HEADERS)
+    return response
+
+
+def get_session(request):
+    session = request.app["sessions"].get(request.match_info["session_id"])
+    if session is None:
+        raise web.HTTPNotFound(text="unknown session")
+    return session
+
+
+def read_wav(data, sample_rate):
+    """解析上傳的 WAV；取樣率須與錄音端一致（單聲道 int16）"""
+    with wave.open(io.BytesIO(data), 'rb') as wf:
+        if wf.getframerate() != sample_rate or wf.getsampwidth() != 2:
+            raise web.HTTPBadRequest(text=f"WAV 須為 {sample_rate} Hz、16-bit")
+        pcm = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+        if wf.getnchannels() > 1:
+            pcm = pcm.reshape(-1, wf.getnchannels())[:, 0]
+    return pcm
+
+
+# ====== 工作階段 API ======
+
+async def create_session(request):
+    try:
+        session = request.app["sessions"].create()
+    except RuntimeError as e:
+        raise web.HTTPServiceUnavailable(text=str(e))
+    return web.json_response({"session_id": session.id})
+
+
+async def list_sessions(request):
+    return web.json_response(request.app["sessions"].stats())
+
+
+async def delete_session(request):
+    closed = await request.app["sessions"].close(request.match_info["session_id"])
+    if not closed:
+        raise web.HTTPNotFound(text="unknown session")
+    return web.json_response({"message": "Session closed."})
+
+
+async def post_audio(request):
+    """audio/wav：一整句，直接辨識；其他 Content-Type 視為 16 kHz int16 原始 PCM 串流片段，由 VAD 切句"""
+    session = get_session(request)
+    data = await request.read()
+    sample_rate = request.app["sessions"].recorder.sample_rate
+    if request.content_type in ("audio/wav", "audio/x-wav", "audio/wave"):
+        session.submit({"audio": read_wav(data, sample_rate)})
+    else:
+        session.feed_audio(np.frombuffer(data[:len(data) - len(data) % 2], dtype=np.int16))
+    return web.json_response({"state": session.state, "in_utterance": session.segmenter.in_utterance})
+
+
+async def post_text(request):
+    session = get_session(request)
+    body = await request.json()
+    text = (body.get("text") or "").strip()
+    if not text:
+        raise web.HTTPBadRequest(text="缺少 text")
+    session.submit({"transcript": text})
+    return web.json_response({"state": session.state})
+
+
+async def session_status(request):
+    return web.json_response(get_session(request).poll_status())
+
+
+async def session_reply(request):
+    session = get_session(request)
+    if not session.reply_audio:
+        raise web.HTTPNotFound(text="no reply yet")
+    return web.Response(body=session.reply_audio, content_type="audio/mpeg",
+                        headers={"X-Reply-Version": str(session.reply_version)})
+
+
+async def stream_events(request, session):
+    """Server-Sent Events：推播該工作階段的 state / transcript / reply 事件，支援 Last-Event-ID 補送"""
+    channel = session.events
+    last_seq = channel.resume_point(parse_last_event_id(request.headers.get('Last-Event-ID') or request.query.get('last_event_id')))
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache',
+                                           'X-Accel-Buffering': 'no', **CORS_HEADERS})
+    await response.prepare(request)
+
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+
+    def listener():
+        loop.call_soon_threadsafe(wake.set)
+
+    channel.add_listener(listener)
+    try:
+        if last_seq == 0:
+            last_seq = channel.seq
+            await response.write(format_sse({"seq": last_seq, "type": "state", "data": {"state": session.state}}).encode())
+        while True:
+            wake.clear()
+            pending = channel.since(last_seq)
+            if not pending:
+                try:
+                    await asyncio.wait_for(wake.wait(), 15)
+                except asyncio.TimeoutError:
+                    await response.write(HEARTBEAT.encode())
+                continue
+            for event in pending:
+                last_seq = event["seq"]
+                await response.write(format_sse(event).encode())
+    except ConnectionResetError:
+        pass
+    finally:
+        channel.remove_listener(listener)
+    return response
+
+
+async def session_events(request):
+    return await stream_events(request, get_session(request))
+
+
+async def session_played(request):
+    get_session(request).mark_played()
+    return web.json_response({"message": "ok"})
+
+
+async def metrics(request):
+    """Prometheus 格式的延遲直方圖與計數，另附各工作階段的待處理與丟棄數"""
+    sessions = request.app["sessions"].stats()["sessions"]
+    body = tracing.metrics.render()
+    body += tracing.format_gauges("voice_session_pending", "各工作階段排隊中的語句數",
+                                  {f'session="{s["session_id"]}"': s["pending"] for s in sessions})
+    body += tracing.format_gauges("voice_session_dropped_total", "各工作階段因佇列滿而丟棄的語句數",
+                                  {f'session="{s["session_id"]}"': s["dropped"] for s in sessions}, metric_type="counter")
+    return web.Response(text=body, content_type="text/plain", charset="utf-8")
+
+
+# ====== 舊前端相容 API（本機麥克風）======
+
+def local_session(manager):
+    """取得（或建立）本機麥克風的工作階段；工作階段已達上限時回 503"""
+    try:
+        return manager.get(LOCAL_SESSION) or manager.create(LOCAL_SESSION, local=True)
+    except RuntimeError as e:
+        raise web.HTTPServiceUnavailable(text=str(e))
+
+
+async def process_audio(request):
+    manager = request.app["sessions"]
+    session = local_session(manager)
+    if not manager.start_microphone(session):
+        return web.json_response({"message": "Already listening."})
+    return web.json_response({"message": "Listening started."})
+
+
+async def audio_status(request):
+    session = request.app["sessions"].get(LOCAL_SESSION)
+    if session is None:
+        return web.json_response({"state": "idle", "has_new": False, "reply": ""})
+    status = session.poll_status()
+    return web.json_response({key: status[key] for key in ("state", "has_new", "reply")})
+
+
+async def local_events(request):
+    manager = request.app["sessions"]
+    session = local_session(manager)
+    return await stream_events(request, session)
+
+
+# ====== 啟動 ======
+
+async def on_startup(app):
+    manager = app["sessions"]
+    manager.start()
+    if os.getenv('AWS_PREWARM', '1') == '1':
+        manager.executor.submit(prewarm_connections)
+
+
+async def on_cleanup(app):
+    await app["sessions"].close_all()
+
+
+def create_app(manager=None):
+    app = web.Application(middlewares=[cors_middleware], client_max_size=16 * 1024 * 1024)
+    app["sessions"] = manager or SessionManager(AudioRecorder(), SpeechToText(), CommandClassifier(), ResponseSpeaker())
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_post('/sessions', create_session)
+    app.router.add_get('/sessions', list_sessions)
+    app.router.add_get('/metrics', metrics)
+    app.router.add_delete('/sessions/{session_id}', delete_session)
+    app.router.add_post('/sessions/{session_id}/audio', post_audio)
+    app.router.add_post('/sessions/{session_id}/text', post_text)
+    app.router.add_get('/sessions/{session_id}/status', session_status)
+    app.router.add_get('/sessions/{session_id}/reply.mp3', session_reply)
+    app.router.add_post('/sessions/{session_id}/played', session_played)
+    app.router.add_get('/sessions/{session_id}/events', session_events)
+    app.router.add_post('/process_audio', process_audio)
+    app.router.add_get('/audio_status', audio_status)
+    app.router.add_get('/events', local_events)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.getenv('PORT', '5001')))
@@ -0,0 +1,242 @@
+import os
+import io
+import time
+import wave
+import threading
+import contextvars
+from contextlib import contextmanager
+import numpy as np
+import tracing
+
+# 可選編碼與對應的 Content-Type（Hugging Face 推論容器以 ffmpeg 解碼，支援這些格式）
+FORMATS = {
+    'wav': 'audio/wav',
+    'flac': 'audio/x-flac',
+    'opus': 'audio/ogg',
+}
+
+
+def encode_wav(pcm, sample_rate=16000):
+    """把 int16 PCM 編碼成記憶體中的 WAV 位元組"""
+    with tracing.span("wav_encode"):
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(sample_rate)
+            wav.writeframes(pcm.tobytes())
+        return buffer.getvalue()
+
+
+def decode_wav(audio_bytes):
+    """WAV 位元組 → (int16 單聲道 PCM, 取樣率)；多聲道時取平均"""
+    with wave.open(io.BytesIO(audio_bytes), 'rb') as wav:
+        channels, width, sample_rate = wav.getnchannels(), wav.getsampwidth(), wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+    if width != 2:
+        raise ValueError(f"只支援 16-bit WAV（收到 {width * 8}-bit）")
+    pcm = np.frombuffer(frames, dtype=np.int16)
+    if channels > 1:
+        pcm = pcm.reshape(-1, channels).mean(axis=1).astype(np.int16)
+    return pcm, sample_rate
+
+
+def voiced_range(pcm, sample_rate, floor_db=-35.0, pad_ms=200, window_ms=10):
+    """回傳有聲段 [start, end)（前後各留 pad_ms）；能量以 10 ms 視窗計，門檻為全段峰值 floor_db，與 vad.reference_end 相同"""
+    window = int(sample_rate * window_ms / 1000)
+    count = len(pcm) // window
+    if not count:
+        return 0, len(pcm)
+    x = pcm[:count * window].reshape(count, window).astype(np.float32)
+    energy_db = 10 * np.log10(np.mean(x * x, axis=1) + 1e-6)
+    active = np.nonzero(energy_db > energy_db.max() + floor_db)[0]
+    if not len(active):
+        return 0, len(pcm)
+    pad = int(pad_ms / window_ms)
+    # 起點對齊 10 ms 視窗
+    start = max(0, active[0] - pad) * window
+    end = min(len(pcm), (active[-1] + 1 + pad) * window)
+    return start, end
+
+
+def normalize_gain(pcm, target_db=-3.0, max_gain_db=20.0):
+    """把峰值放大到 target_db dBFS（最多放大 max_gain_db）；已夠大聲的不縮小，回傳 (PCM, 放大倍數 dB)"""
+    peak = int(np.max(np.abs(pcm.astype(np.int32)))) if len(pcm) else 0
+    if not peak:
+        return pcm, 0.0
+    gain_db = min(max_gain_db, target_db - 20 * np.log10(peak / 32768))
+    if gain_db <= 0.1:
+        return pcm, 0.0
+    scaled = np.round(pcm.astype(np.float32) * 10 ** (gain_db / 20))
+    return np.clip(scaled, -32768, 32767).astype(np.int16), round(float(gain_db), 2)
+
+
+class AudioPrep:
+    """上傳 ASR 前的音訊準備：裁掉前後靜音、放大過小的音量、視端點支援改用 FLAC／Opus 壓縮
+
+    錄音端固定保留 1.5 秒句尾靜音與 0.3 秒前導，裁掉後上傳位元組與端點推論時間都隨之減少。
+    FLAC／Opus 需要安裝 soundfile（libsndfile）；沒有時自動退回 WAV。
+    串流辨識的部分結果請求在 counting("partial") 內處理，統計與 audio_prep 耗時分開，不混進最終辨識的數字。
+    """
+
+    def __init__(self, trim=True, pad_ms=200, normalize=True, target_db=-3.0, max_gain_db=20.0, audio_format='wav'):
+        self.trim = trim
+        self.pad_ms = pad_ms
+        self.normalize = normalize
+        self.target_db = target_db
+        self.max_gain_db = max_gain_db
+        if audio_format not in FORMATS:
+            raise ValueError(f"未知的 ASR 音訊格式：{audio_format}（可用：{', '.join(FORMATS)}）")
+        self.audio_format = audio_format
+
+        # 最終辨識（final）與串流部分結果（partial）分開統計：
+        # bytes_in 為未處理時會上傳的 WAV 位元組，bytes_out 為實際上傳的位元組（交給本機辨識的語句不上傳）
+        self._counts = {kind: {"requests": 0, "bytes_in": 0, "bytes_out": 0, "seconds_in": 0.0, "seconds_out": 0.0}
+                        for kind in ("final", "partial")}
+        self._kind = contextvars.ContextVar("audio_prep_kind", default="final")
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            trim=os.getenv('ASR_TRIM', '1') == '1',
+            pad_ms=int(os.getenv('ASR_TRIM_PAD_MS', '200')),
+            normalize=os.getenv('ASR_NORMALIZE', '1') == '1',
+            target_db=float(os.getenv('ASR_TARGET_PEAK_DB', '-3')),
+            max_gain_db=float(os.getenv('ASR_MAX_GAIN_DB', '20')),
+            audio_format=os.getenv('ASR_AUDIO_FORMAT', 'wav'),
+        )
+
+    @contextmanager
+    def counting(self, kind):
+        """這段期間（同一執行緒）的 process／encode 記在 kind（"final" 或 "partial"）底下"""
+        token = self._kind.set(kind)
+        try:
+            yield
+        finally:
+            self._kind.reset(token)
+
+    def process(self, pcm, sample_rate):
+        """裁切靜音、正規化音量，回傳處理後的 int16 PCM（本機與雲端辨識共用）"""
+        pcm = pcm.reshape(-1)
+        original = len(pcm)
+        kind = self._kind.get()
+        with tracing.span("audio_prep" if kind == "final" else f"audio_prep_{kind}"):
+            if self.trim:
+                start, end = voiced_range(pcm, sample_rate, pad_ms=self.pad_ms)
+                pcm = pcm[start:end]
+            if self.normalize:
+                pcm, _ = normalize_gain(pcm, self.target_db, self.max_gain_db)
+        with self._lock:
+            counts = self._counts[kind]
+            counts["requests"] += 1
+            counts["bytes_in"] += 44 + original * 2
+            counts["seconds_in"] += original / sample_rate
+            counts["seconds_out"] += len(pcm) / sample_rate
+        return pcm
+
+    def encode(self, pcm, sample_rate):
+        """依設定的格式編碼成上傳位元組，回傳 (位元組, Content-Type)"""
+        body, content_type = self._encode(pcm, sample_rate)
+        with self._lock:
+            self._counts[self._kind.get()]["bytes_out"] += len(body)
+        return body, content_type
+
+    def _encode(self, pcm, sample_rate):
+        if self.audio_format != 'wav':
+            try:
+                import soundfile
+                with tracing.span(f"{self.audio_format}_encode"):
+                    buffer = io.BytesIO()
+                    if self.audio_format == 'flac':
+                        soundfile.write(buffer, pcm, sample_rate, format='FLAC', subtype='PCM_16')
+                    else:
+                        soundfile.write(buffer, pcm, sample_rate, format='OGG', subtype='OPUS')
+                    return buffer.getvalue(), FORMATS[self.audio_format]
+            except Exception as e:
+                print(f"⚠️ 無法編碼為 {self.audio_format}（{e}），改用 WAV")
+                self.audio_format = 'wav'
+        return encode_wav(pcm, sample_rate), FORMATS['wav']
+
+    def prepare(self, pcm, sample_rate):
+        """int16 PCM → (上傳位元組, Content-Type)"""
+        return self.encode(self.process(pcm, sample_rate), sample_rate)
+
+    def get_stats(self):
+        """最終辨識的統計；串流部分結果另外放在 "partial" 底下"""
+        with self._lock:
+            final, partial = (self._summary(self._counts[kind]) for kind in ("final", "partial"))
+        return {"format": self.audio_format, **final, "partial": partial}
+
+    @staticmethod
+    def _summary(counts):
+        return {
+            "requests": counts["requests"],
+            "bytes_in": counts["bytes_in"],
+            "bytes_out": counts["bytes_out"],
+            "bytes_saved_ratio": round(1 - counts["bytes_out"] / counts["bytes_in"], 3) if counts["bytes_in"] else None,
+            "seconds_in": round(counts["seconds_in"], 2),
+            "seconds_out": round(counts["seconds_out"], 2),
+        }
+
+
+def main():
+    """python audio_prep.py [--format flac] [--live]：以 data/audio 語料比較原始 WAV 與處理後的上傳大小與 ASR 延遲
+
+    預設打本地假 Whisper 端點（推論時間隨音訊長度增加）；--live 時使用 config/.env 設定的真正端點。
+    """
+    import argparse
+    from fake_aws import FakeServiceServer, DEFAULT_LATENCY, CORPUS_DIR, load_corpus, parse_latency
+
+    parser = argparse.ArgumentParser(description="ASR 上傳音訊準備的效益量測")
+    parser.add_argument('--format', default='wav', choices=list(FORMATS))
+    parser.add_argument('--limit', type=int, default=0, help="最多使用幾個語料檔（0 = 全部）")
+    parser.add_argument('--latency', default="", help="假端點延遲，例如 sagemaker=0.4:0.1")
+    parser.add_argument('--trailing-silence', type=float, default=1.5, help="模擬錄音端保留的句尾靜音秒數")
+    parser.add_argument('--live', action='store_true', help="打真正的 SageMaker 端點")
+    args = parser.parse_args()
+
+    server = None
+    if not args.live:
+        server = FakeServiceServer(parse_latency(args.latency, DEFAULT_LATENCY)).start()
+        os.environ.update(server.environ())
+    from speech_to_text_test import SpeechToText
+    transcriber = SpeechToText()
+
+    corpus = [(name, item) for name, item in load_corpus(CORPUS_DIR).items() if item[2]]
+    if args.limit:
+        corpus = corpus[:args.limit]
+    variants = {"原始 WAV": AudioPrep(trim=False, normalize=False),
+                f"裁切+正規化（{args.format}）": AudioPrep(audio_format=args.format)}
+    results = {label: {"latency": [], "changed": 0} for label in variants}
+    for name, (sample_rate, pcm, text) in corpus:
+        pcm = np.concatenate([pcm.astype(np.int16), np.zeros(int(sample_rate * args.trailing_silence), dtype=np.int16)])
+        baseline = None
+        for label, prep in variants.items():
+            body, content_type = prep.prepare(pcm, sample_rate)
+            start = time.perf_counter()
+            transcript, _ = transcriber._invoke(body, content_type)
+            results[label]["latency"].append(time.perf_counter() - start)
+            if baseline is None:
+                baseline = transcript
+            elif transcript != baseline:
+                results[label]["changed"] += 1
+
+    print(f"\n📦 {len(corpus)} 個語料檔")
+    print(f"{'':24}{'上傳 KB':>10}{'音訊秒數':>10}{'ASR p50':>10}{'ASR 平均':>10}{'轉寫不同':>8}")
+    for label, prep in variants.items():
+        stats, latency = prep.get_stats(), np.array(results[label]["latency"])
+        print(f"{label:24}{stats['bytes_out'] / 1024:>10.0f}{stats['seconds_out']:>10.1f}"
+              f"{np.percentile(latency, 50):>10.3f}{latency.mean():>10.3f}{results[label]['changed']:>8}")
+    raw, prepared = [variants[label].get_stats() for label in variants]
+    latencies = [np.mean(results[label]["latency"]) for label in variants]
+    print(f"節省 {1 - prepared['bytes_out'] / raw['bytes_out']:.1%} 位元組、"
+          f"{1 - prepared['seconds_out'] / raw['seconds_out']:.1%} 音訊長度；ASR 平均延遲 {latencies[1] - latencies[0]:+.3f}s")
+    if server:
+        if args.format == 'opus':
+            print("（假端點以樣本指紋比對，無法辨識有損壓縮的音訊；Opus 的轉寫品質請以 --live 驗證）")
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import os
+import time
+import threading
+import boto3
+import requests
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import startup
+
+# ✅ 載入 config/.env（用絕對路徑避免錯誤）
+startup.load_env()
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_http_session = None
+
+
+def client_config():
+    """共用的 botocore 設定：連線池大小、逾時、自適應重試、TCP keep-alive"""
+    return Config(
+        max_pool_connections=int(os.getenv('AWS_MAX_POOL_CONNECTIONS', '20')),
+        connect_timeout=float(os.getenv('AWS_CONNECT_TIMEOUT', '3')),
+        read_timeout=float(os.getenv('AWS_READ_TIMEOUT', '60')),
+        retries={
+            'mode': os.getenv('AWS_RETRY_MODE', 'adaptive'),
+            'max_attempts': int(os.getenv('AWS_MAX_ATTEMPTS', '3')),
+        },
+        tcp_keepalive=True,
+    )
+
+
+def get_session():
+    """行程內共用的 boto3 Session（憑證只解析一次）"""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = boto3.session.Session(
+                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+            )
+        return _session
+
+
+def get_client(service_name, region_name=None):
+    """依 (服務, 區域) 取得共用的 boto3 客戶端；客戶端是執行緒安全的，可跨請求重用連線"""
+    region_name = region_name or os.getenv('AWS_REGION', 'us-west-2')
+    key = (service_name, region_name)
+    client = _clients.get(key)
+    if client is None:
+        session = get_session()
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = session.client(service_name, region_name=region_name, config=client_config())
+                _clients[key] = client
+    return client
+
+
+def get_http_session():
+    """共用的 requests.Session：keep-alive 連線池，對暫時性錯誤自動重試"""
+    global _http_session
+    with _lock:
+        if _http_session is None:
+            retry = Retry(
+                total=int(os.getenv('HTTP_MAX_RETRIES', '2')),
+                backoff_factor=0.2,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(['GET', 'HEAD']),
+            )
+            pool_size = int(os.getenv('HTTP_POOL_SIZE', '10'))
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+        return _http_session
+
+
+def http_timeout():
+    """requests 使用的 (連線, 讀取) 逾時秒數"""
+    return (float(os.getenv('HTTP_CONNECT_TIMEOUT', '3')), float(os.getenv('HTTP_READ_TIMEOUT', '10')))
+
+
+# 各服務用來建立連線的輕量呼叫；回傳錯誤也無妨，TLS 連線已留在連線池裡
+WARMUP_CALLS = {
+    'bedrock-runtime': lambda client: client.list_async_invokes(maxResults=1),
+    'polly': lambda client: client.describe_voices(LanguageCode='cmn-CN'),
+    # sagemaker-runtime 沒有唯讀 API：呼叫不存在的端點只會回 ValidationException，不會觸發模型
+    'sagemaker-runtime': lambda client: client.invoke_endpoint(
+        EndpointName='connection-prewarm', ContentType='audio/wav', Body=b''),
+}
+
+
+def prewarm(services=None, urls=None):
+    """啟動時先解析憑證、建立客戶端並打開連線，第一個請求不必再付握手成本；回傳各項耗時（秒）"""
+    services = services if services is not None else [
+        ('bedrock-runtime', None),
+        ('sagemaker-runtime', None),
+        ('polly', 'us-east-1'),
+    ]
+    urls = urls if urls is not None else [os.getenv('GOOGLE_SEARCH_URL', 'https://www.googleapis.com/customsearch/v1')]
+    timings = {}
+
+    start = time.time()
+    try:
+        get_session().get_credentials()
+    except BotoCoreError as e:
+        print(f"⚠️ AWS 憑證解析失敗：{e}")
+    timings['credentials'] = round(time.time() - start, 3)
+
+    for service_name, region_name in services:
+        start = time.time()
+        client = get_client(service_name, region_name)
+        warmup = WARMUP_CALLS.get(service_name)
+        if warmup:
+            try:
+                warmup(client)
+            except ClientError:
+                pass
+            except BotoCoreError as e:
+                print(f"⚠️ {service_name} 連線預熱失敗：{e}")
+        timings[service_name] = round(time.time() - start, 3)
+
+    session = get_http_session()
+    for url in urls:
+        start = time.time()
+        try:
+            session.head(url, timeout=http_timeout())
+        except requests.RequestException as e:
+            print(f"⚠️ {url} 連線預熱失敗：{e}")
+        timings[url] = round(time.time() - start, 3)
+
+    print(f"🔥 連線預熱完成：{timings}")
+    return timings
+
+
+def main():
+    """python aws_clients.py：預熱兩次，比較冷啟動與重用連線的耗時"""
+    print("第一次（冷啟動）：", prewarm())
+    print("第二次（重用連線）：", prewarm())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+import os
+import sys
+import glob
+import time
+import threading
+from functools import lru_cache
+import numpy as np
+from scipy.fft import dct
+from scipy.io import wavfile
+from scipy.spatial.distance import cdist
+import tracing
+
+# 本地關鍵字（與 app.process_command 的控制指令相同）
+KEYWORDS = ("停", "慢一點", "快一點", "正常")
+KEYWORD_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'keywords'))
+
+
+# ====== 關鍵字辨識（MFCC + DTW 範本比對）======
+
+@lru_cache(maxsize=4)
+def mel_filterbank(n_mels, n_fft, sample_rate):
+    """三角形 Mel 濾波器組，形狀 (n_mels, n_fft // 2 + 1)"""
+    def to_mel(hz):
+        return 2595 * np.log10(1 + hz / 700)
+
+    def to_hz(mel):
+        return 700 * (10 ** (mel / 2595) - 1)
+
+    points = to_hz(np.linspace(to_mel(0), to_mel(sample_rate / 2), n_mels + 2))
+    bins = np.floor((n_fft + 1) * points / sample_rate).astype(int)
+    bank = np.zeros((n_mels, n_fft // 2 + 1), dtype=np.float32)
+    for m in range(1, n_mels + 1):
+        left, center, right = bins[m - 1], bins[m], bins[m + 1]
+        if center > left:
+            bank[m - 1, left:center] = (np.arange(left, center) - left) / (center - left)
+        if right > center:
+            bank[m - 1, center:right] = (right - np.arange(center, right)) / (right - center)
+    return bank
+
+
+def mfcc(pcm, sample_rate=16000, n_mfcc=13, n_mels=26, frame_ms=25, hop_ms=10, n_fft=512):
+    """int16 PCM → MFCC（去掉 c0 並做倒頻譜均值正規化），形狀 (音框數, n_mfcc - 1)"""
+    x = pcm.reshape(-1).astype(np.float32) / 32768.0
+    x = np.append(x[:1], x[1:] - 0.97 * x[:-1])
+    frame = int(sample_rate * frame_ms / 1000)
+    hop = int(sample_rate * hop_ms / 1000)
+    if len(x) < frame:
+        x = np.pad(x, (0, frame - len(x)))
+    count = 1 + (len(x) - frame) // hop
+    index = np.arange(frame)[None, :] + hop * np.arange(count)[:, None]
+    frames = x[index] * np.hamming(frame).astype(np.float32)
+    power = np.abs(np.fft.rfft(frames, n_fft)) ** 2 / n_fft
+    log_mel = np.log(power @ mel_filterbank(n_mels, n_fft, sample_rate).T + 1e-10)
+    coefficients = dct(log_mel, type=2, axis=1, norm='ortho')[:, 1:n_mfcc]
+    return coefficients - coefficients.mean(axis=0)
+
+
+def trim_silence(pcm, sample_rate=16000, floor_db=-35.0, window_ms=10):
+    """去掉前後能量低於峰值 floor_db 的部分（VAD 切出的語句含前置與尾端靜音）"""
+    window = int(sample_rate * window_ms / 1000)
+    count = len(pcm) // window
+    if count == 0:
+        return pcm
+    x = pcm[:count * window].reshape(count, window).astype(np.float32)
+    energy_db = 10 * np.log10(np.mean(x * x, axis=1) + 1e-6)
+    active = np.nonzero(energy_db > energy_db.max() + floor_db)[0]
+    if len(active) == 0:
+        return pcm[:0]
+    return pcm[active[0] * window:(active[-1] + 1) * window]
+
+
+def dtw_distance(a, b, band_ratio=0.4):
+    """兩段 MFCC 序列的 DTW 距離（以路徑長度正規化；Sakoe-Chiba 帶狀限制）"""
+    cost = cdist(a, b)
+    n, m = cost.shape
+    band = max(int(band_ratio * max(n, m)), abs(n - m)) + 1
+    acc = np.full((n + 1, m + 1), np.inf)
+    acc[0, 0] = 0.0
+    for i in range(1, n + 1):
+        center = int(i * m / n)
+        for j in range(max(1, center - band), min(m, center + band) + 1):
+            acc[i, j] = cost[i - 1, j - 1] + min(acc[i - 1, j], acc[i, j - 1], acc[i - 1, j - 1])
+    return acc[n, m] / (n + m)
+
+
+class KeywordSpotter:
+    """小型本地關鍵字辨識：短語句與各關鍵字的錄音範本做 MFCC + DTW 比對
+
+    範本放在 data/keywords/<關鍵字>_*.wav（16 kHz 單聲道，可用 python barge_in.py enroll 錄製）；
+    沒有錄音範本的關鍵字改用 Polly 以不同語速合成的 PCM 當範本（效果不如本人錄音）。
+    語句長度超過 max_seconds 一律不比對，交回雲端 ASR。
+    """
+
+    def __init__(self, sample_rate=16000, threshold=None, max_seconds=None, keyword_dir=KEYWORD_DIR):
+        self.sample_rate = sample_rate
+        self.threshold = threshold or float(os.getenv('KWS_THRESHOLD', '4.5'))
+        self.max_seconds = max_seconds or float(os.getenv('KWS_MAX_SECONDS', '1.5'))
+        self.keyword_dir = keyword_dir
+        self.templates = {}
+        self.hits = 0
+        self.rejects = 0
+        self._lock = threading.Lock()
+
+    def add_template(self, label, pcm):
+        features = mfcc(trim_silence(pcm, self.sample_rate), self.sample_rate)
+        with self._lock:
+            self.templates.setdefault(label, []).append(features)
+
+    def load(self):
+        """載入 data/keywords 下的錄音範本"""
+        for path in sorted(glob.glob(os.path.join(self.keyword_dir, '*.wav'))):
+            label = os.path.basename(path).rsplit('_', 1)[0]
+            sample_rate, pcm = wavfile.read(path)
+            if sample_rate == self.sample_rate:
+                self.add_template(label, pcm.reshape(-1).astype(np.int16))
+        return self
+
+    def ensure_templates(self, speaker, keywords=KEYWORDS, rates=("80%", "100%", "130%")):
+        """沒有錄音範本的關鍵字以 Polly 合成範本（建議在背景執行緒呼叫）"""
+        for label in keywords:
+            if label in self.templates:
+                continue
+            for rate in rates:
+                pcm = speaker.synthesize_pcm(label, rate=rate, sample_rate=self.sample_rate)
+                if pcm is not None and len(pcm):
+                    self.add_template(label, pcm)
+        print(f"🗝️ 關鍵字範本：{ {label: len(items) for label, items in self.templates.items()} }")
+
+    def spot(self, pcm):
+        """回傳 (關鍵字, 距離)；不像任何關鍵字時回傳 (None, 最近距離)"""
+        if not self.templates or len(pcm) > self.max_seconds * self.sample_rate:
+            return None, None
+        pcm = trim_silence(pcm.reshape(-1), self.sample_rate)
+        if len(pcm) < 0.1 * self.sample_rate:
+            return None, None
+        with tracing.span("keyword_spot"):
+            features = mfcc(pcm, self.sample_rate)
+            best, best_distance = None, np.inf
+            with self._lock:
+                templates = [(label, t) for label, items in self.templates.items() for t in items]
+            for label, template in templates:
+                # 長度差太多的範本不必比對
+                if not 0.5 <= len(features) / len(template) <= 2.0:
+                    continue
+                distance = dtw_distance(features, template)
+                if distance < best_distance:
+                    best, best_distance = label, distance
+        if best is not None and best_distance <= self.threshold:
+            self.hits += 1
+            return best, best_distance
+        self.rejects += 1
+        return None, (None if best is None else best_distance)
+
+
+# ====== 回音抑制與說話起點偵測 ======
+
+class EchoSuppressor:
+    """播放期間的回音抑制（半雙工）與插話起點偵測
+
+    播放中的麥克風能量與「播放參考訊號的能量包絡 + 耦合增益」比較：高出 margin_db 持續 onset_ms
+    才視為使用者開口（插話），否則視為回音並把音訊衰減 attenuation 倍，後面的 VAD 就不會把回音當成語句。
+    參考包絡取目前時間往前 delay_ms 範圍內的最大值，容許喇叭到麥克風的延遲不確定；
+    耦合增益在每次播放開頭 train_ms 內自由學習，之後只在沒有插話時緩慢更新。
+    沒有參考訊號（無法解碼）時改用播放期間的麥克風能量底當作回音估計；預期回音不低於未播放時的環境噪音底。
+    輸出延遲 onset_ms：判定為插話時，起點前那段音訊也原樣送出，不會切掉第一個音節。
+    """
+
+    def __init__(self, reference, sample_rate=16000, subframe_ms=10, margin_db=10.0, onset_ms=60, hangover_ms=300,
+                 delay_ms=250, train_ms=300, attenuation=0.01, learn_rate=0.05):
+        self.reference = reference
+        self.sample_rate = sample_rate
+        self.subframe = int(sample_rate * subframe_ms / 1000)
+        self.subframe_s = subframe_ms / 1000
+        self.margin_db = margin_db
+        self.onset = max(1, int(onset_ms / subframe_ms))
+        self.hangover = max(1, int(hangover_ms / subframe_ms))
+        self.delay = max(1, int(delay_ms / subframe_ms))
+        self.train_s = train_ms / 1000
+        self.attenuation = attenuation
+        self.learn_rate = learn_rate
+        self.coupling_db = None
+        self.echo_floor_db = None
+        self.noise_db = None
+        self._train_min_db = None
+        self.near_end = False
+        self._candidate = 0
+        self._silent = 0
+        self._delay_samples = self.onset * self.subframe
+        self._buffer = np.zeros(self._delay_samples, dtype=np.int16)
+        self._passes = np.ones(self._delay_samples, dtype=bool)
+        self._remainder = np.zeros(0, dtype=np.int16)
+
+    def _predicted_echo(self, envelope, hop, t):
+        """回傳 (參考能量 dB, 時間 t（相對播放開始）的預期回音能量 dB)；尚未學到耦合增益時後者為 None"""
+        if envelope is not None:
+            i = int(t / hop)
+            window = envelope[max(0, i - self.delay):max(0, i) + 1]
+            ref_db = float(window.max()) if len(window) else -100.0
+            predicted = ref_db + self.coupling_db if self.coupling_db is not None else None
+        else:
+            ref_db, predicted = None, self.echo_floor_db
+        # 還沒量到環境噪音底（一啟動就在播放）時，以學習期間的最低能量代替
+        floor = self.noise_db if self.noise_db is not None else self._train_min_db
+        if predicted is not None and floor is not None:
+            predicted = max(predicted, floor)
+        return ref_db, predicted
+
+    def _learn(self, mic_db, ref_db, training):
+        rate = 0.3 if training else self.learn_rate
+        if training:
+            self._train_min_db = mic_db if self._train_min_db is None else min(self._train_min_db, mic_db)
+        if ref_db is not None:
+            if ref_db > 20:
+                # 追蹤上緣（上升快、下降慢）：參考取的是視窗最大值，平均會低估實際回音
+                target = mic_db - ref_db
+                if self.coupling_db is None:
+                    self.coupling_db = target
+                else:
+                    self.coupling_db += (0.3 if target > self.coupling_db else rate * 0.2) * (target - self.coupling_db)
+        else:
+            self.echo_floor_db = mic_db if self.echo_floor_db is None else self.echo_floor_db + rate * (mic_db - self.echo_floor_db)
+
+    def process(self, frame, now=None):
+        """輸入 int16 音框，回傳 (處理後的音框（同長度、延遲 onset_ms）, 是否剛偵測到插話起點)"""
+        frame = frame.reshape(-1)
+        now = now or time.time()
+        playing = self.reference.check_audio()
+        samples = np.concatenate([self._remainder, frame])
+        count = len(samples) // self.subframe
+        self._remainder = samples[count * self.subframe:]
+        passes = np.ones(count * self.subframe, dtype=bool)
+        onset = False
+
+        x = samples[:count * self.subframe].reshape(count, self.subframe).astype(np.float32)
+        mic_db = 10 * np.log10(np.mean(x * x, axis=1) + 1e-6)
+        if playing and count:
+            start, envelope, hop = self.reference.playback_reference()
+            # 這批子音框的錄音時間（最後一個子音框結束於 now）
+            times = now - start - (count - 1 - np.arange(count)) * self.subframe_s - len(self._remainder) / self.sample_rate
+            for i in range(count):
+                ref_db, predicted = self._predicted_echo(envelope, hop, times[i])
+                training = times[i] < self.train_s
+                if training or predicted is None:
+                    self._learn(mic_db[i], ref_db, True)
+                    passes[i * self.subframe:(i + 1) * self.subframe] = False
+                    continue
+                if mic_db[i] > predicted + self.margin_db:
+                    self._candidate += 1
+                    self._silent = 0
+                else:
+                    self._candidate = 0
+                    if self.near_end:
+                        self._silent += 1
+                        if self._silent >= self.hangover:
+                            self.near_end = False
+                    else:
+                        self._learn(mic_db[i], ref_db, False)
+                if not self.near_end and self._candidate >= self.onset:
+                    self.near_end = True
+                    onset = True
+                    # 起點前的候選子音框（可能還在延遲緩衝區裡）一併放行
+                    run = self._candidate * self.subframe
+                    head = run - (i + 1) * self.subframe
+                    if head > 0:
+                        self._passes[-min(head, len(self._passes)):] = True
+                    passes[max(0, (i + 1) * self.subframe - run):(i + 1) * self.subframe] = True
+                elif not self.near_end:
+                    passes[i * self.subframe:(i + 1) * self.subframe] = False
+        elif not playing:
+            self.near_end = False
+            self._candidate = 0
+            self.echo_floor_db = None
+            for value in mic_db:
+                # 環境噪音底：下降快、上升慢（與 SpectralVAD 相同的追蹤方式）
+                rate = 0.5 if self.noise_db is None or value < self.noise_db else 0.02
+                self.noise_db = value if self.noise_db is None else self.noise_db + rate * (value - self.noise_db)
+
+        buffer = np.concatenate([self._buffer, samples[:count * self.subframe]])
+        flags = np.concatenate([self._passes, passes])
+        out, out_flags = buffer[:len(frame)], flags[:len(frame)]
+        self._buffer, self._passes = buffer[len(frame):], flags[len(frame):]
+        if len(out) < len(frame):
+            out = np.pad(out, (len(frame) - len(out), 0))
+            out_flags = np.pad(out_flags, (len(frame) - len(out_flags), 0), constant_values=True)
+        out = np.where(out_flags, out, (out * self.attenuation).astype(np.int16)).astype(np.int16)
+        return out, onset
+
+
+class BargeIn:
+    """插話：播放中持續聆聽，使用者一開口就降低音量（或直接停止），控制指令在本地辨識
+
+    - filter(音框)：錄音端每個音框先經過這裡（回音抑制 + 起點偵測），偵測到插話立即降低音量或停止播放
+    - intercept(整句音訊)：播放中的句尾先給關鍵字辨識（由收尾執行緒呼叫）；是控制指令就在本地處理，不再送雲端 ASR；
+      降低音量後說的是一般語句（長度達 min_speech）則停止播放、照常送出，太短的雜音則恢復音量並丟棄
+    """
+
+    def __init__(self, speaker, spotter=None, on_keyword=None, sample_rate=16000, action=None, duck_volume=None,
+                 min_speech=None):
+        self.speaker = speaker
+        self.spotter = spotter
+        self.on_keyword = on_keyword
+        self.sample_rate = sample_rate
+        self.action = action or os.getenv('BARGE_IN_ACTION', 'duck')
+        self.duck_volume = duck_volume if duck_volume is not None else float(os.getenv('BARGE_IN_DUCK_VOLUME', '0.2'))
+        self.min_speech = min_speech or float(os.getenv('BARGE_IN_MIN_SPEECH', '0.4'))
+        self.suppressor = EchoSuppressor(speaker, sample_rate, margin_db=float(os.getenv('BARGE_IN_MARGIN_DB', '10')))
+        self.read_size = int(sample_rate * 0.02)
+        self.ducked = False
+        self.stats = {"onsets": 0, "keywords": 0, "interrupted": 0, "false_alarms": 0}
+
+    @classmethod
+    def from_env(cls, speaker, on_keyword=None, sample_rate=16000):
+        spotter = None
+        if os.getenv('KWS', '1') == '1':
+            spotter = KeywordSpotter(sample_rate).load()
+        return cls(speaker, spotter, on_keyword, sample_rate)
+
+    def filter(self, frame):
+        start = time.perf_counter()
+        out, onset = self.suppressor.process(frame)
+        if onset and self.speaker.check_audio():
+            self.stats["onsets"] += 1
+            if self.action == "stop":
+                self.speaker.stop_audio()
+            else:
+                self.speaker.duck(self.duck_volume)
+                self.ducked = True
+            tracing.record("barge_in", time.perf_counter() - start)
+            print(f"✋ 偵測到插話，已{'停止' if self.action == 'stop' else '降低音量'}")
+        return out.reshape(frame.shape)
+
+    def intercept(self, audio):
+        """回傳 True 表示這句話已在本地處理，不必再送 ASR
+
+        只在播放中（或剛因插話降低音量）才做關鍵字辨識；沒在朗讀時的短句（例如行動指令）照常送 ASR。
+        DTW 比對需要數十毫秒，請在錄音執行緒以外呼叫。
+        """
+        ducked, self.ducked = self.ducked, False
+        if not ducked and not self.speaker.check_audio():
+            return False
+        label = None
+        if self.spotter:
+            label, distance = self.spotter.spot(audio)
+        if label:
+            self.stats["keywords"] += 1
+            print(f"🗝️ 本地關鍵字：{label}（距離 {distance:.2f}）")
+            if ducked:
+                self.speaker.restore_volume()
+            if self.on_keyword:
+                self.on_keyword(label)
+            return True
+        if ducked:
+            if len(audio) < self.min_speech * self.sample_rate:
+                self.stats["false_alarms"] += 1
+                self.speaker.restore_volume()
+                return True
+            self.stats["interrupted"] += 1
+            self.speaker.stop_audio()
+        return False
+
+    def get_stats(self):
+        stats = dict(self.stats, action=self.action)
+        if self.spotter:
+            stats.update({"kws_hits": self.spotter.hits, "kws_rejects": self.spotter.rejects,
+                          "templates": {label: len(items) for label, items in self.spotter.templates.items()}})
+        return stats
+
+
+def main():
+    """python barge_in.py enroll <關鍵字> [次數]：錄製範本；python barge_in.py test <wav...>：測試關鍵字辨識"""
+    if len(sys.argv) < 3 or sys.argv[1] not in ("enroll", "test"):
+        print(main.__doc__)
+        return
+
+    from recorder import AudioRecorder
+    recorder = AudioRecorder()
+    if sys.argv[1] == "enroll":
+        label = sys.argv[2]
+        count = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+        os.makedirs(KEYWORD_DIR, exist_ok=True)
+        existing = len(glob.glob(os.path.join(KEYWORD_DIR, f"{label}_*.wav")))
+        for n in range(count):
+            print(f"🎙️ 請說「{label}」（{n + 1}/{count}）")
+            for kind, audio in recorder.utterance_events():
+                if kind == "end":
+                    path = os.path.join(KEYWORD_DIR, f"{label}_{existing + n}.wav")
+                    wavfile.write(path, recorder.sample_rate, np.array(audio))
+                    print(f"💾 {path}（{len(audio) / recorder.sample_rate:.2f}s）")
+                    break
+        return
+
+    spotter = KeywordSpotter(recorder.sample_rate).load()
+    if not spotter.templates:
+        print(f"⚠️ {KEYWORD_DIR} 沒有範本，請先執行 enroll")
+        return
+    for path in sys.argv[2:]:
+        sample_rate, pcm = wavfile.read(path)
+        start = time.perf_counter()
+        label, distance = spotter.spot(pcm.reshape(-1).astype(np.int16))
+        print(f"{path}: {label}（距離 {distance}，{(time.perf_counter() - start) * 1000:.1f} ms）")
+
+
+if __name__ == "__main__":
+    main()
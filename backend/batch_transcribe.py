@@ -0,0 +1,255 @@
+import os
+import sys
+import glob
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from audio_prep import decode_wav
+from history_store import HISTORY_DIR, read_records
+
+# ✅ 錄音封存（專案根目錄 data/audio）、舊版轉寫結果與預設輸出位置
+ARCHIVE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'audio'))
+TRANSCRIPT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'transcripts'))
+DEFAULT_OUTPUT = os.path.join(HISTORY_DIR, 'batch_transcripts.jsonl')
+
+
+class RateLimiter:
+    """所有工作執行緒共用的請求速率上限（每秒 rate 次，平均分散，不會一口氣打滿端點）；rate <= 0 時不限制"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def list_inputs(source, pattern='*.wav'):
+    """資料夾（遞迴找 pattern）或清單檔 → 音檔絕對路徑
+
+    清單檔可以是每行一個路徑的 .txt，或每行含 audio_file／path 欄位的 .jsonl；相對路徑以清單檔所在資料夾為準。
+    """
+    if os.path.isdir(source):
+        return sorted(glob.glob(os.path.join(source, '**', pattern), recursive=True))
+    base = os.path.dirname(os.path.abspath(source))
+    paths = []
+    with open(source, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                data = json.loads(line)
+                line = data.get('audio_file') or data.get('path')
+                if not line:
+                    continue
+            paths.append(os.path.normpath(os.path.join(base, line)))
+    return paths
+
+
+def load_previous(transcript_dir=TRANSCRIPT_DIR, history_dir=HISTORY_DIR):
+    """舊版 JSON 檔與歷史紀錄中的轉寫結果 {檔名: 文字}，用來比較端點更新前後的差異"""
+    previous = {}
+    for path in glob.glob(os.path.join(transcript_dir, '*.json')):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        previous[data.get('audio_file')] = data.get('transcript', '')
+    for data in read_records('transcript', history_dir):
+        previous.setdefault(data.get('audio_file'), data.get('transcript', ''))
+    return previous
+
+
+def load_checkpoint(output_path, endpoint):
+    """輸出檔同時是斷點：已成功轉寫（同一端點）的檔案不再重跑；失敗的下次會重試"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError:
+                # 上次中斷時寫到一半的最後一行
+                continue
+            if data.get('endpoint') == endpoint and not data.get('error'):
+                done.add(data.get('path'))
+    return done
+
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def char_error_rate(reference, hypothesis):
+    """字元錯誤率：編輯距離 / 參考文字長度"""
+    if not reference:
+        return 0.0 if not hypothesis else 1.0
+    row = list(range(len(hypothesis) + 1))
+    for i, ref_char in enumerate(reference, 1):
+        diagonal, row[0] = row[0], i
+        for j, hyp_char in enumerate(hypothesis, 1):
+            diagonal, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, diagonal + (ref_char != hyp_char))
+    return row[-1] / len(reference)
+
+
+class BatchTranscriber:
+    """大量轉寫封存錄音：有上限的執行緒池並行、共用速率限制，結果逐筆附加到單一 JSONL
+
+    轉寫只花在等端點回應，執行緒就夠用；本機引擎自己會一次只跑一句。
+    結果不寫入對話歷史，也不覆蓋舊的轉寫紀錄。
+    """
+
+    def __init__(self, transcriber, converter, engine="cloud", workers=4, rate=0.0, previous=None, endpoint=None):
+        self.transcriber = transcriber
+        # 紀錄與斷點用的端點標籤（假端點的結果不能算成真正端點已完成）
+        self.endpoint = endpoint or transcriber.endpoint_name
+        self.converter = converter
+        # cloud：全部送 SageMaker 端點（更新端點後重新評分用）；router：與線上相同的本機／雲端路由
+        self.engine = engine
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.previous = previous or {}
+
+    def transcribe(self, path):
+        """單一檔案 → 結果紀錄（錯誤也寫成紀錄，不中斷整批）"""
+        name = os.path.basename(path)
+        record = {"path": path, "audio_file": name, "endpoint": self.endpoint,
+                  "engine": self.engine, "time": datetime.now().isoformat(timespec="milliseconds")}
+        try:
+            with open(path, 'rb') as f:
+                pcm, sample_rate = decode_wav(f.read())
+            record["seconds"] = round(len(pcm) / sample_rate, 2)
+            pcm = self.transcriber.prep.process(pcm, sample_rate)
+            self.limiter.acquire()
+            start = time.perf_counter()
+            text, confidence = self.transcriber.router.transcribe(pcm, sample_rate, cloud_only=self.engine == "cloud")
+            record["latency"] = round(time.perf_counter() - start, 3)
+            record["transcript"] = self.converter.convert(text) if text else ""
+            record["confidence"] = confidence
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+            return record
+        previous = self.previous.get(name)
+        if previous is not None:
+            # 舊紀錄可能是未經 OpenCC 轉換的簡體，先轉成繁體再比較
+            record["previous"] = previous = self.converter.convert(previous) if previous else ""
+            record["cer"] = round(char_error_rate(previous, record["transcript"]), 3)
+        return record
+
+    def run(self, paths, output_path, progress_every=50):
+        """並行轉寫 paths，逐筆附加到 output_path；回傳統計摘要"""
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        summary = {"total": len(paths), "done": 0, "failed": 0, "changed": 0, "compared": 0, "cer_sum": 0.0}
+        start = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="batch-asr")
+        try:
+            with open(output_path, 'a', encoding='utf-8') as out:
+                # 上次中斷時最後一行可能只寫了一半，先補上換行，新紀錄才不會接在它後面
+                if out.tell() and not _ends_with_newline(output_path):
+                    out.write("\n")
+                futures = [executor.submit(self.transcribe, path) for path in paths]
+                for future in as_completed(futures):
+                    record = future.result()
+                    # ✅ 只有主執行緒寫檔；每筆立即寫出，中斷後可從斷點繼續
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    out.flush()
+                    if record.get("error"):
+                        summary["failed"] += 1
+                        print(f"❌ {record['audio_file']}: {record['error']}")
+                    else:
+                        summary["done"] += 1
+                        if "cer" in record:
+                            summary["compared"] += 1
+                            summary["cer_sum"] += record["cer"]
+                            summary["changed"] += record["transcript"] != record["previous"]
+                    finished = summary["done"] + summary["failed"]
+                    if finished % progress_every == 0:
+                        elapsed = time.perf_counter() - start
+                        print(f"📝 {finished}/{len(paths)}，{finished / elapsed:.1f} 檔/秒，失敗 {summary['failed']}")
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            print("\n⏹️ 已中斷；以相同參數重跑會從斷點繼續")
+            raise
+        executor.shutdown()
+        summary["seconds"] = round(time.perf_counter() - start, 2)
+        summary["mean_cer"] = round(summary.pop("cer_sum") / summary["compared"], 4) if summary["compared"] else None
+        return summary
+
+
+def main():
+    """python batch_transcribe.py [資料夾或清單檔] [--workers 8] [--rate 5] [--endpoint 新端點]：批次重新轉寫封存錄音
+
+    結果附加到 --output 的 JSONL（預設 data/history/batch_transcripts.jsonl），同一端點已成功的檔案會跳過；
+    --fake 改打本地假端點，用來驗證流程；紀錄的端點標為 fake:<名稱>，不會被當成真正端點已完成。
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="批次並行轉寫錄音封存")
+    parser.add_argument('source', nargs='?', default=ARCHIVE_DIR, help="音檔資料夾，或 .txt／.jsonl 清單檔")
+    parser.add_argument('--pattern', default='*.wav', help="資料夾模式下的檔名樣式")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help="結果 JSONL（同時作為斷點）")
+    parser.add_argument('--workers', type=int, default=int(os.getenv('BATCH_ASR_WORKERS', '4')))
+    parser.add_argument('--rate', type=float, default=float(os.getenv('BATCH_ASR_RATE', '0')),
+                        help="每秒最多送出幾個請求（0 = 不限制）")
+    parser.add_argument('--endpoint', default="", help="改用的 SageMaker 端點名稱（預設 SAGEMAKER_ENDPOINT_NAME）")
+    parser.add_argument('--engine', default='cloud', choices=['cloud', 'router'])
+    parser.add_argument('--limit', type=int, default=0, help="最多處理幾個檔案（0 = 全部）")
+    parser.add_argument('--restart', action='store_true', help="忽略斷點，全部重新轉寫")
+    parser.add_argument('--fake', action='store_true', help="打本地假 SageMaker 端點")
+    args = parser.parse_args()
+
+    server = None
+    if args.fake:
+        from fake_aws import FakeServiceServer, DEFAULT_LATENCY
+        server = FakeServiceServer(DEFAULT_LATENCY).start()
+        os.environ.update(server.environ())
+    if args.endpoint:
+        os.environ['SAGEMAKER_ENDPOINT_NAME'] = args.endpoint
+    from speech_to_text_test import SpeechToText, converter
+    transcriber = SpeechToText()
+    endpoint = f"fake:{transcriber.endpoint_name}" if args.fake else transcriber.endpoint_name
+
+    paths = [os.path.abspath(path) for path in list_inputs(args.source, args.pattern)]
+    done = set() if args.restart else load_checkpoint(args.output, endpoint)
+    pending = [path for path in paths if path not in done]
+    skipped = len(paths) - len(pending)
+    if args.limit:
+        pending = pending[:args.limit]
+    print(f"🎙️ 共 {len(paths)} 個音檔，已完成 {skipped}，"
+          f"本次轉寫 {len(pending)}（端點 {endpoint}，{args.workers} 執行緒）")
+
+    batch = BatchTranscriber(transcriber, converter, engine=args.engine, workers=args.workers,
+                             rate=args.rate, previous=load_previous(), endpoint=endpoint)
+    try:
+        summary = batch.run(pending, args.output)
+    except KeyboardInterrupt:
+        sys.exit(130)
+    finally:
+        if server:
+            server.stop()
+
+    print(f"\n✅ 完成 {summary['done']}、失敗 {summary['failed']}，耗時 {summary['seconds']}s → {args.output}")
+    if summary["compared"]:
+        print(f"與先前轉寫比較 {summary['compared']} 筆：不同 {summary['changed']} 筆，平均字元錯誤率 {summary['mean_cer']:.2%}")
+    print(json.dumps({"prep": transcriber.prep.get_stats(), "routing": transcriber.router.get_stats()}, ensure_ascii=False))
+    if summary["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
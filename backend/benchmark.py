@@ -0,0 +1,207 @@
+# ===== 端到端延遲基準測試 =====
+#
+# python benchmark.py [--turns 40] [--sessions 4] [--latency bedrock=0.8:0.2] [--baseline FILE] [--save-baseline]
+#
+# 啟動本地假 SageMaker／Bedrock／Polly／Google 服務，讓 app.py 真正的 handle_heard_audio 流程
+# （boto3 簽章與連線池、OpenCC、本地分類、歷史寫入…）處理 data/audio 的錄音語料，
+# 統計各階段 p50/p95/p99、N 個工作階段並行時的吞吐量與記憶體用量。
+# 指定 --baseline 時與儲存的基準比較，任一階段退步超過容許範圍即以結束碼 1 離開（可用於 CI）。
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import tracemalloc
+import numpy as np
+
+from fake_aws import FakeServiceServer, CORPUS_DIR, DEFAULT_LATENCY, parse_latency, load_corpus
+
+BASELINE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json'))
+STAGES = ("asr", "classify", "respond", "tts", "playback")
+
+
+def percentiles(values):
+    values = np.array(values) if values else np.zeros(1)
+    return {
+        "count": int(len(values)),
+        "p50": round(float(np.percentile(values, 50)), 4),
+        "p95": round(float(np.percentile(values, 95)), 4),
+        "p99": round(float(np.percentile(values, 99)), 4),
+        "mean": round(float(np.mean(values)), 4),
+    }
+
+
+def rss_mb():
+    """行程的最大常駐記憶體（MB；Linux 的 ru_maxrss 單位為 KB）"""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def instrument(app, samples, lock):
+    """把 app 的各階段函式換成計時版本（run_turn 每次呼叫時才從模組取出階段函式，所以替換即生效）"""
+    for name in STAGES:
+        original = getattr(app, f"stage_{name}")
+
+        def timed(turn, original=original, name=name):
+            start = time.perf_counter()
+            try:
+                return original(turn)
+            finally:
+                with lock:
+                    samples[name].append(time.perf_counter() - start)
+
+        setattr(app, f"stage_{name}", timed)
+
+
+def run(turns, sessions, latency, keep_caches=False, trace_memory=False):
+    random.seed(0)
+    server = FakeServiceServer(latency).start()
+    history_dir = tempfile.mkdtemp(prefix="benchmark_history_")
+    os.environ.update(server.environ())
+    os.environ.update({
+        'HISTORY_DIR': history_dir,
+        'SDL_AUDIODRIVER': 'dummy',
+        'PIPELINE_MODE': '0',
+        'AWS_PREWARM': '1',
+    })
+    if not keep_caches:
+        # 語料會重複播放，關掉快取才量得到每一輪真正的服務呼叫
+        os.environ.update({'TTS_CACHE': '0', 'RESPONSE_CACHE': '0', 'SEARCH_CACHE_TTL': '0'})
+
+    if trace_memory:
+        tracemalloc.start()
+    rss_before = rss_mb()
+    startup = time.perf_counter()
+    import app
+    startup = time.perf_counter() - startup
+    # 沒有音訊裝置：播放階段只量到送出播放前的等待，不實際發聲
+    app.speaker.play = lambda audio_stream, text="": None
+
+    samples = {name: [] for name in STAGES + ("turn",)}
+    lock = threading.Lock()
+    instrument(app, samples, lock)
+
+    corpus = load_corpus()
+    paths = [os.path.join(CORPUS_DIR, name) for name, item in corpus.items() if item[2]]
+    if not paths:
+        raise SystemExit(f"找不到有轉寫結果的語料：{CORPUS_DIR}")
+
+    # 暖機一輪（載入 OpenCC、建立連線），不列入統計
+    app.handle_heard_audio(paths[0])
+    for values in samples.values():
+        values.clear()
+
+    counter = iter(range(turns))
+    counter_lock = threading.Lock()
+
+    def session_worker():
+        while True:
+            with counter_lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            start = time.perf_counter()
+            app.handle_heard_audio(paths[index % len(paths)])
+            with lock:
+                samples["turn"].append(time.perf_counter() - start)
+
+    wall = time.perf_counter()
+    workers = [threading.Thread(target=session_worker) for _ in range(sessions)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    wall = time.perf_counter() - wall
+
+    report = {
+        "config": {"turns": turns, "sessions": sessions, "latency": latency, "keep_caches": keep_caches},
+        "stages": {name: percentiles(values) for name, values in samples.items()},
+        "throughput_turns_per_s": round(turns / wall, 3),
+        "wall_s": round(wall, 3),
+        "startup_s": round(startup, 3),
+        "startup_breakdown": app.startup.report()["events"],
+        "memory": {"rss_before_mb": rss_before, "rss_peak_mb": rss_mb()},
+        "service_requests": dict(server.requests),
+    }
+    if trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        report["memory"]["python_heap_peak_mb"] = round(peak / 1024 / 1024, 1)
+        tracemalloc.stop()
+    server.stop()
+    return report
+
+
+def compare(report, baseline, tolerance, slack):
+    """回傳退步清單：目前值 > 基準 × (1 + tolerance) + slack 秒"""
+    regressions = []
+    for name, stats in baseline.get("stages", {}).items():
+        current = report["stages"].get(name)
+        if not current or not current["count"]:
+            continue
+        for key in ("p50", "p95"):
+            limit = stats[key] * (1 + tolerance) + slack
+            if current[key] > limit:
+                regressions.append(f"{name} {key}: {current[key]:.3f}s > 基準 {stats[key]:.3f}s（上限 {limit:.3f}s）")
+    base_throughput = baseline.get("throughput_turns_per_s")
+    if base_throughput and report["throughput_turns_per_s"] < base_throughput / (1 + tolerance):
+        regressions.append(f"吞吐量: {report['throughput_turns_per_s']} < 基準 {base_throughput} 輪/秒")
+    return regressions
+
+
+def print_report(report):
+    print(f"\n📊 {report['config']['turns']} 輪、{report['config']['sessions']} 個並行工作階段，"
+          f"耗時 {report['wall_s']}s，吞吐量 {report['throughput_turns_per_s']} 輪/秒，啟動 {report['startup_s']}s")
+    print(f"{'階段':10}{'次數':>6}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, stats in report["stages"].items():
+        print(f"{name:10}{stats['count']:>6}{stats['p50']:>9.3f}{stats['p95']:>9.3f}{stats['p99']:>9.3f}")
+    print(f"記憶體：{report['memory']}")
+    print(f"假服務請求數：{report['service_requests']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="語音管線端到端延遲基準測試（本地假服務）")
+    parser.add_argument('--turns', type=int, default=40)
+    parser.add_argument('--sessions', type=int, default=1, help="並行工作階段數")
+    parser.add_argument('--latency', default="", help="各服務延遲，例如 bedrock=0.8:0.2,polly=0.1:0.02")
+    parser.add_argument('--keep-caches', action='store_true', help="保留語音與回覆快取")
+    parser.add_argument('--trace-memory', action='store_true', help="以 tracemalloc 量測 Python 配置峰值（會拖慢執行）")
+    parser.add_argument('--output', help="把結果寫成 JSON")
+    parser.add_argument('--baseline', nargs='?', const=BASELINE_PATH, help="與基準檔比較，退步時結束碼為 1")
+    parser.add_argument('--save-baseline', nargs='?', const=BASELINE_PATH, help="把這次結果存成基準")
+    parser.add_argument('--tolerance', type=float, default=float(os.getenv('BENCHMARK_TOLERANCE', '0.2')))
+    parser.add_argument('--slack', type=float, default=float(os.getenv('BENCHMARK_SLACK', '0.05')),
+                        help="容許的絕對誤差（秒），避免極短階段因抖動誤判")
+    args = parser.parse_args()
+
+    latency = parse_latency(args.latency, DEFAULT_LATENCY)
+    report = run(args.turns, args.sessions, latency, args.keep_caches, args.trace_memory)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 已儲存基準：{args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline["config"]["latency"] != json.loads(json.dumps(latency)) or baseline["config"]["sessions"] != args.sessions:
+            print("⚠️ 基準檔的延遲設定或工作階段數與這次不同，比較結果僅供參考")
+        regressions = compare(report, baseline, args.tolerance, args.slack)
+        if regressions:
+            print("❌ 效能退步：")
+            for line in regressions:
+                print(f"  - {line}")
+            sys.exit(1)
+        print("✅ 所有階段都在基準容許範圍內")
+
+
+if __name__ == "__main__":
+    main()
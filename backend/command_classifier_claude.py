@@ -1,31 +1,61 @@
 import os
 import json
-import boto3
-from dotenv import load_dotenv
-from datetime import datetime
-import requests
+import time
+import random
+import threading
+from aws_clients import get_client, get_http_session
+from intent_classifier import LocalIntentClassifier
+from response_cache import ResponseCache
+from history_store import get_writer, new_record
+from prompt_templates import PromptLibrary
+from plan_library import PlanLibrary, validate_plan
+from search_retriever import SearchRetriever
+import tracing
+import startup
 
 # ✅ 正確加載環境變數
-env_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'config', '.env'))
-load_dotenv(env_path)
+startup.load_env()
 
 class CommandClassifier:
     def __init__(self):
-        # 設置 AWS Bedrock 客戶端
-        self.client = boto3.client(
-            service_name="bedrock-runtime",
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-            region_name=os.getenv('AWS_REGION', 'us-west-2')
-        )
+        # 設置 AWS Bedrock 客戶端（共用連線池）
+        self.client = get_client("bedrock-runtime")
+        self.http = get_http_session()
+        # ✅ 查詢的檢索階段：多個關鍵字版本並行搜尋、對沖慢請求、結果快取
+        self.retriever = SearchRetriever.from_env(self.http)
 
         # 設置模型 ID
         self.model_id = "anthropic.claude-3-5-sonnet-20241022-v2:0"
 
-        # ✅ 正確載入 assets/command_type.json
-        json_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'assets', 'command_type.json'))
-        with open(json_path, 'r', encoding='utf-8') as f:
-            self.reference_data = json.load(f)
+        # ✅ 資產檔只載入一次、檔案變動時自動重載；提示詞靜態前綴預先組好
+        self.prompts = PromptLibrary(check_interval=float(os.getenv('ASSET_CHECK_INTERVAL', '1.0')))
+        # 對靜態前綴啟用 Bedrock 提示詞快取（需模型支援，且前綴須達模型的最小快取長度）
+        self.prompt_cache = os.getenv('BEDROCK_PROMPT_CACHE', '0') == '1'
+
+        self.history = get_writer()
+
+        # ✅ 本地快速分類（字元 n-gram kNN）：高信心直接採用，低信心才呼叫 Bedrock
+        self.local_classifier = None
+        if os.getenv('LOCAL_CLASSIFIER', '1') == '1':
+            self.local_classifier = LocalIntentClassifier.from_assets()
+
+        # ✅ 聊天／查詢回覆快取（依類型設定過期時間）
+        self.response_cache = None
+        if os.getenv('RESPONSE_CACHE', '1') == '1':
+            self.response_cache = ResponseCache.from_env()
+
+        # ✅ 行動計劃範本庫：與過去成功計劃同類型的任務直接套範本，不呼叫 Bedrock
+        self.plan_library = None
+        if os.getenv('PLAN_LIBRARY', '1') == '1':
+            self.plan_library = PlanLibrary.from_assets(self.prompts.movement)
+
+        # ✅ 單次呼叫「分類＋回覆」模式：哪些類型直接採用合併回覆（其餘類型退回原本的兩段式處理）
+        # 例：FUSED_TYPES=聊天,行動；預設關閉
+        self.fused_types = [t for t in os.getenv('FUSED_TYPES', '').split(',') if t]
+        # 合併模式下，抽樣多少比例在背景另跑一次 classify_command 比對分類是否一致
+        self.fused_shadow_rate = float(os.getenv('FUSED_SHADOW_RATE', '0'))
+        self.mode_stats = {}
+        self._stats_lock = threading.Lock()
 
         self.available_functions = [{
             "function_name": "web_search",
@@ -37,66 +67,192 @@ class CommandClassifier:
             }]
         }]
 
-    def _send_to_model(self, prompt):
-        """發送提示詞到 Claude 模型並獲取回應"""
-        body = json.dumps({
+    def _build_body(self, prompt, prefix=None):
+        """組出請求內容；有靜態前綴時拆成兩個文字區塊，前綴可標記為快取點"""
+        content = prompt
+        if prefix:
+            prefix_block = {"type": "text", "text": prefix}
+            if self.prompt_cache:
+                prefix_block["cache_control"] = {"type": "ephemeral"}
+            content = [prefix_block, {"type": "text", "text": prompt}]
+        return json.dumps({
             "max_tokens": 512,
-            "messages": [{"role": "user", "content": prompt}],
+            "messages": [{"role": "user", "content": content}],
             "anthropic_version": "bedrock-2023-05-31"
         })
 
+    def _send_to_model(self, prompt, prefix=None):
+        """發送提示詞到 Claude 模型並獲取回應（prefix 為可快取的靜態前綴）"""
+        body = self._build_body(prompt, prefix)
+
         try:
-            response = self.client.invoke_model(
-                body=body,
-                modelId=self.model_id,
-                contentType="application/json"
-            )
-            response_body = json.loads(response["body"].read())
+            with tracing.span("llm"):
+                response = self.client.invoke_model(
+                    body=body,
+                    modelId=self.model_id,
+                    contentType="application/json"
+                )
+                response_body = json.loads(response["body"].read())
             return response_body["content"][0]["text"]
         except Exception as e:
             print(f"模型調用錯誤: {str(e)}")
             return "無法獲取模型回應"
 
-    def classify_command(self, text):
-        """分類輸入命令"""
-        examples = "\n".join([f"- 輸入：{item['command']}  類型：{item['command_type']}" for item in self.reference_data])
-
-        prompt = f"""
-        根据以下示例對命令進行分類。
-        示例：
-        {examples}
-        請對以下輸入進行分類：
-        輸入："{text}"
-        請只回復以下三種類型之一：
-        - 聊天
-        - 查詢
-        - 行動
-        """
+    def _stream_from_model(self, prompt, prefix=None):
+        """以串流方式呼叫 Claude，逐段 yield 生成的文字"""
+        body = self._build_body(prompt, prefix)
+
+        try:
+            with tracing.span("llm", stream=True):
+                start = time.perf_counter()
+                first = True
+                response = self.client.invoke_model_with_response_stream(
+                    body=body,
+                    modelId=self.model_id,
+                    contentType="application/json"
+                )
+                for event in response["body"]:
+                    chunk = event.get("chunk")
+                    if not chunk:
+                        continue
+                    data = json.loads(chunk["bytes"])
+                    if data.get("type") == "content_block_delta":
+                        text = data.get("delta", {}).get("text")
+                        if text:
+                            if first:
+                                first = False
+                                tracing.record("llm_first_token", time.perf_counter() - start)
+                            yield text
+        except Exception as e:
+            print(f"模型調用錯誤: {str(e)}")
+            yield "無法獲取模型回應"
+
+    def classify_command(self, text, learn=True, mode="two_call"):
+        """分類輸入命令（learn=False：結果不回饋給本地分類器，供推測執行使用；mode 為延遲統計的分組）"""
+        if self.local_classifier:
+            with tracing.span("classify_local"):
+                local_type = self.local_classifier.classify(text)
+            if local_type:
+                print(f"分類結果: {local_type}（本地）")
+                return local_type
+
+        prefix, prompt = self.prompts.build_classify(text)
 
         # print("\n=== 提示詞內容 ===")
-        # print(prompt)
+        # print(prefix + prompt)
         # print("=== 提示詞結束 ===\n")
 
-        result = self._send_to_model(prompt).strip()
+        start = time.time()
+        result = self._send_to_model(prompt, prefix).strip()
+        self.record_mode(mode, "classify", time.time() - start)
         #print(f"模型響應: {result}\n")
 
+        command_type = self._normalize_label(result)
+        print(f"分類結果: {command_type}")
+        if learn and self.local_classifier and result != "無法獲取模型回應":
+            self.local_classifier.learn(text, command_type)
+        return command_type
+
+    @property
+    def fused_enabled(self):
+        return bool(self.fused_types)
+
+    def classify_and_respond(self, text):
+        """單次模型呼叫同時取得分類與回覆
+
+        回傳 (command_type, response)；若該類型未開啟合併模式或解析失敗，response 為 None，
+        呼叫端應改用對應的 handle_* 產生回覆（但不必再呼叫 classify_command；解析失敗時這裡已改用兩段式分類）。
+        """
+        prefix, prompt = self.prompts.build_fused(text, self.fused_types)
+
+        start = time.time()
+        result = self._send_to_model(prompt, prefix).strip()
+        elapsed = time.time() - start
+
+        command_type = '聊天'
+        response = None
+        try:
+            parsed = self._extract_json(result)
+            label = str(parsed.get("類型", ""))
+            command_type = self._normalize_label(label)
+            if command_type in self.fused_types:
+                response = parsed.get("回覆")
+                if command_type == '行動':
+                    if not self._valid_plan(response):
+                        response = None
+                    elif self.plan_library:
+                        self.plan_library.learn(text, response)
+                elif command_type != '行動' and not isinstance(response, str):
+                    response = None
+        except (json.JSONDecodeError, ValueError, AttributeError) as e:
+            # 自由文字的回覆可能含有「查」「動」等字，不能拿來猜類型；改走兩段式分類
+            print(f"警告：合併回覆解析失敗，改用兩段式流程 - {str(e)}")
+            self.record_mode("fused", "parse_error", elapsed)
+            return self.classify_command(text), None
+
+        print(f"分類結果: {command_type}（合併模式）")
+        self.record_mode("fused", command_type, elapsed)
+
+        if self.fused_shadow_rate and random.random() < self.fused_shadow_rate:
+            threading.Thread(target=self._shadow_classify, args=(text, command_type), daemon=True).start()
+
+        return command_type, response
+
+    def _shadow_classify(self, text, fused_type):
+        """背景跑一次兩段式分類，記錄與合併模式是否一致"""
+        # 延遲另外記在 shadow 分組，不混進兩段式模式的統計
+        two_call_type = self.classify_command(text, mode="shadow")
+        with self._stats_lock:
+            entry = self.mode_stats.setdefault(("shadow", fused_type), {"count": 0, "agree": 0})
+            entry["count"] += 1
+            entry["agree"] += int(two_call_type == fused_type)
+
+    def record_mode(self, mode, command_type, elapsed):
+        """累計各模式、各類型的模型呼叫延遲"""
+        with self._stats_lock:
+            entry = self.mode_stats.setdefault((mode, command_type), {"count": 0, "total_latency": 0.0})
+            entry["count"] += 1
+            entry["total_latency"] += elapsed
+
+    def get_mode_stats(self):
+        """回傳 [{mode, command_type, count, avg_latency / agree_rate}]，方便並排比較"""
+        report = []
+        with self._stats_lock:
+            for (mode, command_type), entry in self.mode_stats.items():
+                row = {"mode": mode, "command_type": command_type, "count": entry["count"]}
+                if "total_latency" in entry:
+                    row["avg_latency"] = round(entry["total_latency"] / entry["count"], 3)
+                if "agree" in entry:
+                    row["agree_rate"] = round(entry["agree"] / entry["count"], 3)
+                report.append(row)
+        return report
+
+    @staticmethod
+    def _normalize_label(result):
         if '查' in result or '詢' in result:
-            print("分類結果: 查詢")
             return '查詢'
         elif '行' in result or '動' in result:
-            print("分類結果: 行動")
             return '行動'
+        return '聊天'
+
+    @staticmethod
+    def _extract_json(result):
+        if "```json" in result:
+            json_str = result.split("```json")[1].split("```")[0].strip()
         else:
-            print("分類結果: 聊天")
-            return '聊天'
+            json_str = result.strip()
+        return json.loads(json_str)
 
-    def chat_with_gemini(self, text):
-        """與 Claude 聊天"""
-        prompt = f"""
+    def _chat_prompt(self, text):
+        return f"""
         你是一個友善的AI助手，請用自然、友好的方式回應用戶的對話。
         請用繁體中文回覆。
         用戶說：{text}
         """
+
+    def chat_with_gemini(self, text):
+        """與 Claude 聊天"""
+        prompt = self._chat_prompt(text)
         # print("\n=== 聊天提示詞內容 ===")
         # print(prompt)
         # print("=== 提示詞結束 ===\n")
@@ -105,58 +261,38 @@ class CommandClassifier:
         print(f"Claude回應: {result}\n")
         return result
 
-    def save_chat_history(self, command, response, command_type):
-        """保存聊天歷史"""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        chat_data = {"timestamp": timestamp, "command": command, "response": response, "command_type": command_type}
-
-        # ✅ 保存到 data/chat_history
-        save_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'chat_history'))
-        os.makedirs(save_dir, exist_ok=True)
+    def chat_stream(self, text):
+        """與 Claude 聊天（逐段產生回覆文字）"""
+        return self._stream_from_model(self._chat_prompt(text))
 
-        file_path = os.path.join(save_dir, f"chat_{timestamp}.json")
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(chat_data, f, ensure_ascii=False, indent=2)
-
-        #print(f"聊天記錄已保存至: {file_path}\n")
+    def save_chat_history(self, command, response, command_type, extra=None):
+        """保存聊天歷史（extra 可附加處理模式、延遲等欄位）"""
+        # ✅ 交給背景寫入器附加到 data/history/chat.jsonl，不阻塞請求
+        chat_data = new_record(command=command, response=response, command_type=command_type, **(extra or {}))
+        self.history.append('chat', chat_data)
 
     def web_search(self, query):
-        """網路搜尋"""
-        search_api_key = os.getenv('GOOGLE_SEARCH_API_KEY')
-        cx = os.getenv('GOOGLE_SEARCH_CX')
-        url = "https://www.googleapis.com/customsearch/v1"
-        params = {'key': search_api_key, 'cx': cx, 'q': query}
+        """網路搜尋（單一關鍵字；有快取與逾時）"""
+        return self.retriever.search(query)
 
-        try:
-            response = requests.get(url, params=params)
-            results = response.json()
-
-            if 'items' in results:
-                return [{
-                    'title': item['title'],
-                    'snippet': item['snippet'],
-                    'link': item['link']
-                } for item in results['items'][:3]]
-            return []
-        except Exception as e:
-            print(f"搜索出錯: {str(e)}")
-            return []
-
-    def handle_query(self, text):
-        """處理查詢命令"""
-        prompt = f"""
-        你是一個專業的搜索助手。用戶想要查詢一些信息，請幫我生成合適的搜索關鍵詞。
-        用戶查詢：{text}
-        """
+    def retrieve(self, text):
+        """查詢用的搜尋結果：多個關鍵字版本並行搜尋、合併並去除重複摘要"""
+        return self.retriever.retrieve(text)
 
-        # print("\n=== 查詢提示詞內容 ===")
-        # print(prompt)
-        # print("=== 提示詞結束 ===\n")
+    def handle_query(self, text, search_results=None):
+        """處理查詢命令（search_results：已預先搜尋好的結果）"""
+        final_response = self._send_to_model(self._query_prompt(text, search_results))
+        return final_response.strip()
 
-        search_query = text
-        # print(f"生成的搜索關鍵詞: {search_query}")
+    def handle_query_stream(self, text, search_results=None):
+        """處理查詢命令（搜尋完成後逐段產生回答）"""
+        return self._stream_from_model(self._query_prompt(text, search_results))
 
-        search_results = self.web_search(search_query)
+    def _query_prompt(self, text, search_results=None):
+        """搜尋並組出回答用的提示詞"""
+        # 關鍵字版本由 query_variants 在本地產生，不再多等一次模型呼叫
+        if search_results is None:
+            search_results = self.retrieve(text)
 
         results_prompt = f"""
         你是一個資訊助理，請根據以下 Google 搜尋結果，直接用繁體中文回答使用者的問題：
@@ -170,97 +306,82 @@ class CommandClassifier:
         搜尋結果：
         {json.dumps(search_results, ensure_ascii=False, indent=2)}
         """
+        return results_prompt
 
-        final_response = self._send_to_model(results_prompt)
-        return final_response.strip()
-
-    def save_query_history(self, command, response, command_type):
+    def save_query_history(self, command, response, command_type, extra=None):
         """保存查詢歷史"""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        query_data = {"timestamp": timestamp, "command": command, "response": response, "command_type": command_type}
-
-        # ✅ 保存到 data/query_history
-        save_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'query_history'))
-        os.makedirs(save_dir, exist_ok=True)
-
-        file_path = os.path.join(save_dir, f"query_{timestamp}.json")
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(query_data, f, ensure_ascii=False, indent=2)
-
-        #(f"查詢記錄已保存至: {file_path}\n")
+        # ✅ 交給背景寫入器附加到 data/history/query.jsonl，不阻塞請求
+        query_data = new_record(command=command, response=response, command_type=command_type, **(extra or {}))
+        self.history.append('query', query_data)
 
     def handle_movement(self, text):
         """處理行動命令"""
-        # ✅ 載入 assets/movement_deployment.json
-        movement_json_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'assets', 'movement_deployment.json'))
-        with open(movement_json_path, 'r', encoding='utf-8') as f:
-            movement_data = json.load(f)
-
-        prompt = f"""
-        你是一個專業的機器人動作規劃助手。請根據以下系統設定和用戶的任務，生成詳細的動作順序和說明。
-
-        系統可用的動作清單：
-        {json.dumps(movement_data['動作清單'], ensure_ascii=False, indent=2)}
-
-        參考任務範例：
-        {json.dumps(movement_data['任務拆解'], ensure_ascii=False, indent=2)}
-
-        當前用戶任務：{text}
-
-        請按照以下格式返回：
-        {{
-            "動作順序": ["動作代號1", "動作代號2", ...],
-            "說明": [
-                "詳細步驟1",
-                "詳細步驟2",
-                ...
-            ]
-        }}
-
-        請確保：
-        1. 動作順序使用動作清單中的代號
-        2. 說明要詳細且符合實際執行順序
-        3. 回覆必須是有效的JSON格式，並使用```json 包裹
-        """
+        if self.plan_library:
+            with tracing.span("plan_library"):
+                movement_plan = self.plan_library.lookup(text)
+            if movement_plan:
+                return movement_plan
+
+        prefix, prompt = self.prompts.build_movement(text)
 
         # print("\n=== 行動規劃提示詞內容 ===")
-        # print(prompt)
+        # print(prefix + prompt)
         # print("=== 提示詞結束 ===\n")
 
-        result = self._send_to_model(prompt).strip()
+        result = self._send_to_model(prompt, prefix).strip()
         #print(f"Claude回應: {result}\n")
 
         try:
-            if "```json" in result:
-                json_str = result.split("```json")[1].split("```")[0].strip()
-            else:
-                json_str = result.strip()
-
-            movement_plan = json.loads(json_str)
+            movement_plan = self._extract_json(result)
 
             if not isinstance(movement_plan, dict) or '動作順序' not in movement_plan or '說明' not in movement_plan:
                 raise ValueError("JSON格式不符合要求")
+            if not self._valid_plan(movement_plan):
+                raise ValueError(f"動作代號不在動作清單中：{movement_plan.get('動作順序')}")
 
+            if self.plan_library:
+                self.plan_library.learn(text, movement_plan)
             return movement_plan
 
         except (json.JSONDecodeError, ValueError) as e:
             print(f"警告：無法解析回應為JSON格式 - {str(e)}")
             return {"動作順序": [], "說明": ["無法生成有效的動作計劃"]}
 
-    def save_movement_history(self, command, response, command_type):
-        """保存行動歷史"""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        movement_data = {"timestamp": timestamp, "command": command, "movement_plan": response, "command_type": command_type}
+    def _valid_plan(self, movement_plan):
+        """動作計劃的格式正確，且動作代號都來自 movement_deployment.json 的動作清單"""
+        return validate_plan(movement_plan, self.prompts.movement_data()['動作清單'])
 
-        # ✅ 保存到 data/movement_history
-        save_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'movement_history'))
-        os.makedirs(save_dir, exist_ok=True)
+    def save_movement_history(self, command, response, command_type, extra=None):
+        """保存行動歷史"""
+        # ✅ 交給背景寫入器附加到 data/history/movement.jsonl，不阻塞請求
+        movement_data = new_record(command=command, movement_plan=response, command_type=command_type, **(extra or {}))
+        self.history.append('movement', movement_data)
 
-        file_path = os.path.join(save_dir, f"movement_{timestamp}.json")
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(movement_data, f, ensure_ascii=False, indent=2)
+    def save_turn_history(self, command, response, command_type, extra=None):
+        """依類型保存一輪對話；回覆快取未命中的結果順便寫入快取
 
-        #print(f"行動計劃已保存至: {file_path}\n")
+        播放被中止（extra["cancelled"]）或回覆含模型錯誤訊息（例如串流到一半失敗）時不寫入快取。
+        """
+        extra = extra or {}
+        failed = isinstance(response, str) and "無法獲取模型回應" in response
+        if extra.get("cache") == "miss" and not extra.get("cancelled") and not failed:
+            self.response_cache.store(command, command_type, response)
+        if command_type == '聊天':
+            self.save_chat_history(command, response, command_type, extra)
+        elif command_type == '查詢':
+            self.save_query_history(command, response, command_type, extra)
+        elif command_type == '行動':
+            self.save_movement_history(command, response, command_type, extra)
+
+    @staticmethod
+    def format_response(command_type, response):
+        """把回覆轉成要朗讀的文字；行動計劃逐行念出「代號，說明」"""
+        if command_type == "行動" and isinstance(response, dict) and "說明" in response and "動作順序" in response:
+            combined = [f"{code}，{desc}" for code, desc in zip(response["動作順序"], response["說明"])]
+            return "\n".join(combined)
+        if isinstance(response, str):
+            return response
+        return "⚠️ 無法識別命令"
 
 if __name__ == "__main__":
     classifier = CommandClassifier()
@@ -0,0 +1,73 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+
+
+class EventChannel:
+    """狀態推播頻道：每個事件帶遞增序號，保留最近 replay_size 筆供斷線重連時補送
+
+    publish() 可在任何執行緒呼叫；訂閱者以 Last-Event-ID（最後收到的序號）取回之後的事件，
+    不會像輪詢 /audio_status 那樣因為別的用戶端先讀走而漏掉回覆。
+    """
+
+    def __init__(self, replay_size=None):
+        self.replay_size = replay_size or int(os.getenv('EVENT_REPLAY_SIZE', '256'))
+        self.seq = 0
+        self._events = deque(maxlen=self.replay_size)
+        self._listeners = set()
+        self._cond = threading.Condition()
+
+    def publish(self, event_type, **data):
+        with self._cond:
+            self.seq += 1
+            event = {"seq": self.seq, "type": event_type, "time": time.time(), "data": data}
+            self._events.append(event)
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+        return event
+
+    def resume_point(self, last_seq):
+        """重連時帶來的序號比目前還大（伺服器重啟、序號從頭計算）時視為新連線，回傳 0"""
+        with self._cond:
+            return 0 if last_seq > self.seq else last_seq
+
+    def since(self, last_seq):
+        """回傳序號大於 last_seq 的事件；太舊的已被淘汰時，從緩衝區最舊的一筆開始"""
+        with self._cond:
+            return [event for event in self._events if event["seq"] > last_seq]
+
+    def wait(self, last_seq, timeout=None):
+        """阻塞直到有新事件或逾時（供執行緒式伺服器使用）"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.seq > last_seq, timeout)
+        return self.since(last_seq)
+
+    def add_listener(self, callback):
+        """註冊「有新事件」的通知函式（供 asyncio 伺服器喚醒協程，callback 不應阻塞）"""
+        with self._cond:
+            self._listeners.add(callback)
+
+    def remove_listener(self, callback):
+        with self._cond:
+            self._listeners.discard(callback)
+
+
+def parse_last_event_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def format_sse(event):
+    """轉成 text/event-stream 格式；id 讓瀏覽器的 EventSource 斷線重連時自動帶上 Last-Event-ID"""
+    payload = json.dumps({"seq": event["seq"], **event["data"]}, ensure_ascii=False)
+    return f"id: {event['seq']}\nevent: {event['type']}\ndata: {payload}\n\n"
+
+
+# 定期送出的註解行，避免代理伺服器因閒置而切斷連線
+HEARTBEAT = ": keep-alive\n\n"
@@ -0,0 +1,381 @@
+import os
+import io
+import sys
+import json
+import glob
+import time
+import hashlib
+import random
+import threading
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from scipy.io import wavfile
+
+from history_store import HISTORY_DIR, read_records
+from vad import reference_end
+from intent_classifier import normalize_text, char_ngrams
+
+# ✅ 錄音語料庫（專案根目錄 data/audio）與對應的歷史轉寫結果
+CORPUS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'audio'))
+TRANSCRIPT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'transcripts'))
+
+FINGERPRINT_SAMPLES = 256
+# VAD 起點（與 ASR 上傳前的靜音裁切）以 10 ms 為單位對齊，索引每個 10 ms 位置的指紋
+FINGERPRINT_STEP = 160
+# 假 Whisper 每秒音訊額外的推論時間（秒）：裁掉靜音後推論時間跟著減少
+ASR_SECONDS_PER_AUDIO_SECOND = 0.05
+
+
+def _fingerprint(pcm):
+    # 只取樣本正負號：上傳前放大音量不影響比對
+    return hashlib.sha1(np.sign(pcm[:FINGERPRINT_SAMPLES]).astype(np.int8).tobytes()).hexdigest()
+
+
+def decode_audio(body, content_type='audio/wav'):
+    """解碼上傳的音訊，回傳 (int16 PCM, 取樣率)；FLAC／Opus 需要 soundfile"""
+    if content_type in ('audio/wav', 'audio/x-wav'):
+        sample_rate, pcm = wavfile.read(io.BytesIO(body))
+        return pcm.reshape(-1), sample_rate
+    import soundfile
+    pcm, sample_rate = soundfile.read(io.BytesIO(body), dtype='int16')
+    return pcm.reshape(-1), sample_rate
+
+
+def load_corpus(corpus_dir=CORPUS_DIR, transcript_dir=TRANSCRIPT_DIR):
+    """讀取 WAV 語料與歷史轉寫，回傳 {檔名: (取樣率, PCM, 文字)}"""
+    transcripts = {}
+    for path in glob.glob(os.path.join(transcript_dir, '*.json')):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        transcripts[data.get('audio_file')] = data.get('transcript', '')
+    for data in read_records('transcript', HISTORY_DIR):
+        transcripts.setdefault(data.get('audio_file'), data.get('transcript', ''))
+
+    corpus = {}
+    for path in sorted(glob.glob(os.path.join(corpus_dir, '*.wav'))):
+        name = os.path.basename(path)
+        sample_rate, pcm = wavfile.read(path)
+        corpus[name] = (sample_rate, pcm.reshape(-1), transcripts.get(name, ''))
+    return corpus
+
+
+class _Body:
+    """模擬 botocore StreamingBody"""
+
+    def __init__(self, payload):
+        self._buffer = io.BytesIO(payload)
+
+    def read(self, *args):
+        return self._buffer.read(*args)
+
+
+class FakeSageMakerRuntime:
+    """本地假 Whisper 端點：依音訊指紋找回語料檔，回傳該檔的歷史轉寫
+
+    串流時送來的是語句的前半段，依收到的樣本比例回傳前綴文字作為部分結果。
+    latency 為 (平均秒數, 標準差)，加上每秒音訊 per_second 秒，模擬端點推論時間。
+    """
+
+    def __init__(self, corpus=None, latency=(0.4, 0.1), per_second=ASR_SECONDS_PER_AUDIO_SECOND):
+        self.corpus = corpus if corpus is not None else load_corpus()
+        self.latency = latency
+        self.per_second = per_second
+        self.calls = 0
+        self.bytes_received = 0
+        self._index = {}
+
+        for name, (_, pcm, text) in self.corpus.items():
+            for start in range(0, len(pcm) - FINGERPRINT_SAMPLES + 1, FINGERPRINT_STEP):
+                self._index.setdefault(_fingerprint(pcm[start:]), (name, start))
+            sample_rate = self.corpus[name][0]
+            self.corpus[name] = (sample_rate, pcm, text, reference_end(pcm, sample_rate) or len(pcm))
+
+    def _sleep(self, seconds):
+        mean, std = self.latency
+        time.sleep(max(0.0, random.gauss(mean, std)) + self.per_second * seconds)
+
+    def invoke_endpoint(self, EndpointName, ContentType, Body):
+        self.calls += 1
+        self.bytes_received += len(Body)
+        try:
+            pcm, sample_rate = decode_audio(Body, ContentType)
+        except Exception as e:
+            raise ValueError(f"invalid audio: {e}")
+        self._sleep(len(pcm) / sample_rate)
+
+        text = ""
+        match = self._index.get(_fingerprint(pcm))
+        if match:
+            name, offset = match
+            _, _, full_text, voiced_end = self.corpus[name]
+            ratio = min(1.0, (offset + len(pcm)) / voiced_end)
+            text = full_text[:round(len(full_text) * ratio)]
+
+        payload = json.dumps({"text": [text]}, ensure_ascii=False).encode('utf-8')
+        return {"Body": _Body(payload)}
+
+
+ASSETS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'assets'))
+
+# 各假服務的預設延遲 (平均秒數, 標準差)
+DEFAULT_LATENCY = {
+    'sagemaker': (0.4, 0.1),
+    'bedrock': (0.8, 0.2),
+    'polly': (0.15, 0.05),
+    'google': (0.3, 0.1),
+}
+
+
+def parse_latency(spec, base=None):
+    """解析 "bedrock=0.8:0.2,polly=0.1:0.02" 格式的延遲設定"""
+    latency = dict(base or DEFAULT_LATENCY)
+    for item in (spec or "").split(','):
+        if '=' in item:
+            name, value = item.split('=', 1)
+            mean, _, std = value.partition(':')
+            latency[name.strip()] = (float(mean), float(std or 0))
+    return latency
+
+
+class FakeBedrock:
+    """依提示詞內容判斷是分類、行動規劃、合併模式或一般回答，回傳對應格式的假 Claude 回覆"""
+
+    QUERY_WORDS = ('查', '搜尋', '天氣', '幾點', '哪裡', '附近', '多少')
+    MOVEMENT_WORDS = ('幫我拿', '走到', '拿起', '放下', '倒', '按下', '移動', '去')
+
+    def __init__(self):
+        with open(os.path.join(ASSETS_DIR, 'command_type.json'), 'r', encoding='utf-8') as f:
+            self.labels = {item['command']: item['command_type'] for item in json.load(f)}
+
+    def label(self, text):
+        if text in self.labels:
+            return self.labels[text]
+        if any(word in text for word in self.MOVEMENT_WORDS):
+            return '行動'
+        if any(word in text for word in self.QUERY_WORDS):
+            return '查詢'
+        return '聊天'
+
+    @staticmethod
+    def _user_input(prompt):
+        marker = prompt.rfind('輸入："')
+        if marker >= 0:
+            return prompt[marker + 4:prompt.find('"', marker + 4)]
+        marker = prompt.rfind('當前用戶任務：')
+        if marker >= 0:
+            return prompt[marker + 7:].strip()
+        return ""
+
+    def respond(self, prompt):
+        text = self._user_input(prompt)
+        plan = {"動作順序": ["1", "2", "8"], "說明": ["走到目標位置", "拿起物品", "回報完成"]}
+        if '只回復以下三種類型之一' in prompt:
+            return self.label(text)
+        if '動作規劃助手' in prompt:
+            return "```json\n" + json.dumps(plan, ensure_ascii=False) + "\n```"
+        if '"類型"' in prompt:
+            command_type = self.label(text)
+            reply = {'聊天': f"好的，關於「{text}」我很樂意聊聊。", '查詢': None, '行動': plan}[command_type]
+            return "```json\n" + json.dumps({"類型": command_type, "回覆": reply}, ensure_ascii=False) + "\n```"
+        return "這是離線測試用的回覆，內容長度大約與真實回答相近，方便量測語音合成與播放的時間。"
+
+
+class FakeSearch:
+    """假 Google 自訂搜尋：以 assets 中的查詢範例建立小型文件庫，依字元雙字組重疊排序
+
+    每份文件另有一份轉載版本（不同連結、幾乎相同的摘要），用來驗證搜尋結果去重。
+    """
+
+    def __init__(self):
+        with open(os.path.join(ASSETS_DIR, 'command_type.json'), 'r', encoding='utf-8') as f:
+            queries = [item['command'] for item in json.load(f) if item['command_type'] == '查詢']
+        self.documents = []
+        for i, query in enumerate(queries):
+            snippet = f"{query}：離線測試用的搜尋摘要，長度大約與真實結果相近。"
+            self.documents.append({"title": f"{query}｜生活資訊", "snippet": snippet, "link": f"https://example.com/{i}"})
+            self.documents.append({"title": f"{query}｜轉載", "snippet": f"轉載 {snippet}", "link": f"https://mirror.example.com/{i}"})
+        self._grams = [set(char_ngrams(normalize_text(doc["title"] + doc["snippet"]), (2,))) for doc in self.documents]
+
+    def search(self, query, num=10):
+        grams = set(char_ngrams(normalize_text(query), (2,)))
+        scored = sorted((-len(grams & doc_grams), i) for i, doc_grams in enumerate(self._grams))
+        items = [self.documents[i] for score, i in scored[:num] if score < 0]
+        if not items:
+            items = [{"title": f"結果 {i}", "snippet": f"關於「{query}」的離線測試搜尋摘要 {i}。",
+                      "link": f"https://example.com/search/{i}"} for i in range(1, 4)]
+        return items
+
+
+class FakeServiceServer:
+    """本地 HTTP 假服務：SageMaker（Whisper）、Bedrock（Claude）、Polly 與 Google 自訂搜尋
+
+    以 endpoint_url 指向這裡即可讓真正的 boto3／requests 程式路徑（簽章、連線池、重試）全部照常執行。
+    每個服務的延遲依 latency 中的 (平均, 標準差) 以常態分布抽樣。
+    """
+
+    def __init__(self, latency=None, corpus=None, host='127.0.0.1', port=0):
+        self.latency = latency or dict(DEFAULT_LATENCY)
+        self.sagemaker = FakeSageMakerRuntime(corpus, latency=self.latency['sagemaker'])
+        self.bedrock = FakeBedrock()
+        self.search = FakeSearch()
+        self.requests = {name: 0 for name in self.latency}
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="fake-aws", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def environ(self):
+        """讓 boto3 與 web_search 改連本地假服務的環境變數"""
+        return {
+            'AWS_ENDPOINT_URL_SAGEMAKER_RUNTIME': self.url,
+            'AWS_ENDPOINT_URL_BEDROCK_RUNTIME': self.url,
+            'AWS_ENDPOINT_URL_POLLY': self.url,
+            'GOOGLE_SEARCH_URL': f"{self.url}/customsearch/v1",
+            'AWS_ACCESS_KEY_ID': 'fake',
+            'AWS_SECRET_ACCESS_KEY': 'fake',
+        }
+
+    def _sleep(self, service):
+        with self._lock:
+            self.requests[service] = self.requests.get(service, 0) + 1
+        mean, std = self.latency.get(service, (0.0, 0.0))
+        time.sleep(max(0.0, random.gauss(mean, std)))
+
+    def handle(self, method, path, body, query="", content_type='audio/wav'):
+        """回傳 (狀態碼, Content-Type, 內容位元組)"""
+        if path.startswith('/endpoints/') and path.endswith('/invocations'):
+            with self._lock:
+                self.requests['sagemaker'] += 1
+            try:
+                response = self.sagemaker.invoke_endpoint(path.split('/')[2], content_type, body)
+            except ValueError:
+                return 400, 'application/json', b'{"message": "invalid audio"}'
+            return 200, 'application/json', response["Body"].read()
+
+        if path.startswith('/model/') and path.endswith('/invoke'):
+            self._sleep('bedrock')
+            request = json.loads(body or b'{}')
+            content = request.get("messages", [{}])[0].get("content", "")
+            if isinstance(content, list):
+                content = "".join(block.get("text", "") for block in content)
+            payload = {"content": [{"type": "text", "text": self.bedrock.respond(content)}]}
+            return 200, 'application/json', json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+        if path == '/async-invoke':
+            return 200, 'application/json', b'{"asyncInvokeSummaries": []}'
+
+        if path == '/v1/speech':
+            self._sleep('polly')
+            text = json.loads(body or b'{}').get("Text", "")
+            # 約 24 kbps、每字 0.25 秒的假 mp3 大小
+            return 200, 'audio/mpeg', b'\xff\xf3' * (len(text) * 375)
+
+        if path == '/v1/voices':
+            return 200, 'application/json', b'{"Voices": []}'
+
+        if path == '/customsearch/v1':
+            if method == 'HEAD':
+                return 200, 'application/json', b''
+            self._sleep('google')
+            params = parse_qs(query)
+            items = self.search.search(params.get('q', [''])[0], int(params.get('num', ['10'])[0]))
+            return 200, 'application/json', json.dumps({"items": items}, ensure_ascii=False).encode('utf-8')
+
+        return 404, 'application/json', b'{"message": "not found"}'
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _serve(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                url = urlparse(self.path)
+                status, content_type, payload = server.handle(self.command, url.path, body, url.query,
+                                                              self.headers.get('Content-Type') or 'audio/wav')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(payload)
+
+            do_GET = do_POST = do_HEAD = _serve
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def wav_frames(path, frame_size=4800, realtime=True, trailing_silence=2.0):
+    """把 WAV 檔切成固定長度音框重播，模擬麥克風輸入；結尾補靜音讓端點偵測觸發"""
+    sample_rate, pcm = wavfile.read(path)
+    pcm = pcm.reshape(-1).astype(np.int16)
+    pad = np.zeros(int(sample_rate * trailing_silence), dtype=np.int16)
+    pcm = np.concatenate([pcm, pad])
+    frame_duration = frame_size / sample_rate
+
+    for start in range(0, len(pcm) - frame_size + 1, frame_size):
+        if realtime:
+            time.sleep(frame_duration)
+        yield pcm[start:start + frame_size].reshape(-1, 1)
+
+
+def main():
+    """用假端點重播語料，比較串流模式與寫檔模式的句尾到文字延遲"""
+    from recorder import AudioRecorder
+    from speech_to_text_test import SpeechToText
+
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    runtime = FakeSageMakerRuntime()
+    transcriber = SpeechToText(runtime=runtime)
+    recorder = AudioRecorder()
+
+    frame_size = int(recorder.sample_rate * recorder.make_vad().chunk_duration)
+
+    names = [name for name, item in runtime.corpus.items() if item[2]][:limit]
+    for name in names:
+        path = os.path.join(CORPUS_DIR, name)
+        expected = runtime.corpus[name][2]
+
+        results = {}
+        for mode in ("file", "stream"):
+            marks = {}
+
+            def on_done(value, marks=marks):
+                marks['done'] = time.time()
+                marks['value'] = value
+
+            frames = _timed(wav_frames(path, frame_size), marks)
+            if mode == "file":
+                recorder.listen_forever(on_heard_callback=lambda p: on_done(transcriber.transcribe_file(p)), source=frames)
+            else:
+                recorder.listen_streaming(transcriber, on_transcript=lambda text, _: on_done(text),
+                                          on_partial=lambda text, _: print(f"  … {text}"), source=frames)
+            results[mode] = (marks.get('value'), marks.get('done', 0) - marks['start'])
+
+        print(f"{name}  期望：{expected}")
+        for mode, (value, elapsed) in results.items():
+            print(f"  [{mode:6}] {value}  開始重播後 {elapsed:.2f}s 取得文字")
+
+
+def _timed(frames, marks):
+    """記錄第一個音框送出的時間，作為延遲計算基準"""
+    marks['start'] = time.time()
+    yield from frames
+
+
+if __name__ == "__main__":
+    main()
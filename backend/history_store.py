@@ -0,0 +1,171 @@
+import os
+import sys
+import glob
+import json
+import time
+import uuid
+import queue
+import atexit
+import threading
+from datetime import datetime
+
+# 可用環境變數 HISTORY_DIR 改到其他位置（例如基準測試時寫到暫存資料夾）
+HISTORY_DIR = os.getenv('HISTORY_DIR') or os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'history'))
+
+# 舊版「每輪一個 JSON 檔」的資料夾對應到新的紀錄種類
+LEGACY_DIRS = {
+    'chat': 'chat_history',
+    'query': 'query_history',
+    'movement': 'movement_history',
+    'transcript': 'transcripts',
+}
+
+
+def new_record(**fields):
+    """建立帶有唯一 id 與毫秒級時間的紀錄（同一秒內多輪也不會互相覆蓋）"""
+    now = datetime.now()
+    return {
+        "id": uuid.uuid4().hex,
+        "timestamp": now.strftime("%Y%m%d_%H%M%S"),
+        "time": now.isoformat(timespec="milliseconds"),
+        **fields,
+    }
+
+
+class HistoryWriter:
+    """背景批次寫入的歷史紀錄：各種類附加到 data/history/<kind>.jsonl
+
+    append() 只把紀錄放進佇列就返回，請求路徑上沒有任何磁碟 I/O。
+    背景執行緒每次收集最多 batch_size 筆或等待 flush_interval 秒，一次寫入並 fsync（群組提交）；
+    檔案超過 max_bytes 時輪替成 <kind>_<時間>.jsonl。
+    """
+
+    def __init__(self, base_dir=HISTORY_DIR, batch_size=64, flush_interval=0.2, max_bytes=10 * 1024 * 1024):
+        self.base_dir = base_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        os.makedirs(base_dir, exist_ok=True)
+
+        self.written = 0
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+
+    def path_for(self, kind):
+        return os.path.join(self.base_dir, f"{kind}.jsonl")
+
+    def append(self, kind, record):
+        self._queue.put((kind, record))
+
+    def flush(self, timeout=5.0):
+        """等待目前佇列中的紀錄全部寫入（關閉程式或測試時使用）"""
+        done = threading.Event()
+        self._queue.put(("__flush__", done))
+        done.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            waiters = [item for kind, item in batch if kind == "__flush__"]
+            grouped = {}
+            for kind, record in batch:
+                if kind != "__flush__":
+                    grouped.setdefault(kind, []).append(record)
+
+            for kind, records in grouped.items():
+                try:
+                    self._write(kind, records)
+                except OSError as e:
+                    print(f"⚠️ 歷史紀錄寫入失敗（{kind}）：{e}")
+            for done in waiters:
+                done.set()
+
+    def _write(self, kind, records):
+        path = self.path_for(kind)
+        if os.path.exists(path) and os.path.getsize(path) >= self.max_bytes:
+            rotated = os.path.join(self.base_dir, f"{kind}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.jsonl")
+            os.replace(path, rotated)
+
+        lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self.written += len(records)
+        self.batches += 1
+
+
+def read_records(kind, base_dir=HISTORY_DIR):
+    """依時間順序讀出某種類的全部紀錄（含已輪替的檔案）"""
+    paths = sorted(glob.glob(os.path.join(base_dir, f"{kind}_*.jsonl")))
+    current = os.path.join(base_dir, f"{kind}.jsonl")
+    if os.path.exists(current):
+        paths.append(current)
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """行程內共用的單一背景寫入器"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = HistoryWriter(os.getenv('HISTORY_DIR') or HISTORY_DIR)
+            atexit.register(_writer.flush)
+        return _writer
+
+
+def migrate(data_dir=None, base_dir=HISTORY_DIR):
+    """把舊版 data/*_history、data/transcripts 下的單檔 JSON 匯入 JSONL（可重複執行，已匯入者略過）"""
+    data_dir = data_dir or os.path.dirname(base_dir)
+    writer = HistoryWriter(base_dir)
+    for kind, folder in LEGACY_DIRS.items():
+        imported = {record.get("source") for record in read_records(kind, base_dir)}
+        records = []
+        for path in glob.glob(os.path.join(data_dir, folder, '*.json')):
+            source = f"{folder}/{os.path.basename(path)}"
+            if source in imported:
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                print(f"⚠️ 略過無法讀取的檔案 {path}：{e}")
+                continue
+            records.append({"id": uuid.uuid4().hex, **data, "source": source})
+
+        records.sort(key=lambda record: str(record.get("timestamp", "")))
+        for record in records:
+            writer.append(kind, record)
+        print(f"📦 {kind}: 匯入 {len(records)} 筆")
+    writer.flush()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        migrate()
+    else:
+        print("用法: python history_store.py migrate")
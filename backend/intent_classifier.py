@@ -0,0 +1,218 @@
+import os
+import re
+import glob
+import json
+import math
+import time
+import threading
+from collections import Counter
+from history_store import LEGACY_DIRS, read_records
+import startup
+
+# 第一次轉換時才載入 OpenCC 字典
+converter = startup.component("intent_classifier.converter", "opencc", "OpenCC", "s2tw")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+HISTORY_KINDS = ('chat', 'query', 'movement')
+
+# 去除標點、空白與表情符號，只留中英數字
+_PUNCT_RE = re.compile(r"[^\w]|_", re.UNICODE)
+
+
+def normalize_text(text):
+    """簡轉繁、去標點、轉小寫，作為比對用的標準化文字"""
+    return _PUNCT_RE.sub("", converter.convert(text or "")).lower()
+
+
+def char_ngrams(text, n_values=(1, 2, 3)):
+    """字元 n-gram 計數（text 應已標準化）"""
+    grams = Counter()
+    for n in n_values:
+        for i in range(len(text) - n + 1):
+            grams[text[i:i + n]] += 1
+    return grams
+
+
+def load_examples(base_dir=BASE_DIR):
+    """從 assets/command_type.json、data/history/*.jsonl 與舊版 data/*_history 收集 (命令, 類型) 範例"""
+    examples = []
+    with open(os.path.join(base_dir, 'assets', 'command_type.json'), 'r', encoding='utf-8') as f:
+        for item in json.load(f):
+            examples.append((item['command'], item['command_type']))
+
+    imported = set()
+    for kind in HISTORY_KINDS:
+        for record in read_records(kind, os.path.join(base_dir, 'data', 'history')):
+            imported.add(record.get('source'))
+            if record.get('command') and record.get('command_type'):
+                examples.append((record['command'], record['command_type']))
+
+    for kind in HISTORY_KINDS:
+        folder = LEGACY_DIRS[kind]
+        for path in glob.glob(os.path.join(base_dir, 'data', folder, '*.json')):
+            if f"{folder}/{os.path.basename(path)}" in imported:
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    record = json.load(f)
+                if record.get('command') and record.get('command_type'):
+                    examples.append((record['command'], record['command_type']))
+            except (json.JSONDecodeError, OSError):
+                continue
+    return examples
+
+
+def dedupe_examples(examples):
+    """依標準化文字去除重複的命令，保留第一筆（資產檔的範例排在最前面，優先保留）"""
+    unique, seen = [], set()
+    for command, label in examples:
+        key = normalize_text(command)
+        if key not in seen:
+            seen.add(key)
+            unique.append((command, label))
+    return unique
+
+
+class LocalIntentClassifier:
+    """字元 n-gram TF-IDF + 加權 kNN 的本地分類器，作為 Bedrock 分類前的第一層
+
+    predict() 回傳 (類型, 信心值)；信心值為得票最高類型占前 k 名相似度總和的比例，
+    再乘上最近鄰的相似度，避免與所有範例都不像的輸入被誤判為高信心。
+    低於 min_confidence 時由呼叫端交給 LLM。
+    """
+
+    def __init__(self, examples, k=5, min_confidence=0.5):
+        self.k = k
+        self.min_confidence = min_confidence
+        self.total = 0
+        self.local_hits = 0
+        self.total_local_time = 0.0
+        self._lock = threading.Lock()
+        self._fit(examples)
+
+    @classmethod
+    def from_assets(cls, base_dir=BASE_DIR):
+        return cls(
+            load_examples(base_dir),
+            k=int(os.getenv('LOCAL_CLASSIFIER_K', '5')),
+            min_confidence=float(os.getenv('LOCAL_CLASSIFIER_MIN_CONFIDENCE', '0.5')),
+        )
+
+    def _fit(self, examples):
+        seen = set()
+        docs = []
+        for command, label in examples:
+            key = normalize_text(command)
+            if key and (key, label) not in seen:
+                seen.add((key, label))
+                docs.append((char_ngrams(key), label))
+
+        df = Counter()
+        for grams, _ in docs:
+            df.update(grams.keys())
+        n_docs = len(docs) or 1
+        self._idf = {g: math.log((1 + n_docs) / (1 + c)) + 1 for g, c in df.items()}
+        self._default_idf = math.log(1 + n_docs) + 1
+
+        # 倒排索引：n-gram -> [(範例編號, 權重)]，查詢只需掃過共享 n-gram 的範例
+        self._labels = []
+        self._index = {}
+        for doc_id, (grams, label) in enumerate(docs):
+            vector = self._vectorize(grams)
+            self._labels.append(label)
+            for g, w in vector.items():
+                self._index.setdefault(g, []).append((doc_id, w))
+        self._seen = seen
+
+    def _vectorize(self, grams):
+        vector = {g: c * self._idf.get(g, self._default_idf) for g, c in grams.items()}
+        norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+        return {g: w / norm for g, w in vector.items()}
+
+    def predict(self, text):
+        """回傳 (類型, 信心值)；無法判斷時類型為 None"""
+        start = time.perf_counter()
+        scores = Counter()
+        for g, w in self._vectorize(char_ngrams(normalize_text(text))).items():
+            for doc_id, dw in self._index.get(g, ()):
+                scores[doc_id] += w * dw
+
+        label, confidence = None, 0.0
+        neighbours = scores.most_common(self.k)
+        if neighbours:
+            votes = Counter()
+            for doc_id, sim in neighbours:
+                votes[self._labels[doc_id]] += sim
+            label, weight = votes.most_common(1)[0]
+            confidence = (weight / sum(votes.values())) * neighbours[0][1]
+
+        with self._lock:
+            self.total_local_time += time.perf_counter() - start
+        return label, round(confidence, 4)
+
+    def classify(self, text):
+        """高信心時回傳類型，否則回傳 None（需升級給 LLM），並累計統計"""
+        label, confidence = self.predict(text)
+        confident = label is not None and confidence >= self.min_confidence
+        with self._lock:
+            self.total += 1
+            self.local_hits += int(confident)
+        print(f"本地分類: {label}（信心 {confidence}）{'' if confident else '→ 交給 LLM'}")
+        return label if confident else None
+
+    def learn(self, text, label):
+        """把 LLM 判定的結果加入範例，之後相似的輸入可直接在本地判斷"""
+        key = normalize_text(text)
+        if not key or (key, label) in self._seen:
+            return
+        vector = self._vectorize(char_ngrams(key))
+        with self._lock:
+            doc_id = len(self._labels)
+            self._labels.append(label)
+            for g, w in vector.items():
+                self._index.setdefault(g, []).append((doc_id, w))
+            self._seen.add((key, label))
+
+    def get_stats(self):
+        with self._lock:
+            escalated = self.total - self.local_hits
+            return {
+                "min_confidence": self.min_confidence,
+                "total": self.total,
+                "local_hits": self.local_hits,
+                "escalated": escalated,
+                "escalation_rate": round(escalated / self.total, 3) if self.total else 0.0,
+                "avg_local_ms": round(self.total_local_time / self.total * 1000, 3) if self.total else 0.0,
+                "examples": len(self._labels),
+            }
+
+
+def main():
+    """留一法評估：每筆範例以其餘範例訓練，報告準確率、升級率與平均耗時
+
+    先去除重複的命令（見 dedupe_examples），否則同一句的副本留在訓練集裡會高估準確率。
+    """
+    examples = dedupe_examples(load_examples())
+    threshold = float(os.getenv('LOCAL_CLASSIFIER_MIN_CONFIDENCE', '0.5'))
+    correct = confident = confident_correct = 0
+    elapsed = 0.0
+    for i, (command, label) in enumerate(examples):
+        model = LocalIntentClassifier(examples[:i] + examples[i + 1:], min_confidence=threshold)
+        start = time.perf_counter()
+        predicted, score = model.predict(command)
+        elapsed += time.perf_counter() - start
+        correct += int(predicted == label)
+        if score >= threshold:
+            confident += 1
+            confident_correct += int(predicted == label)
+
+    n = len(examples) or 1
+    print(f"範例數: {len(examples)}")
+    print(f"整體準確率: {correct / n:.3f}")
+    print(f"本地處理比例: {confident / n:.3f}（升級率 {1 - confident / n:.3f}）")
+    print(f"本地處理準確率: {confident_correct / (confident or 1):.3f}")
+    print(f"平均耗時: {elapsed / n * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import time
+import queue
+import threading
+from collections import deque
+
+
+class Stage:
+    """管線中的一個處理階段：有界佇列 + 專屬工作執行緒池
+
+    handler(item) 回傳要交給下一階段的物件；回傳 None 表示此輪到此結束。
+    佇列滿時依 drop_policy 處理：
+    - "drop_oldest"：丟掉最舊的一筆，新資料一定進得去（生產者永不阻塞）
+    - "drop_newest"：直接丟掉新資料
+    - "block"：最多等待 put_timeout 秒（背壓），逾時才丟掉新資料；put_timeout=None 時一直等到有空位
+    """
+
+    def __init__(self, name, handler, workers=1, maxsize=4, drop_policy="drop_oldest", put_timeout=0.5):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.drop_policy = drop_policy
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.next_stage = None
+        # on_done(item, status)：一筆資料離開管線時呼叫，status 為 done / error / dropped
+        self.on_done = None
+
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self._latencies = deque(maxlen=200)
+        self._waits = deque(maxlen=200)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._running = False
+
+    def put(self, item):
+        """送入一筆資料；回傳是否成功進入佇列"""
+        entry = (time.time(), item)
+        try:
+            if self.drop_policy == "block":
+                self.queue.put(entry, timeout=self.put_timeout)
+            else:
+                self.queue.put_nowait(entry)
+            return True
+        except queue.Full:
+            pass
+
+        if self.drop_policy == "drop_oldest":
+            # 每筆被丟掉的資料只計一次：被擠掉的最舊一筆，以及（重試仍失敗時）新的這一筆
+            try:
+                _, oldest = self.queue.get_nowait()
+                self.queue.task_done()
+                self._count_drop()
+                self._done(oldest, "dropped")
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(entry)
+                return True
+            except queue.Full:
+                pass
+
+        self._count_drop()
+        self._done(item, "dropped")
+        return False
+
+    def _done(self, item, status):
+        if self.on_done and item is not None:
+            try:
+                self.on_done(item, status)
+            except Exception as e:
+                print(f"⚠️ [{self.name}] on_done 錯誤: {str(e)}")
+
+    def _count_drop(self):
+        with self._lock:
+            self.dropped += 1
+        print(f"⚠️ [{self.name}] 佇列已滿，丟棄一筆資料")
+
+    def start(self):
+        self._running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """停止工作執行緒；不會阻塞（佇列滿或工作執行緒卡在處理中也一樣）
+
+        佇列中尚未處理的資料以 dropped 回報；工作執行緒由停止訊號或 get 逾時喚醒後結束。
+        """
+        self._running = False
+        while True:
+            try:
+                _, item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.queue.task_done()
+            self._done(item, "dropped")
+        for _ in self._threads:
+            try:
+                self.queue.put_nowait((time.time(), None))
+            except queue.Full:
+                break
+        self._threads = []
+
+    def _work(self, poll_interval=0.2):
+        while self._running:
+            try:
+                enqueued_at, item = self.queue.get(timeout=poll_interval)
+            except queue.Empty:
+                continue
+            if item is None:
+                self.queue.task_done()
+                break
+
+            started = time.time()
+            status = "done"
+            try:
+                result = self.handler(item)
+            except Exception as e:
+                result = None
+                status = "error"
+                with self._lock:
+                    self.errors += 1
+                print(f"❌ [{self.name}] 處理錯誤: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+            with self._lock:
+                self.processed += 1
+                self._waits.append(started - enqueued_at)
+                self._latencies.append(time.time() - started)
+
+            if result is not None and self.next_stage:
+                self.next_stage.put(result)
+            else:
+                self._done(item if result is None else result, status)
+
+    def stats(self):
+        """回傳佇列深度與處理延遲（秒）"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            waits = sorted(self._waits)
+            return {
+                "stage": self.name,
+                "workers": self.workers,
+                "depth": self.queue.qsize(),
+                "maxsize": self.queue.maxsize,
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "latency_p50": _percentile(latencies, 0.5),
+                "latency_p95": _percentile(latencies, 0.95),
+                "wait_p50": _percentile(waits, 0.5),
+                "wait_p95": _percentile(waits, 0.95),
+            }
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    return round(values[min(len(values) - 1, int(q * len(values)))], 4)
+
+
+class Pipeline:
+    """把多個 Stage 串成一條管線，前一階段的輸出自動送往下一階段"""
+
+    def __init__(self, stages, on_complete=None):
+        self.stages = stages
+        for current, following in zip(stages, stages[1:]):
+            current.next_stage = following
+        for stage in stages:
+            stage.on_done = on_complete
+
+    def submit(self, item):
+        return self.stages[0].put(item)
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages]
@@ -0,0 +1,318 @@
+import os
+import re
+import glob
+import json
+import time
+import threading
+from history_store import LEGACY_DIRS, read_records
+from intent_classifier import BASE_DIR, normalize_text
+
+# 固定的地點與對象，不當成槽位（「送來給我」的「我」就是使用者位置）
+FIXED_PLACES = {'原點', '使用者', '用戶', '當前位置', '目前位置', '充電站', '我', '你'}
+
+# 比對前去掉客套的開頭結尾與指示詞，「請幫我把這個便當…」「把那個便當…好嗎」視為同一種說法
+_FILLER_RE = re.compile(r"^(?:請|麻煩你?|可以|能不能|你)*(?:幫我|幫忙|替我|我(?=[把從]))?")
+_TAIL_RE = re.compile(r"(?:好嗎|好不好|謝謝|一下)+$")
+_DEMONSTRATIVE_RE = re.compile(r"在?[這那](?:邊的|裡的|個|張|份|些|盒|本|瓶|位)")
+# 辨識結果中重複的片語（「拿到拿到」）只留一次
+_REPEAT_RE = re.compile(r"(.{2,4}?)\1+")
+
+# 各動作代號的說明中，A／B 參數所在的位置（代號 8 是自由文字，只做字串替換）
+STEP_ARGS = {
+    "1": re.compile(r"從(?P<from>.+?)走[到道](?P<to>.+)$"),
+    "2": re.compile(r"拿起(?P<object>.+)$"),
+    "3": re.compile(r"放下(?P<object>.+)$"),
+    "4": re.compile(r"倒(?P<object>.+?)(?:到|進)"),
+}
+_ARG_SUFFIX_RE = re.compile(r"(?:的)?(?:位置|旁邊|邊|旁|上)$")
+
+# 有槽位的範本至少要有幾個固定字，且固定字中要有動詞，避免「{object}」「{object}上」這種什麼都對得上的範本
+MIN_LITERAL_CHARS = 2
+MAX_SLOT_CHARS = 8
+_VERB_RE = re.compile(r"[拿送帶放倒走去回按給搬遞取裝收]")
+
+# 模型聽不懂時的回覆（只有說話、或說明中道歉）不是可以重複使用的計劃
+_FAILURE_RE = re.compile(r"無法|抱歉|不明白|不理解|聽不懂|請重新")
+_CJK_RE = re.compile(r"[\u4e00-\u9fff]")
+
+# 範本至少要有幾個計劃得出相同的動作順序才會套用（留一法下仍能重現）；任務拆解的範例直接視為可信
+MIN_SUPPORT = 2
+
+
+def task_key(text):
+    """任務的標準化文字：簡轉繁、去標點，再去掉客套語、指示詞與重複的片語"""
+    key = _FILLER_RE.sub("", normalize_text(text), count=1)
+    return _REPEAT_RE.sub(r"\1", _TAIL_RE.sub("", _DEMONSTRATIVE_RE.sub("", key)))
+
+
+def validate_plan(plan, actions):
+    """動作計劃格式正確、至少一個動作，且每個代號都在動作清單中"""
+    if not isinstance(plan, dict) or not isinstance(plan.get('動作順序'), list) or not isinstance(plan.get('說明'), list):
+        return False
+    codes = plan['動作順序']
+    return bool(codes) and all(str(code) in actions for code in codes)
+
+
+def is_learnable(text, plan):
+    """過濾掉不該學的計劃：只有代號 8（說話）、說明含失敗或道歉文字、任務沒有中文（多半是 Whisper 的誤辨識，如「off」「we go」）
+
+    套用範本產生的計劃（帶有 "範本" 欄位，也會寫進行動歷史）不是新的佐證，同樣不學。
+    """
+    if "範本" in plan:
+        return False
+    codes = [str(code) for code in plan['動作順序']]
+    if all(code == "8" for code in codes):
+        return False
+    if any(_FAILURE_RE.search(normalize_text(str(step))) for step in plan['說明']):
+        return False
+    return bool(_CJK_RE.search(normalize_text(text)))
+
+
+def build_template(text, plan):
+    """從一個成功的計劃學出範本；說明中的動作參數若也出現在任務裡就變成槽位。無法對齊時回傳 None"""
+    key = task_key(text)
+    codes, steps = [str(code) for code in plan['動作順序']], plan['說明']
+    if not key or len(codes) != len(steps) or not all(isinstance(step, str) for step in steps):
+        return None
+
+    # 先找出說明中各動作的參數：(步驟編號, 參數種類, 開始位置, 值, 是否已拿起東西)
+    args = []
+    picked = False
+    for i, (code, step) in enumerate(zip(codes, steps)):
+        match = STEP_ARGS.get(code) and STEP_ARGS[code].search(step)
+        if match:
+            for group, raw in match.groupdict().items():
+                value = _ARG_SUFFIX_RE.sub("", raw)
+                if value and value not in FIXED_PLACES and key.count(value) == 1:
+                    args.append((i, group, match.start(group), value, picked))
+        picked = picked or code == "2"
+    # 同一個值在說明中既是物品又是走路的起訖點（「走到{object}位置」）時角色不明，保留為固定字
+    kinds = {}
+    for _, group, _, value, _ in args:
+        kinds.setdefault(value, set()).add(group == 'object')
+    args = [arg for arg in args if len(kinds[arg[3]]) == 1]
+
+    # 拿起／放下的參數一定是物品；其餘地點依出現順序：拿起東西前走去的是來源，之後的是目的地（前面是「給」時為對象）
+    roles = {}      # 槽位值 -> 角色（object 物品、source 來源、destination 目的地、recipient 對象）
+    for _, group, _, value, picked in sorted(args, key=lambda arg: arg[1] != 'object'):
+        if value in roles:
+            continue
+        if group == 'object':
+            role = 'object'
+        elif group == 'from' or not picked:
+            role = 'source'
+        elif key[key.find(value) - 1:key.find(value)] == '給':
+            role = 'recipient'
+        else:
+            role = 'destination'
+        # 同一個角色只對應一個值，其餘保留為固定字
+        if role not in roles.values():
+            roles[value] = role
+    spans = [(i, start, start + len(value), value) for i, _, start, value, _ in args if value in roles]
+
+    # 槽位在任務中不可重疊，且彼此之間至少隔一個固定字
+    accepted, taken = {}, []
+    for value in sorted({span[3] for span in spans}, key=len, reverse=True):
+        start = key.find(value)
+        if all(start + len(value) < s or e < start for s, e in taken):
+            accepted[value] = roles[value]
+            taken.append((start, start + len(value)))
+    literal = key
+    for start, end in sorted(taken, reverse=True):
+        literal = literal[:start] + literal[end:]
+    if accepted and (len(literal) < MIN_LITERAL_CHARS or not _VERB_RE.search(literal)):
+        accepted, taken, literal = {}, [], key
+
+    pattern, position = "^", 0
+    for start, end in sorted(taken):
+        pattern += re.escape(key[position:start]) + f"(?P<{accepted[key[start:end]]}>.+?)"
+        position = end
+    pattern += re.escape(key[position:]) + "$"
+
+    template_steps = list(steps)
+    for i, start, end, value in sorted(spans, reverse=True):
+        if value in accepted:
+            step = template_steps[i]
+            template_steps[i] = step[:start] + "{" + accepted[value] + "}" + step[end:]
+    for i, code in enumerate(codes):
+        if code == "8":
+            for value, role in accepted.items():
+                template_steps[i] = template_steps[i].replace(value, "{" + role + "}")
+
+    signature = re.sub(r"\(\?P<(\w+)>\.\+\?\)", r"{\1}", pattern[1:-1]).replace("\\", "")
+    return {
+        "signature": signature,
+        "regex": re.compile(pattern),
+        "slots": sorted(set(accepted.values())),
+        "literal": len(literal),
+        "codes": codes,
+        "steps": template_steps,
+        "support": 1,
+        "conflict": False,
+    }
+
+
+def load_plans(base_dir=BASE_DIR):
+    """從 data/history/movement.jsonl 與舊版 data/movement_history 收集 (命令, 計劃)，依時間先後"""
+    plans = []
+    imported = set()
+    for record in read_records('movement', os.path.join(base_dir, 'data', 'history')):
+        imported.add(record.get('source'))
+        if record.get('command') and record.get('movement_plan'):
+            plans.append((record['command'], record['movement_plan']))
+
+    folder = LEGACY_DIRS['movement']
+    legacy = []
+    for path in glob.glob(os.path.join(base_dir, 'data', folder, '*.json')):
+        if f"{folder}/{os.path.basename(path)}" in imported:
+            continue
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            continue
+        if record.get('command') and record.get('movement_plan'):
+            legacy.append((str(record.get('timestamp', '')), record['command'], record['movement_plan']))
+    return [(command, plan) for _, command, plan in sorted(legacy)] + plans
+
+
+class PlanLibrary:
+    """行動計劃範本庫：已知類型的任務直接套範本，不必再請 Claude 規劃
+
+    範本來自 movement_deployment.json 的任務拆解、過去的行動歷史與之後每次成功的 LLM 規劃，
+    以標準化的任務文字（物品、來源、目的地、對象換成槽位）為索引。套出的計劃一樣要通過動作清單檢查。
+    計劃會直接交給機器人執行，所以範本要有 MIN_SUPPORT 個計劃得出相同的動作順序才套用；
+    同一簽章出現過不同的動作順序就不再套用，交給 LLM 規劃。
+    """
+
+    def __init__(self, movement_asset, plans=()):
+        self.asset = movement_asset
+        self.lookups = 0
+        self.hits = 0
+        self.learned = 0
+        self.rejected = 0
+        self.total_lookup_time = 0.0
+
+        self._templates = {}     # 簽章 -> 範本（同一簽章以最新的計劃為準）
+        self._ordered = []
+        self._trusted = []
+        self._asset_version = None
+        self._lock = threading.Lock()
+        self._sync_asset()
+        for text, plan in plans:
+            self.learn(text, plan, count=False)
+
+    @classmethod
+    def from_assets(cls, movement_asset, base_dir=BASE_DIR):
+        return cls(movement_asset, load_plans(base_dir))
+
+    def actions(self):
+        return self.asset.get()['動作清單']
+
+    def _sync_asset(self):
+        """動作清單或任務拆解更新時重新載入範例"""
+        data = self.asset.get()
+        if self.asset.version == self._asset_version:
+            return
+        self._asset_version = self.asset.version
+        for example in data.get('任務拆解', []):
+            self.learn(example['任務'], example, count=False, trusted=True)
+
+    def learn(self, text, plan, count=True, trusted=False):
+        """把一個成功的計劃加入範本庫；格式不對、代號不在動作清單中或只是道歉回覆的計劃不收
+
+        trusted=True（人工撰寫的範例）時不必等其他計劃佐證。
+        """
+        if not validate_plan(plan, self.actions()) or not is_learnable(text, plan):
+            return False
+        template = build_template(text, plan)
+        if template is None:
+            return False
+        with self._lock:
+            previous = self._templates.get(template["signature"])
+            if previous is not None:
+                agrees = previous["codes"] == template["codes"]
+                template["support"] = previous["support"] + 1 if agrees else 1
+                template["conflict"] = previous["conflict"] or not agrees
+            if trusted:
+                template["support"] = max(template["support"], MIN_SUPPORT)
+            self._templates[template["signature"]] = template
+            # 固定字越多的範本越具體，比對時優先
+            self._ordered = sorted(self._templates.values(), key=lambda t: (-t["literal"], len(t["slots"])))
+            self._trusted = [t for t in self._ordered if t["support"] >= MIN_SUPPORT and not t["conflict"]]
+            if count:
+                self.learned += 1
+        return True
+
+    def lookup(self, text):
+        """回傳套好槽位的計劃；沒有相符範本時回傳 None（交給 LLM 規劃）"""
+        start = time.perf_counter()
+        self._sync_asset()
+        key = task_key(text)
+        plan = None
+        with self._lock:
+            templates = self._trusted
+        for template in templates:
+            match = template["regex"].match(key)
+            if not match:
+                continue
+            values = match.groupdict()
+            if any(len(value) > MAX_SLOT_CHARS or value in FIXED_PLACES for value in values.values()):
+                continue
+            steps = list(template["steps"])
+            for role, value in values.items():
+                steps = [step.replace("{" + role + "}", value) for step in steps]
+            candidate = {"動作順序": list(template["codes"]), "說明": steps, "範本": template["signature"]}
+            if not validate_plan(candidate, self.actions()):
+                with self._lock:
+                    self.rejected += 1
+                continue
+            plan = candidate
+            print(f"📋 行動計劃套用範本「{template['signature']}」{values or ''}")
+            break
+        with self._lock:
+            self.lookups += 1
+            self.hits += plan is not None
+            self.total_lookup_time += time.perf_counter() - start
+        return plan
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "templates": len(self._templates),
+                "trusted": len(self._trusted),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / self.lookups, 3) if self.lookups else 0.0,
+                "learned": self.learned,
+                "rejected": self.rejected,
+                "avg_lookup_ms": round(self.total_lookup_time / self.lookups * 1000, 3) if self.lookups else 0.0,
+            }
+
+
+def main():
+    """列出目前的範本，並以留一法估計命中率：每筆可學習的歷史計劃用其餘計劃建立的範本庫來查"""
+    from prompt_templates import PromptLibrary
+    asset = PromptLibrary().movement
+    plans = [(text, plan) for text, plan in load_plans()
+             if validate_plan(plan, asset.get()['動作清單']) and is_learnable(text, plan)]
+    library = PlanLibrary(asset, plans)
+    stats = library.get_stats()
+    print(f"範本數: {stats['templates']}（可套用 {stats['trusted']}）")
+    for template in library._ordered:
+        mark = "✅" if template in library._trusted else "  "
+        print(f"{mark} {template['signature']:32} {','.join(template['codes'])}  {' / '.join(template['steps'])}")
+
+    hits = same = 0
+    for i, (text, plan) in enumerate(plans):
+        model = PlanLibrary(asset, plans[:i] + plans[i + 1:])
+        predicted = model.lookup(text)
+        if predicted:
+            hits += 1
+            same += predicted["動作順序"] == [str(code) for code in plan.get("動作順序", [])]
+    n = len(plans) or 1
+    print(f"可學習的歷史計劃: {len(plans)}，範本命中: {hits / n:.3f}，命中者動作順序相同: {same / (hits or 1):.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import threading
+
+ASSETS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'assets'))
+
+
+class AssetFile:
+    """只載入一次的 JSON 資產檔；每隔 check_interval 秒檢查 mtime，有變動才重新載入"""
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.version = 0
+        self._data = None
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        now = time.time()
+        if self._data is not None and now - self._checked_at < self.check_interval:
+            return self._data
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError as e:
+                if self._data is None:
+                    raise
+                print(f"⚠️ 無法讀取資產檔 {self.path}：{e}")
+                return self._data
+            if mtime != self._mtime:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except (json.JSONDecodeError, OSError) as e:
+                    if self._data is None:
+                        raise
+                    # 存到一半或格式錯誤：沿用上一版，記下 mtime 避免每次都重新解析壞掉的檔案
+                    print(f"⚠️ 資產檔 {self.path} 無法解析，沿用上一版：{e}")
+                    self._mtime = mtime
+                    return self._data
+                if self._data is not None:
+                    print(f"🔄 已重新載入 {os.path.basename(self.path)}")
+                self._data, self._mtime = data, mtime
+                self.version += 1
+        return self._data
+
+
+class PromptLibrary:
+    """提示詞組裝層：資產只讀一次，各提示詞的靜態前綴預先組好並快取
+
+    每個 build_* 回傳 (prefix, suffix)：prefix 只跟資產內容有關，可交給 Bedrock 的提示詞快取；
+    suffix 才含使用者輸入。資產檔更新時前綴自動重建。
+    """
+
+    def __init__(self, assets_dir=ASSETS_DIR, check_interval=1.0):
+        self.command_types = AssetFile(os.path.join(assets_dir, 'command_type.json'), check_interval)
+        self.movement = AssetFile(os.path.join(assets_dir, 'movement_deployment.json'), check_interval)
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    def _prefix(self, name, builder, *assets, extra=()):
+        datas = [asset.get() for asset in assets]
+        key = (name, tuple(asset.version for asset in assets), extra)
+        prefix = self._compiled.get(key)
+        if prefix is None:
+            prefix = builder(*datas)
+            with self._lock:
+                self._compiled = {k: v for k, v in self._compiled.items() if k[0] != name or k[2] != extra}
+                self._compiled[key] = prefix
+        return prefix
+
+    @staticmethod
+    def _examples(reference_data):
+        return "\n".join([f"- 輸入：{item['command']}  類型：{item['command_type']}" for item in reference_data])
+
+    def reference_data(self):
+        return self.command_types.get()
+
+    def movement_data(self):
+        return self.movement.get()
+
+    def build_classify(self, text):
+        prefix = self._prefix("classify", lambda reference_data: f"""
+        根据以下示例對命令進行分類。
+        示例：
+        {self._examples(reference_data)}
+        請對以下輸入進行分類，
+        只回復以下三種類型之一：
+        - 聊天
+        - 查詢
+        - 行動
+        """, self.command_types)
+        return prefix, f"""
+        輸入："{text}"
+        """
+
+    def build_movement(self, text):
+        prefix = self._prefix("movement", lambda movement_data: f"""
+        你是一個專業的機器人動作規劃助手。請根據以下系統設定和用戶的任務，生成詳細的動作順序和說明。
+
+        系統可用的動作清單：
+        {json.dumps(movement_data['動作清單'], ensure_ascii=False, indent=2)}
+
+        參考任務範例：
+        {json.dumps(movement_data['任務拆解'], ensure_ascii=False, indent=2)}
+
+        請按照以下格式返回：
+        {{
+            "動作順序": ["動作代號1", "動作代號2", ...],
+            "說明": [
+                "詳細步驟1",
+                "詳細步驟2",
+                ...
+            ]
+        }}
+
+        請確保：
+        1. 動作順序使用動作清單中的代號
+        2. 說明要詳細且符合實際執行順序
+        3. 回覆必須是有效的JSON格式，並使用```json 包裹
+        """, self.movement)
+        return prefix, f"""
+        當前用戶任務：{text}
+        """
+
+    def build_fused(self, text, fused_types):
+        with_movement = '行動' in fused_types
+
+        def builder(reference_data, movement_data):
+            movement_rule = ""
+            if with_movement:
+                movement_rule = f"""
+        3. 若類型為「行動」，"回覆" 請改為動作計劃物件：{{"動作順序": ["動作代號", ...], "說明": ["詳細步驟", ...]}}，
+        動作代號必須來自以下動作清單：
+        {json.dumps(movement_data['動作清單'], ensure_ascii=False)}
+        """
+            return f"""
+        你是一個友善的AI語音助手。請先根據以下示例判斷輸入的類型（聊天、查詢、行動），再直接回覆使用者。
+        示例：
+        {self._examples(reference_data)}
+
+        規則：
+        1. 若類型為「聊天」，"回覆" 請用自然、友好的繁體中文回應。
+        2. 若類型為「查詢」，"回覆" 請填 null（系統會另外搜尋）。
+        {movement_rule}
+        請只回覆有效的JSON，並使用```json 包裹：
+        {{"類型": "聊天|查詢|行動", "回覆": ...}}
+        """
+
+        prefix = self._prefix("fused", builder, self.command_types, self.movement, extra=(with_movement,))
+        return prefix, f"""
+        輸入："{text}"
+        """
@@ -6,58 +6,323 @@ import time
 import os
 from scipy.io.wavfile import write
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from vad import make_vad, START, PAUSE, RESUME, END
+
+class RingBuffer:
+    """預先配置的 int16 環形緩衝區
+
+    內部長度為 2 × capacity，每個樣本同時寫在 i 與 i + capacity，
+    所以任何長度不超過 capacity 的區間都是連續記憶體，可以直接回傳 ndarray 切片（不複製）。
+    切片在之後再寫入 capacity − 長度 個樣本前都有效（見 alive）。
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buffer = np.zeros(capacity * 2, dtype=np.int16)
+        self.position = 0        # 已寫入的總樣本數（絕對位置，reset 後也不倒退，已交出的切片才能判斷是否有效）
+        self._floor = 0
+
+    def reset(self):
+        """捨棄目前的內容（之後的切片不會取到 reset 之前的樣本）"""
+        self._floor = self.position
+
+    @property
+    def oldest(self):
+        """仍保留在緩衝區中最舊樣本的絕對位置"""
+        return max(self._floor, self.position - self.capacity)
+
+    def alive(self, start):
+        """從絕對位置 start 開始的切片內容是否還沒被之後的寫入覆蓋"""
+        return self.position - start <= self.capacity
+
+    def write(self, samples):
+        n = len(samples)
+        if n > self.capacity:
+            samples = samples[-self.capacity:]
+            self.position += n - self.capacity
+            n = self.capacity
+        start = self.position % self.capacity
+        first = min(n, self.capacity - start)
+        for offset in (0, self.capacity):
+            self._buffer[offset + start:offset + start + first] = samples[:first]
+            if first < n:
+                self._buffer[offset:offset + n - first] = samples[first:]
+        self.position += n
+
+    def view(self, start, end):
+        """回傳絕對位置 [start, end) 的零複製切片"""
+        start = max(start, self.oldest)
+        end = max(start, min(end, self.position))
+        offset = start % self.capacity
+        return self._buffer[offset:offset + (end - start)]
+
+
+class RingSlice:
+    """交給其他執行緒的整句音訊：data 為環形緩衝區的零複製切片，valid() 確認內容尚未被之後的錄音覆蓋
+
+    切句保證一句不超過半個緩衝區，句尾之後至少還有半個緩衝區長度（預設 30 秒）的錄音時間可以使用；
+    使用端在讀取前後各確認一次 valid()，期間被覆蓋就放棄這句，不必為每句配置副本。
+    """
+
+    def __init__(self, ring, start, end):
+        self.ring = ring
+        self.start = start
+        self.data = ring.view(start, end)
+
+    def __len__(self):
+        return len(self.data)
+
+    def valid(self):
+        return self.ring.alive(self.start)
+
+
+class UtteranceSegmenter:
+    """推送式語句切分：push(音訊) 回傳這段音訊產生的事件列表（格式同 AudioRecorder.utterance_events）
+
+    輸入可以是任意長度，內部會重新切成 VAD 的讀取區塊長度。
+    語句超過緩衝區一半長度時強制切句，確保交出的切片在之後至少半個緩衝區的時間內有效；
+    每次 "end" 事件時 last_utterance 為這句的 RingSlice，要交給其他執行緒時用它代替事件中的切片。
+    """
+
+    def __init__(self, vad, sample_rate=16000, pre_roll=0.3, ring_seconds=60, ring=None):
+        self.vad = vad
+        self.sample_rate = sample_rate
+        self.frame_size = int(sample_rate * vad.chunk_duration)
+        self.pre_roll = int(sample_rate * pre_roll)
+        self.ring = ring if ring is not None else RingBuffer(int(sample_rate * ring_seconds))
+        self.ring.reset()
+        # VAD 的位置從 0 起算，加上 origin 才是環形緩衝區的絕對位置
+        self.origin = self.ring.position
+        self.max_length = self.ring.capacity // 2
+        self.start_pos = None
+        self.last_utterance = None
+        # 最近一句的句尾判定延遲（秒）：句尾位置到 VAD 確定句尾時已讀入的音訊長度
+        self.last_endpoint_delay = 0.0
+        self._pending = np.zeros(0, dtype=np.int16)
+
+    @property
+    def in_utterance(self):
+        return self.start_pos is not None
+
+    def push(self, samples):
+        samples = samples.reshape(-1)
+        if len(self._pending) == 0 and len(samples) == self.frame_size:
+            return self._process(samples)
+        samples = np.concatenate([self._pending, samples]) if len(self._pending) else samples
+        events = []
+        count = len(samples) // self.frame_size
+        for i in range(count):
+            events += self._process(samples[i * self.frame_size:(i + 1) * self.frame_size])
+        self._pending = samples[count * self.frame_size:].copy()
+        return events
+
+    def _process(self, frame):
+        ring = self.ring
+        ring.write(frame)
+        out = []
+
+        if self.start_pos is not None:
+            out.append(("audio", frame))
+            if ring.position - self.start_pos >= self.max_length:
+                self.last_utterance = RingSlice(ring, self.start_pos, ring.position)
+                out.append(("end", self.last_utterance.data))
+                self.start_pos = ring.position
+                out.append(("start", ring.view(self.start_pos, self.start_pos)))
+
+        for event, position in self.vad.process(frame):
+            position += self.origin
+            if event == START and self.start_pos is None:
+                self.start_pos = max(position - self.pre_roll, ring.oldest)
+                out.append(("start", ring.view(self.start_pos, ring.position)))
+            elif event == PAUSE and self.start_pos is not None:
+                out.append(("pause", None))
+            elif event == RESUME and self.start_pos is not None:
+                out.append(("resume", None))
+            elif event == END and self.start_pos is not None:
+                end_pos = min(max(position, self.start_pos), ring.position)
+                self.last_utterance = RingSlice(ring, self.start_pos, end_pos)
+                self.last_endpoint_delay = (ring.position - end_pos) / self.sample_rate
+                self.start_pos = None
+                out.append(("end", self.last_utterance.data))
+        return out
+
 
 class AudioRecorder:
-    def __init__(self, sample_rate=16000, channels=1, silence_threshold=70000, silence_duration=1.5):
+    def __init__(self, sample_rate=16000, channels=1, silence_threshold=70000, silence_duration=1.5, vad_engine=None,
+                 pre_roll=None, ring_seconds=None):
         self.sample_rate = sample_rate
         self.channels = channels
         self.silence_threshold = silence_threshold
         self.silence_duration = silence_duration
+        # VAD 引擎名稱（energy / spectral），None 時讀取環境變數 VAD_ENGINE
+        self.vad_engine = vad_engine
+        # 句首多保留的秒數，與環形緩衝區長度（秒）
+        self.pre_roll = pre_roll if pre_roll is not None else float(os.getenv('RECORDER_PRE_ROLL', '0.3'))
+        self.ring_seconds = ring_seconds if ring_seconds is not None else float(os.getenv('RECORDER_RING_SECONDS', '60'))
+        self.ring = RingBuffer(int(self.sample_rate * self.ring_seconds))
+        self.last_endpoint_delay = 0.0
+        # 最近一句的 RingSlice（"end" 事件時更新，在錄音執行緒上讀取）
+        self.last_utterance = None
+        # 插話偵測（barge_in.BargeIn）：麥克風音框先經過回音抑制，句尾先給本地關鍵字辨識
+        self.barge_in = None
         self.audio_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'audio_input'))
         os.makedirs(self.audio_dir, exist_ok=True)
 
 
-    def listen_forever(self, on_heard_callback):
-        print("🎧 進入持續監聽模式...")
+    def make_vad(self):
+        return make_vad(self.vad_engine, self.sample_rate,
+                        silence_threshold=self.silence_threshold, silence_duration=self.silence_duration)
 
-        frame_duration = 0.3
-        frame_size = int(self.sample_rate * frame_duration)
+    def mic_frames(self, frame_size):
+        """從麥克風持續讀取固定長度的 int16 音框"""
         stream = sd.InputStream(samplerate=self.sample_rate, channels=self.channels, dtype='int16')
         stream.start()
-
-        recording = []
-        last_voice_time = time.time()
-        speaking = False
-
         try:
             while True:
                 frame, overflowed = stream.read(frame_size)
                 if overflowed:
                     print("⚠️ 音訊 overflow!")
+                yield frame
+        finally:
+            stream.stop()
+            stream.close()
+
+    def make_segmenter(self):
+        """建立推送式的語句切分器（每個音訊來源各自一個）"""
+        return UtteranceSegmenter(self.make_vad(), self.sample_rate, self.pre_roll, self.ring_seconds)
+
+    def utterance_events(self, source=None):
+        """依 VAD 事件切出語句，依序產生：
+        ("start", 起點到目前的音訊)、("audio", 後續音框)、("pause", None)、("resume", None)、("end", 整句音訊)
+
+        音訊都是環形緩衝區的零複製切片；起點會往前多取 pre_roll 秒，避免切掉第一個音節。
+        啟用插話偵測時以 20 ms 為單位讀取麥克風；本地關鍵字辨識由各 listen_* 在錄音執行緒以外處理（見 handled_locally）。
+        """
+        segmenter = UtteranceSegmenter(self.make_vad(), self.sample_rate, self.pre_roll, ring=self.ring)
+        barge_in = self.barge_in
+        read_size = barge_in.read_size if barge_in else segmenter.frame_size
+        frames = source if source is not None else self.mic_frames(read_size)
+        for frame in frames:
+            if barge_in:
+                frame = barge_in.filter(frame)
+            for event in segmenter.push(frame):
+                if event[0] == "end":
+                    self.last_endpoint_delay = segmenter.last_endpoint_delay
+                    self.last_utterance = segmenter.last_utterance
+                yield event
+
+    def handled_locally(self, utterance):
+        """播放中說的控制指令由插話模組在本地處理（回傳 True），不必再送 ASR；請在錄音執行緒以外呼叫
+
+        utterance 為 RingSlice；比對期間音訊若已被覆蓋，結果不算數。
+        """
+        if self.barge_in is None or not utterance.valid():
+            return False
+        return self.barge_in.intercept(utterance.data) and utterance.valid()
+
+    def listen_forever(self, on_heard_callback=None, source=None, on_audio=None):
+        """持續監聽；句尾時呼叫 on_heard_callback(WAV 路徑)
+
+        若提供 on_audio，改為直接交出整句的 RingSlice（零複製切片，使用前後以 valid() 確認），不寫檔。
+        """
+        print("🎧 進入持續監聽模式...")
+
+        def deliver(utterance):
+            if self.handled_locally(utterance):
+                return
+            if on_audio:
+                on_audio(utterance)
+            else:
+                filename = os.path.join(self.audio_dir, f"recording.wav")
+                write(filename, self.sample_rate, utterance.data)
+                if not utterance.valid():
+                    print("⚠️ 語句在寫檔前已被之後的錄音覆蓋，略過這句")
+                    return
 
-                volume = np.linalg.norm(frame)
-                #debug用音量
-                # print(volume)
+                if on_heard_callback:
+                    on_heard_callback(filename)
 
-                if volume > self.silence_threshold:
-                    if not speaking:
-                        speaking = True
-                    recording.append(frame)
-                    last_voice_time = time.time()
+        # 啟用插話時，關鍵字辨識與之後的處理交給單一收尾執行緒（依語句順序），錄音迴圈不等 DTW 比對
+        finisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="utterance") if self.barge_in else None
+        try:
+            for kind, _ in self.utterance_events(source):
+                if kind != "end":
+                    continue
+                if finisher:
+                    # 交出零複製切片；收尾執行緒使用時以 valid() 確認沒有被之後的錄音覆蓋
+                    finisher.submit(deliver, self.last_utterance)
                 else:
-                    if speaking and (time.time() - last_voice_time) > self.silence_duration:
-                        audio_data = np.concatenate(recording, axis=0)
-                        filename = os.path.join(self.audio_dir, f"recording.wav")
-                        write(filename, self.sample_rate, audio_data)
+                    deliver(self.last_utterance)
+
+        except KeyboardInterrupt:
+            print("👋 停止持續監聽")
+        finally:
+            if finisher:
+                finisher.shutdown(wait=True)
+
+
+    def listen_streaming(self, transcriber, on_transcript, on_partial=None, source=None):
+        """串流模式：邊錄邊把 PCM 片段送給 transcriber，不寫入 WAV 檔
 
-                        if on_heard_callback:
-                            on_heard_callback(filename)
+        source 可替換成任意音框來源（例如重播 WAV 檔），預設為麥克風。
+        on_transcript(text, utterance_id) 在句尾靜音逾時後收到最終文字（在收尾執行緒上呼叫，依語句順序）；
+        on_partial(text, utterance_id) 在說話途中收到部分辨識結果。utterance_id 為每句遞增的編號，
+        上一句還在收尾時下一句的部分結果可能已經送達，靠編號分辨屬於哪一句。
+        """
+        print("🎧 進入持續監聽模式（串流辨識）...")
 
-                        recording = []
-                        speaking = False
+        # 句尾的收尾（等最後一次辨識）交給單一收尾執行緒，錄音迴圈不必等端點回應
+        finisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="asr-finish")
+
+        def finish(session, utterance_id, utterance):
+            if utterance is not None and self.handled_locally(utterance):
+                session.discard()
+                return
+            try:
+                text = session.finish()
+            except Exception as e:
+                print(f"❌ 最終辨識失敗，略過這句: {str(e)}")
+                return
+            if on_transcript and text:
+                on_transcript(text, utterance_id)
+
+        def partial_callback(utterance_id):
+            if on_partial is None:
+                return None
+            return lambda text: on_partial(text, utterance_id)
+
+        session = None
+        utterance_id = 0
+        paused = None        # 停頓期間的音框先暫存，恢復說話才送出；句尾的靜音不必送去辨識
+        try:
+            for kind, audio_data in self.utterance_events(source):
+                if kind == "start":
+                    utterance_id += 1
+                    session = transcriber.start_stream(self.sample_rate, on_partial=partial_callback(utterance_id))
+                    session.feed(audio_data)
+                    paused = None
+                elif kind == "audio":
+                    if paused is None:
+                        session.feed(audio_data)
+                    else:
+                        paused.append(audio_data)
+                        # 停頓時若前一個請求還沒回來，等它回來後再補送一次
+                        session.flush()
+                elif kind == "pause":
+                    # 進入靜音：立刻把已收到的語音送出辨識，與靜音等待時間重疊
+                    session.flush()
+                    paused = []
+                elif kind == "resume":
+                    if paused:
+                        session.feed(np.concatenate(paused))
+                    paused = None
+                elif kind == "end":
+                    finisher.submit(finish, session, utterance_id, self.last_utterance if self.barge_in else None)
+                    session = None
 
         except KeyboardInterrupt:
             print("👋 停止持續監聽")
         finally:
-            stream.stop()
-            stream.close()
+            # 音訊來源結束（例如重播檔案）時等已結束的語句收尾完
+            finisher.shutdown(wait=True)
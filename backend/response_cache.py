@@ -0,0 +1,111 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from intent_classifier import normalize_text, char_ngrams
+
+# 各類型回覆的預設存活秒數：查詢結果很快過期，聊天回覆可以保留較久；行動不快取
+DEFAULT_TTL = {'聊天': 24 * 3600, '查詢': 600, '行動': 0}
+
+
+def parse_ttl(spec):
+    """解析 "聊天=86400,查詢=600" 格式的設定"""
+    ttl = dict(DEFAULT_TTL)
+    for item in (spec or "").split(','):
+        if '=' in item:
+            command_type, seconds = item.split('=', 1)
+            ttl[command_type.strip()] = int(seconds)
+    return ttl
+
+
+class ResponseCache:
+    """聊天／查詢回覆快取：完全比對 → 標準化比對 →（可選）近似比對
+
+    標準化比對使用 OpenCC 簡轉繁並去除標點，近似比對以字元雙字組的 Jaccard 相似度判斷，
+    similarity 為 0 時關閉。每筆資料依其類型的 TTL 過期。
+    """
+
+    def __init__(self, ttl=None, similarity=0.0, max_entries=500):
+        self.ttl = ttl or dict(DEFAULT_TTL)
+        self.similarity = similarity
+        self.max_entries = max_entries
+        self.counts = {"exact": 0, "normalized": 0, "similar": 0, "miss": 0}
+
+        self._exact = {}
+        self._entries = OrderedDict()   # 標準化文字 -> (command_type, response, 過期時間, 雙字組)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            ttl=parse_ttl(os.getenv('RESPONSE_CACHE_TTL')),
+            similarity=float(os.getenv('RESPONSE_CACHE_SIMILARITY', '0')),
+        )
+
+    def lookup(self, text):
+        """回傳 (command_type, response, 判定)；未命中時前兩者為 None，判定為 "miss" """
+        key = normalize_text(text)
+        now = time.time()
+        with self._lock:
+            hit, decision = None, "miss"
+            normalized = self._exact.get(text)
+            if normalized is not None and self._alive(normalized, now):
+                hit, decision = normalized, "exact"
+            elif self._alive(key, now):
+                hit, decision = key, "normalized"
+            elif self.similarity and key:
+                hit = self._nearest(char_ngrams(key, (2,)), now)
+                decision = "similar" if hit else "miss"
+
+            self.counts[decision] += 1
+            if not hit:
+                return None, None, "miss"
+            self._entries.move_to_end(hit)
+            command_type, response, _, _ = self._entries[hit]
+            return command_type, response, decision
+
+    def _alive(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        if entry[2] < now:
+            del self._entries[key]
+            return False
+        return True
+
+    def _nearest(self, grams, now):
+        best, best_score = None, self.similarity
+        keys = set(grams)
+        for key, (_, _, expires, entry_grams) in list(self._entries.items()):
+            if expires < now:
+                continue
+            union = len(keys | entry_grams)
+            score = len(keys & entry_grams) / union if union else 0.0
+            if score >= best_score:
+                best, best_score = key, score
+        return best
+
+    def store(self, text, command_type, response):
+        ttl = self.ttl.get(command_type, 0)
+        key = normalize_text(text)
+        if ttl <= 0 or not key or not isinstance(response, str) or not response:
+            return
+        with self._lock:
+            self._exact[text] = key
+            self._entries[key] = (command_type, response, time.time() + ttl, set(char_ngrams(key, (2,))))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if len(self._exact) > self.max_entries * 2:
+                self._exact = {t: k for t, k in self._exact.items() if k in self._entries}
+
+    def get_stats(self):
+        with self._lock:
+            lookups = sum(self.counts.values())
+            hits = lookups - self.counts["miss"]
+            return {
+                **self.counts,
+                "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+                "entries": len(self._entries),
+                "ttl": self.ttl,
+            }
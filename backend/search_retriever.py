@@ -0,0 +1,256 @@
+import os
+import re
+import time
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from intent_classifier import normalize_text, char_ngrams
+import tracing
+
+# 口語查詢常見的開頭／結尾贅字；去掉後的關鍵字版本與原句一起送出搜尋
+_FILLER_PREFIX = re.compile(r"^(請問|請幫我|幫我|麻煩|我想知道|我想問|告訴我|查一下|查詢|搜尋|查)+")
+_FILLER_SUFFIX = re.compile(r"(是什麼|是多少|怎麼樣|如何|一下|嗎|呢|呀|啊|吧)+$")
+
+
+def query_variants(text, limit=2):
+    """由轉寫文字產生搜尋關鍵字版本（原句、去除贅字的關鍵字）；不額外呼叫模型"""
+    variants = []
+    for candidate in (text.strip(), _FILLER_SUFFIX.sub("", _FILLER_PREFIX.sub("", normalize_text(text)))):
+        if candidate and all(normalize_text(candidate) != normalize_text(v) for v in variants):
+            variants.append(candidate)
+    return variants[:limit]
+
+
+class SearchCache:
+    """搜尋結果快取：以標準化後的關鍵字為鍵，超過 ttl 秒過期，超過 max_entries 淘汰最久未使用的"""
+
+    def __init__(self, ttl=600, max_entries=500):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # 標準化關鍵字 -> (結果, 過期時間)
+        self._lock = threading.Lock()
+
+    def get(self, query):
+        key = normalize_text(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.time():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, query, results):
+        key = normalize_text(query)
+        if self.ttl <= 0 or not key:
+            return
+        with self._lock:
+            self._entries[key] = (results, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def dedupe_results(results, similarity=0.8, limit=5):
+    """去除重複的搜尋結果：相同連結，或摘要的字元雙字組 Jaccard 相似度達 similarity"""
+    kept, seen_links, seen_grams = [], set(), []
+    for item in results:
+        link = item.get('link')
+        grams = set(char_ngrams(normalize_text(item.get('snippet', '')), (2,)))
+        if link in seen_links:
+            continue
+        if grams and any(len(grams & other) / len(grams | other) >= similarity for other in seen_grams):
+            continue
+        kept.append(item)
+        seen_links.add(link)
+        seen_grams.append(grams)
+        if len(kept) >= limit:
+            break
+    return kept
+
+
+class SearchRetriever:
+    """查詢用的檢索階段：多個關鍵字版本並行搜尋、逾時與對沖請求、TTL 快取、摘要去重
+
+    單一請求超過 hedge_delay 秒還沒回來，就再送一次相同請求，取先回來的結果（另一個結果丟棄）；
+    hedge_delay 未指定時取最近請求延遲的 p95，累積到 10 筆延遲前不對沖（冷啟動時不重複花錢查詢）。
+    整體等待不超過 timeout 秒，逾時的版本直接略過。
+    """
+
+    def __init__(self, http, url, api_key=None, cx=None, timeout=2.0, hedge_delay=None, variants=2,
+                 per_query=3, max_results=5, cache=None, workers=8):
+        self.http = http
+        self.url = url
+        self.api_key = api_key
+        self.cx = cx
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self.variants = variants
+        self.per_query = per_query
+        self.max_results = max_results
+        self.cache = cache
+        # 各關鍵字版本的 search() 會阻塞等待自己的請求，兩者分開兩個執行緒池，同時多個查詢時才不會互相卡住
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="search")
+        self.request_executor = ThreadPoolExecutor(max_workers=workers * 2, thread_name_prefix="search-request")
+
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+        self.errors = 0
+        self._latencies = deque(maxlen=100)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, http):
+        hedge_delay = os.getenv('SEARCH_HEDGE_DELAY')
+        ttl = int(os.getenv('SEARCH_CACHE_TTL', '600'))
+        return cls(
+            http,
+            url=os.getenv('GOOGLE_SEARCH_URL', "https://www.googleapis.com/customsearch/v1"),
+            api_key=os.getenv('GOOGLE_SEARCH_API_KEY'),
+            cx=os.getenv('GOOGLE_SEARCH_CX'),
+            timeout=float(os.getenv('SEARCH_TIMEOUT', '2.0')),
+            hedge_delay=float(hedge_delay) if hedge_delay else None,
+            variants=int(os.getenv('SEARCH_VARIANTS', '2')),
+            per_query=int(os.getenv('SEARCH_PER_QUERY', '3')),
+            max_results=int(os.getenv('SEARCH_MAX_RESULTS', '5')),
+            cache=SearchCache(ttl) if ttl > 0 else None,
+        )
+
+    @staticmethod
+    def _submit(executor, func, *args):
+        # 每個工作各自複製 contextvars，搜尋的 span 才會記到發起查詢的那一輪
+        return executor.submit(contextvars.copy_context().run, func, *args)
+
+    def _hedge_after(self):
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < 10:
+            return None
+        return max(0.1, latencies[int(len(latencies) * 0.95) - 1])
+
+    def _request(self, query):
+        """送出一次搜尋請求；回傳結果清單，失敗時拋出例外"""
+        start = time.time()
+        with tracing.span("web_search"):
+            response = self.http.get(self.url, params={'key': self.api_key, 'cx': self.cx, 'q': query, 'num': self.per_query},
+                                     timeout=(min(3.0, self.timeout), self.timeout))
+            response.raise_for_status()
+            results = response.json()
+        with self._lock:
+            self.requests += 1
+            self._latencies.append(time.time() - start)
+        return [{
+            'title': item['title'],
+            'snippet': item['snippet'],
+            'link': item['link']
+        } for item in results.get('items', [])[:self.per_query]]
+
+    def search(self, query, deadline=None):
+        """單一關鍵字搜尋（先查快取）；逾時或失敗回傳 []，不寫入快取"""
+        if self.cache is not None:
+            cached = self.cache.get(query)
+            if cached is not None:
+                return cached
+        deadline = deadline or time.time() + self.timeout
+
+        primary = self._submit(self.request_executor, self._request, query)
+        pending = {primary}
+        hedge_after = self._hedge_after()
+        if hedge_after is not None:
+            done, _ = wait(pending, timeout=min(hedge_after, max(0.0, deadline - time.time())))
+            if not done and time.time() < deadline:
+                with self._lock:
+                    self.hedged += 1
+                pending.add(self._submit(self.request_executor, self._request, query))
+
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.time()), return_when=FIRST_COMPLETED)
+            if not done:
+                with self._lock:
+                    self.timeouts += 1
+                print(f"⏱️ 搜尋逾時：{query}")
+                return []
+            for future in done:
+                try:
+                    results = future.result()
+                except Exception as e:
+                    with self._lock:
+                        self.errors += 1
+                    print(f"搜索出錯: {str(e)}")
+                    continue
+                if future is not primary:
+                    with self._lock:
+                        self.hedge_wins += 1
+                if self.cache is not None:
+                    self.cache.put(query, results)
+                return results
+        return []
+
+    def retrieve(self, text):
+        """並行搜尋各關鍵字版本，合併並去除重複摘要後回傳"""
+        with tracing.span("retrieve"):
+            deadline = time.time() + self.timeout
+            queries = query_variants(text, self.variants)
+            if not queries:
+                return []
+            # 第一個版本在目前執行緒搜尋，其餘交給執行緒池
+            futures = [self._submit(self.executor, self.search, query, deadline) for query in queries[1:]]
+            merged = list(self.search(queries[0], deadline))
+            for future in futures:
+                merged += future.result()
+            return dedupe_results(merged, limit=self.max_results)
+
+    def get_stats(self):
+        hedge_after = self._hedge_after()
+        with self._lock:
+            stats = {
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "timeouts": self.timeouts,
+                "errors": self.errors,
+                "hedge_delay": round(hedge_after, 3) if hedge_after is not None else None,
+            }
+        if self.cache is not None:
+            stats.update({"cache_hits": self.cache.hits, "cache_misses": self.cache.misses, "cache_entries": len(self.cache)})
+        return stats
+
+
+def main():
+    """python search_retriever.py：以本地假搜尋服務比較冷查詢與快取命中的耗時（可用 --latency 模擬慢請求）"""
+    import argparse
+    from aws_clients import get_http_session
+    from fake_aws import FakeServiceServer, DEFAULT_LATENCY, parse_latency
+
+    parser = argparse.ArgumentParser(description="檢索階段測試（本地假 Google 搜尋）")
+    parser.add_argument('--latency', default="google=0.3:0.3", help="例如 google=0.3:0.3（標準差大時較常觸發對沖請求）")
+    parser.add_argument('queries', nargs='*', default=["請問今天天氣如何？", "幫我查行天宮附近的披薩店", "今天有什麼重大新聞？"])
+    args = parser.parse_args()
+
+    server = FakeServiceServer(parse_latency(args.latency, DEFAULT_LATENCY)).start()
+    retriever = SearchRetriever(get_http_session(), url=f"{server.url}/customsearch/v1", cache=SearchCache())
+    for label in ("冷查詢", "快取"):
+        for query in args.queries:
+            start = time.time()
+            results = retriever.retrieve(query)
+            print(f"[{label}] {query} → {query_variants(query)}：{len(results)} 筆，{time.time() - start:.2f}s")
+            for item in results:
+                print(f"    {item['link']}  {item['snippet']}")
+    print(retriever.get_stats(), server.requests)
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import os
+import threading
+from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor
+from intent_classifier import normalize_text
+import tracing
+
+
+def similarity(a, b):
+    """兩段標準化文字的相似度（0～1）"""
+    return SequenceMatcher(None, a, b).ratio()
+
+
+class Speculation:
+    """針對一段穩定的部分辨識結果，在背景先跑分類；判定為查詢時接著以最新的部分結果預先搜尋"""
+
+    def __init__(self, text, key):
+        self.text = text
+        self.key = key
+        self.search_text = text
+        self.search_key = key
+        self.cancelled = False
+        # 最終文字與搜尋用的文字完全相同時，預先搜尋的結果才能沿用
+        self.reuse_search = False
+        self.classify = None
+        self.search = None
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """尚未開始的工作直接取消；已送出的模型／搜尋請求會跑完，但結果被丟棄"""
+        with self._lock:
+            self.cancelled = True
+            for future in (self.classify, self.search):
+                if future:
+                    future.cancel()
+
+
+class SpeculativeClassifier:
+    """推測執行：句子還沒說完，就用穩定的部分辨識結果先分類、先搜尋
+
+    新的部分結果只是延長上一次的內容（前段相似度達 stable_ratio，且長度至少 min_chars 字）即視為穩定，開始推測；
+    之後若部分結果與推測文字差到句尾不會沿用，取消舊的推測重來（每句最多 max_attempts 次，避免浪費模型呼叫）。
+    句尾 take(最終文字) 時，與推測文字相似度達 match_ratio 才沿用分類結果；
+    搜尋關鍵字會跟著之後的部分結果更新，但只有與最終文字標準化後完全相同時才沿用，否則在回應階段重新搜尋。
+
+    observe／take 都帶語句編號（recorder.listen_streaming 提供）：上一句在收尾執行緒 take 之前，
+    下一句的部分結果可能已經開始送進來，各句的推測分開保存，不會被別句取走。
+    推測分類的延遲記在 "speculative" 模式下，不算進 two_call 的統計。
+    """
+
+    def __init__(self, classifier, min_chars=None, stable_ratio=None, match_ratio=None, max_attempts=None):
+        self.classifier = classifier
+        self.min_chars = min_chars or int(os.getenv('SPECULATE_MIN_CHARS', '4'))
+        self.stable_ratio = stable_ratio or float(os.getenv('SPECULATE_STABLE_RATIO', '0.9'))
+        self.match_ratio = match_ratio or float(os.getenv('SPECULATE_MATCH_RATIO', '0.8'))
+        self.max_attempts = max_attempts or int(os.getenv('SPECULATE_MAX_ATTEMPTS', '3'))
+        self.prefetch_search = os.getenv('SPECULATE_SEARCH', '1') == '1'
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculate")
+
+        self._utterances = {}     # 語句編號 -> {"previous": 上一段部分結果, "current": 推測, "attempts": 次數}
+        self._lock = threading.Lock()
+        self.stats = {"started": 0, "cancelled": 0, "hits": 0, "misses": 0, "search_hits": 0, "search_misses": 0}
+
+    def observe(self, text, utterance_id=None):
+        """收到語句 utterance_id 的一段部分辨識結果（可在辨識執行緒呼叫，不阻塞）"""
+        key = normalize_text(text)
+        with self._lock:
+            state = self._utterances.setdefault(utterance_id, {"previous": "", "current": None, "attempts": 0})
+            previous, state["previous"] = state["previous"], key
+            if len(key) < self.min_chars or not previous:
+                return
+            if similarity(previous, key[:len(previous)]) < self.stable_ratio:
+                return
+            current = state["current"]
+            if current and similarity(current.key, key) >= self.match_ratio:
+                if key != current.search_key:
+                    self._refresh_search(current, text, key)
+                return
+            if state["attempts"] >= self.max_attempts:
+                return
+            if current:
+                current.cancel()
+                self.stats["cancelled"] += 1
+            speculation = Speculation(text, key)
+            state["current"] = speculation
+            state["attempts"] += 1
+            self.stats["started"] += 1
+            speculation.classify = self.executor.submit(self._classify, speculation)
+        print(f"🔮 推測分類：{text}")
+
+    def _classify(self, speculation):
+        # 部分結果可能不完整，不拿來訓練本地分類器；延遲另外統計，不混進 two_call
+        command_type = self.classifier.classify_command(speculation.text, learn=False, mode="speculative")
+        if command_type == '查詢' and self.prefetch_search:
+            with speculation._lock:
+                if not speculation.cancelled:
+                    speculation.search = self.executor.submit(self.classifier.retrieve, speculation.search_text)
+        return command_type
+
+    def _refresh_search(self, speculation, text, key):
+        """分類仍可沿用，但搜尋關鍵字改用較新的部分結果（分類還沒完成時只記下文字）"""
+        with speculation._lock:
+            speculation.search_text, speculation.search_key = text, key
+            if speculation.search is not None and not speculation.cancelled:
+                speculation.search.cancel()
+                speculation.search = self.executor.submit(self.classifier.retrieve, text)
+
+    def take(self, text, utterance_id=None):
+        """句尾：取出語句 utterance_id 的推測；與最終文字差太多時取消並回傳 None
+
+        編號較小、已經不會再 take 的語句（例如由本地關鍵字處理而放棄的）一併清掉。
+        """
+        key = normalize_text(text)
+        with self._lock:
+            state = self._utterances.pop(utterance_id, None)
+            if utterance_id is not None:
+                for stale_id in [i for i in self._utterances if i is not None and i < utterance_id]:
+                    stale = self._utterances.pop(stale_id)["current"]
+                    if stale:
+                        stale.cancel()
+            speculation = state["current"] if state else None
+            if speculation is None:
+                return None
+            if similarity(speculation.key, key) < self.match_ratio:
+                speculation.cancel()
+                self.stats["misses"] += 1
+                print(f"🔮 推測作廢：「{speculation.text}」→「{text}」")
+                return None
+            self.stats["hits"] += 1
+            speculation.reuse_search = speculation.search_key == key
+            return speculation
+
+    def command_type(self, speculation):
+        """等待推測分類完成；推測失敗時回傳 None，由呼叫端照常分類"""
+        try:
+            with tracing.span("speculation_wait"):
+                return speculation.classify.result()
+        except Exception as e:
+            print(f"推測分類失敗: {str(e)}")
+            return None
+
+    def search_results(self, speculation):
+        """取得預先搜尋的結果；沒有可沿用的結果時回傳 None"""
+        with speculation._lock:
+            search = speculation.search
+        if search is None:
+            return None
+        if not speculation.reuse_search:
+            search.cancel()
+            with self._lock:
+                self.stats["search_misses"] += 1
+            return None
+        with self._lock:
+            self.stats["search_hits"] += 1
+        with tracing.span("speculation_wait"):
+            return search.result()
+
+    def reset(self):
+        with self._lock:
+            for state in self._utterances.values():
+                if state["current"]:
+                    state["current"].cancel()
+            self._utterances = {}
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        decided = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / decided, 3) if decided else None
+        return stats
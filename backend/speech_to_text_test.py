@@ -1,53 +1,51 @@
 import os
-import json
 import sys
-import boto3
-from dotenv import load_dotenv
+import wave
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from aws_clients import get_client
+import numpy as np
 from datetime import datetime
-from opencc import OpenCC
+from history_store import get_writer, new_record
+from audio_prep import AudioPrep, decode_wav
+from asr_backends import SageMakerASR, ASRRouter
+import tracing
+import startup
 
-converter = OpenCC('s2tw')  # ✅ 注意這裡直接寫 's2t'，不用加 '.json'
+# ✅ 's2tw' 不用加 '.json'；第一次轉換時才載入 OpenCC 字典
+converter = startup.component("speech_to_text_test.converter", "opencc", "OpenCC", "s2tw")
 
 # ✅ 載入 config/.env（用絕對路徑避免錯誤）
-env_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'config', '.env'))
-load_dotenv(env_path)
+startup.load_env()
 
 class SpeechToText:
-    def __init__(self):
+    def __init__(self, runtime=None):
         # Whisper 模型配置
         self.endpoint_name = os.getenv('SAGEMAKER_ENDPOINT_NAME', 'jumpstart-dft-hf-asr-whisper-large-20250426-025518')
         self.region = os.getenv('AWS_REGION', 'us-west-2')
 
-        # ✅ 創建 SageMaker 客戶端（加上明確金鑰）
-        self.runtime = boto3.client(
-            "sagemaker-runtime", 
-            region_name=self.region,
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-        )
-
-        # ✅ 設定儲存路徑為 backend/data/transcripts
-        self.transcript_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'transcripts'))
-        os.makedirs(self.transcript_dir, exist_ok=True)
+        # ✅ 共用的 SageMaker 客戶端（連線池重用）；可注入假端點做離線測試
+        self.runtime = runtime or get_client("sagemaker-runtime", self.region)
 
-    def save_transcript(self, transcript_text, audio_file_path, confidence=0.9):
-        """保存转写结果"""
-        audio_filename = os.path.basename(audio_file_path)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        transcript_filename = os.path.join(self.transcript_dir, f"transcript_{timestamp}.json")
+        # ✅ 轉寫結果交給共用的背景寫入器
+        self.history = get_writer()
 
-        data = {
-            'audio_file': audio_filename,
-            'timestamp': timestamp,
-            'transcript': transcript_text,
-            'confidence': confidence
-        }
+        # ✅ 上傳前裁掉前後靜音、正規化音量（可選 FLAC／Opus 壓縮），減少上傳量與推論時間
+        self.prep = AudioPrep.from_env()
 
-        with open(transcript_filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # ✅ 辨識引擎：雲端 Whisper-large；ASR_LOCAL=1 時短句先交給本機量化模型，信心不足再送雲端
+        self.cloud = SageMakerASR(self.runtime, self.endpoint_name, self.prep)
+        self.router = ASRRouter.from_env(self.cloud)
 
-        # print(f"轉寫文本已保存至: {transcript_filename}")
-        return transcript_filename
+    def save_transcript(self, transcript_text, audio_file_path, confidence=0.9):
+        """保存转写结果（背景附加到 data/history/transcript.jsonl）"""
+        data = new_record(
+            audio_file=os.path.basename(audio_file_path),
+            transcript=transcript_text,
+            confidence=confidence
+        )
+        self.history.append('transcript', data)
+        return self.history.path_for('transcript')
 
     def transcribe_file(self, audio_file_path):
         """將音頻文件轉換為文字"""
@@ -56,35 +54,156 @@ class SpeechToText:
         try:
             with open(audio_file_path, "rb") as audio_file:
                 audio_bytes = audio_file.read()
+        except Exception as e:
+            print(f"轉換過程中出現錯誤: {str(e)}")
+            return None
 
-            response = self.runtime.invoke_endpoint(
-                EndpointName=self.endpoint_name,
-                ContentType="audio/wav",
-                Body=audio_bytes
-            )
-
-            response_body = response["Body"].read().decode("utf-8")
-            result = json.loads(response_body)
-
-            transcript_text = ""
-            confidence = 0.9
-
-            if "text" in result and isinstance(result["text"], list) and len(result["text"]) > 0:
-                transcript_text = result["text"][0]
-                confidence = result.get("confidence", 0.9)
-                print(f"識別結果: {transcript_text}")
-
-            #print("語音轉換完成!")
+        return self.transcribe_bytes(audio_bytes, audio_file_path)
 
+    def transcribe_bytes(self, audio_bytes, audio_name="stream.wav"):
+        """將記憶體中的 WAV 位元組轉換為文字（不經過磁碟）"""
+        try:
+            pcm, sample_rate = decode_wav(audio_bytes)
+        except (wave.Error, ValueError, EOFError) as e:
+            # 無法解析的 WAV 照原樣上傳，交給雲端端點處理
+            print(f"⚠️ 無法解析 WAV，略過音訊準備：{e}")
+            return self._transcribe(lambda: self._invoke(audio_bytes), audio_name)
+        return self.transcribe_pcm(pcm, sample_rate, audio_name)
+
+    def transcribe_pcm(self, pcm, sample_rate=16000, audio_name="stream.wav"):
+        """將 int16 PCM 轉換為文字（錄音端直接交出的音訊，不必先編成 WAV）"""
+        return self._transcribe(lambda: self.recognize(pcm, sample_rate), audio_name)
+
+    def recognize(self, pcm, sample_rate=16000, partial=False):
+        """PCM → (原始文字, 信心值)：裁切靜音、正規化後由路由決定送本機或雲端引擎
+
+        partial=True（串流辨識的部分結果）時音訊準備的統計另外記錄，不算進最終辨識。
+        """
+        with self.prep.counting("partial" if partial else "final"):
+            return self.router.transcribe(self.prep.process(pcm, sample_rate), sample_rate)
+
+    def _transcribe(self, recognize, audio_name):
+        try:
+            transcript_text, confidence = recognize()
             if transcript_text:
-                self.save_transcript(transcript_text, audio_file_path, confidence)
+                print(f"識別結果: {transcript_text}")
+                self.save_transcript(transcript_text, audio_name, confidence)
 
-            return converter.convert(transcript_text)
+            with tracing.span("opencc"):
+                return converter.convert(transcript_text)
 
         except Exception as e:
             print(f"轉換過程中出現錯誤: {str(e)}")
             return None
 
+    def _invoke(self, audio_bytes, content_type="audio/wav"):
+        """直接呼叫雲端 Whisper 端點，回傳 (原始文字, 信心值)"""
+        return self.cloud.invoke(audio_bytes, content_type)
+
+    def start_stream(self, sample_rate=16000, on_partial=None, partial_interval=None):
+        """開啟串流轉寫：錄音中即可送入 PCM 片段，邊說邊辨識"""
+        if partial_interval is None:
+            partial_interval = float(os.getenv('ASR_PARTIAL_INTERVAL', '0.6'))
+        return StreamingTranscription(self, sample_rate, on_partial, partial_interval)
+
+
+class StreamingTranscription:
+    """單一語句的串流轉寫工作階段
+
+    錄音端持續呼叫 feed() 送入 int16 片段；每累積 partial_interval 秒的新音訊，
+    就在背景把目前為止的音訊送去辨識，產生部分結果（partial）。
+    句尾呼叫 finish() 取得最終結果；若最後一次部分辨識已涵蓋全部音訊，直接沿用，不再多打一次端點。
+    """
+
+    def __init__(self, transcriber, sample_rate, on_partial=None, partial_interval=0.6):
+        self.transcriber = transcriber
+        self.sample_rate = sample_rate
+        self.on_partial = on_partial
+        self.partial_samples = int(sample_rate * partial_interval)
+
+        self._chunks = []
+        self._total = 0
+        self._requested = 0          # 已送出辨識的樣本數
+        self._covered = 0            # 最新部分結果涵蓋的樣本數
+        self._partial_text = ""
+        self._confidence = 0.9
+        self._pending = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def feed(self, chunk):
+        """送入一段 int16 PCM（不阻塞錄音執行緒）"""
+        with self._lock:
+            self._chunks.append(chunk.reshape(-1))
+            self._total += len(chunk)
+            due = self._total - self._requested >= self.partial_samples
+        if due:
+            self.flush()
+
+    def flush(self):
+        """若沒有進行中的請求，立即把目前累積的音訊送去辨識"""
+        with self._lock:
+            if self._total == self._requested or (self._pending and not self._pending.done()):
+                return
+            pcm = self._snapshot()
+            self._requested = len(pcm)
+            self._pending = self._executor.submit(self._recognize, pcm)
+
+    def _snapshot(self):
+        if len(self._chunks) > 1:
+            self._chunks = [np.concatenate(self._chunks)]
+        return self._chunks[0] if self._chunks else np.zeros(0, dtype=np.int16)
+
+    def _recognize(self, pcm, final=False):
+        try:
+            text, confidence = self.transcriber.recognize(pcm, self.sample_rate, partial=not final)
+        except Exception as e:
+            if final:
+                raise
+            print(f"串流辨識錯誤: {str(e)}")
+            return
+        with self._lock:
+            if len(pcm) >= self._covered:
+                self._covered = len(pcm)
+                self._partial_text = text
+                self._confidence = confidence
+        if self.on_partial and text:
+            self.on_partial(converter.convert(text))
+
+    @property
+    def partial(self):
+        """目前最新的部分辨識結果（已轉繁體）"""
+        return converter.convert(self._partial_text)
+
+    def discard(self):
+        """放棄這句話（例如已由本地關鍵字處理）：不再送出辨識，也不回報部分結果"""
+        self.on_partial = None
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def finish(self):
+        """句尾：等待進行中的請求，必要時補辨識剩餘音訊，回傳最終文字
+
+        會等一次端點往返，不要在錄音執行緒上呼叫。補辨識失敗時拋出例外，不拿舊的部分結果當最終結果。
+        """
+        pending = self._pending
+        if pending:
+            pending.result()
+        with self._lock:
+            need_final = self._total > self._covered
+            pcm = self._snapshot()
+        try:
+            if need_final:
+                self._recognize(pcm, final=True)
+        finally:
+            self._executor.shutdown(wait=False)
+
+        text = self._partial_text
+        if text:
+            print(f"識別結果: {text}")
+            self.transcriber.save_transcript(text, "stream.wav", self._confidence)
+        return converter.convert(text)
+
+
 def main():
     # ✅ 測試音檔請放這個路徑（改為相對路徑，統一使用）
     test_audio_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'audio', 'test.wav'))
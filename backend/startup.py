@@ -0,0 +1,149 @@
+import os
+import sys
+import time
+import socket
+import importlib
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+# ✅ 設定檔路徑（絕對路徑）；整個行程只載入一次
+ENV_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), 'config', '.env'))
+
+_t0 = time.perf_counter()
+_events = []
+_marks = {}
+_lock = threading.RLock()
+_env_loaded = False
+
+
+def load_env():
+    """載入 config/.env（各模組都可以呼叫，只有第一次真的讀檔）"""
+    global _env_loaded
+    with _lock:
+        if not _env_loaded:
+            load_dotenv(ENV_PATH)
+            _env_loaded = True
+
+
+def lazy_init():
+    """延遲初始化：重量級模組與客戶端在第一次使用（或背景預熱）時才建立；LAZY_INIT=0 時建立元件當下就初始化
+
+    先載入 config/.env 再讀旗標，設定檔中的 LAZY_INIT 才會生效（元件可能在呼叫端載入設定前就宣告）。
+    """
+    load_env()
+    return os.getenv('LAZY_INIT', '1') == '1'
+
+
+@contextmanager
+def timed(kind, name):
+    """記錄一段啟動工作（import／init／warm）的耗時與相對啟動的時間點"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        with _lock:
+            _events.append({"kind": kind, "name": name, "at": round(start - _t0, 4), "seconds": round(end - start, 4),
+                            "thread": threading.current_thread().name})
+
+
+def import_module(name):
+    """匯入模組並記錄耗時；已經匯入過的不再記錄（耗時算在第一個匯入它的元件）"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    with timed("import", name):
+        return importlib.import_module(name)
+
+
+def mark(name):
+    """記下一個里程碑（例如 imported、serving）相對啟動的秒數"""
+    with _lock:
+        _marks.setdefault(name, round(time.perf_counter() - _t0, 4))
+
+
+class Lazy:
+    """第一次存取屬性時才匯入模組並建立的元件；之後所有屬性存取都轉給實體
+
+    on_ready(實體) 在建立後呼叫一次（例如把插話模組接到錄音器）。建立過程以鎖保護，
+    背景預熱與請求同時觸發時只會建立一次。
+    """
+
+    def __init__(self, name, module, factory, *args, on_ready=None, **kwargs):
+        object.__setattr__(self, "_spec", (name, module, factory, args, kwargs, on_ready))
+        object.__setattr__(self, "_instance", None)
+        object.__setattr__(self, "_lock", threading.RLock())
+
+    @property
+    def ready(self):
+        return self._instance is not None
+
+    def get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    name, module, factory, args, kwargs, on_ready = self._spec
+                    module = import_module(module)
+                    with timed("init", name):
+                        instance = getattr(module, factory)(*args, **kwargs)
+                    object.__setattr__(self, "_instance", instance)
+                    if on_ready:
+                        on_ready(instance)
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get(), name, value)
+
+    def __repr__(self):
+        return f"<Lazy {self._spec[0]}{'' if self.ready else '（尚未建立）'}>"
+
+
+def component(name, module, factory, *args, on_ready=None, **kwargs):
+    """建立元件；延遲初始化關閉時立即建立"""
+    lazy = Lazy(name, module, factory, *args, on_ready=on_ready, **kwargs)
+    if not lazy_init():
+        lazy.get()
+    return lazy
+
+
+def warm(components):
+    """依序建立尚未建立的元件（建議在背景執行緒呼叫）"""
+    for lazy in components:
+        if not lazy.ready:
+            with timed("warm", lazy._spec[0]):
+                lazy.get()
+
+
+def wait_for_port(port, host="127.0.0.1", timeout=30.0):
+    """等到本機的 HTTP 伺服器開始接受連線；逾時回傳 False"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.2):
+                return True
+        except OSError:
+            time.sleep(0.02)
+    return False
+
+
+def report():
+    """啟動時間報告：里程碑與各模組匯入、元件建立的耗時（依時間先後）"""
+    with _lock:
+        events = sorted(_events, key=lambda event: event["at"])
+        totals = {}
+        for event in events:
+            if event["kind"] != "warm":
+                totals[event["kind"]] = round(totals.get(event["kind"], 0) + event["seconds"], 4)
+        return {"lazy_init": lazy_init(), "marks": dict(_marks), "totals": totals, "events": events}
+
+
+def print_report():
+    data = report()
+    marks = "，".join(f"{name} {seconds:.3f}s" for name, seconds in data["marks"].items())
+    print(f"🚀 啟動時間（延遲初始化 {'開' if data['lazy_init'] else '關'}）：{marks}")
+    for event in data["events"]:
+        print(f"    {event['at']:>7.3f}s  {event['kind']:6} {event['name']:28} {event['seconds']:.3f}s  [{event['thread']}]")
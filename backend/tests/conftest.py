@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 後端模組都直接放在 backend/ 底下（不是套件），測試以模組名稱匯入
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -0,0 +1,42 @@
+import numpy as np
+from audio_prep import AudioPrep, decode_wav, encode_wav
+
+SAMPLE_RATE = 16000
+
+
+def utterance():
+    """前後各 1 秒靜音，中間 1 秒 440 Hz 的小音量正弦波"""
+    t = np.arange(SAMPLE_RATE) / SAMPLE_RATE
+    tone = (3000 * np.sin(2 * np.pi * 440 * t)).astype(np.int16)
+    silence = np.zeros(SAMPLE_RATE, dtype=np.int16)
+    return np.concatenate([silence, tone, silence])
+
+
+def test_process_trims_silence_and_normalizes():
+    prep = AudioPrep(pad_ms=100)
+    pcm = prep.process(utterance(), SAMPLE_RATE)
+
+    assert len(pcm) < 1.5 * SAMPLE_RATE
+    assert np.abs(pcm).max() > 20000
+
+
+def test_partial_requests_are_counted_separately():
+    prep = AudioPrep()
+    with prep.counting("partial"):
+        prep.prepare(utterance()[:SAMPLE_RATE * 2], SAMPLE_RATE)
+        prep.prepare(utterance()[:SAMPLE_RATE * 2], SAMPLE_RATE)
+    prep.prepare(utterance(), SAMPLE_RATE)
+
+    stats = prep.get_stats()
+    assert stats["requests"] == 1
+    assert stats["seconds_in"] == 3.0
+    assert stats["bytes_in"] == 44 + 3 * SAMPLE_RATE * 2
+    assert stats["partial"]["requests"] == 2
+    assert stats["partial"]["seconds_in"] == 4.0
+
+
+def test_wav_round_trip():
+    pcm = utterance()
+    decoded, sample_rate = decode_wav(encode_wav(pcm, SAMPLE_RATE))
+    assert sample_rate == SAMPLE_RATE
+    assert np.array_equal(decoded, pcm)
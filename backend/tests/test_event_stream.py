@@ -0,0 +1,40 @@
+from event_stream import EventChannel, parse_last_event_id, format_sse
+
+
+def test_since_returns_events_after_last_seen():
+    channel = EventChannel(replay_size=10)
+    for i in range(3):
+        channel.publish("state", value=i)
+
+    assert [event["data"]["value"] for event in channel.since(1)] == [1, 2]
+    assert channel.since(3) == []
+
+
+def test_resume_from_evicted_id_starts_at_oldest_kept_event():
+    channel = EventChannel(replay_size=2)
+    for i in range(5):
+        channel.publish("state", value=i)
+
+    assert [event["seq"] for event in channel.since(1)] == [4, 5]
+
+
+def test_last_event_id_from_before_restart_is_treated_as_new_connection():
+    channel = EventChannel(replay_size=10)
+    channel.publish("reply", text="重啟後的第一則")
+
+    # 重啟前的用戶端帶著較大的序號重連，不能因此漏掉新事件
+    last_seq = channel.resume_point(42)
+    assert last_seq == 0
+    assert [event["data"]["text"] for event in channel.since(last_seq)] == ["重啟後的第一則"]
+    assert channel.resume_point(1) == 1
+
+
+def test_parse_last_event_id():
+    assert parse_last_event_id("7") == 7
+    assert parse_last_event_id(None) == 0
+    assert parse_last_event_id("abc") == 0
+
+
+def test_format_sse_sets_id_for_reconnects():
+    event = EventChannel(replay_size=1).publish("reply", text="你好")
+    assert format_sse(event) == 'id: 1\nevent: reply\ndata: {"seq": 1, "text": "你好"}\n\n'
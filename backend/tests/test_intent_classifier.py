@@ -0,0 +1,45 @@
+from intent_classifier import LocalIntentClassifier, dedupe_examples, normalize_text
+
+EXAMPLES = [
+    ("你好嗎", "聊天"),
+    ("講個笑話給我聽", "聊天"),
+    ("今天台北天氣如何", "查詢"),
+    ("幫我查明天的天氣", "查詢"),
+    ("幫我把便當拿給參賽者", "行動"),
+    ("把杯子拿到床上", "行動"),
+]
+
+
+def test_normalize_text_folds_script_and_punctuation():
+    assert normalize_text("今天天气如何？") == normalize_text("今天天氣如何")
+
+
+def test_dedupe_keeps_first_occurrence_per_normalized_command():
+    examples = [("今天天氣如何？", "查詢"), ("今天天气如何", "聊天"), ("講個笑話", "聊天"), ("今天天氣如何", "查詢")]
+    assert dedupe_examples(examples) == [("今天天氣如何？", "查詢"), ("講個笑話", "聊天")]
+
+
+def test_leave_one_out_after_dedupe_excludes_held_out_command():
+    examples = dedupe_examples(EXAMPLES + [("今天台北天氣如何？", "查詢"), ("今天台北天气如何", "查詢")])
+    held_out = [command for command, _ in examples].index("今天台北天氣如何")
+    model = LocalIntentClassifier(examples[:held_out] + examples[held_out + 1:])
+
+    # 去重後訓練集中不再有同一句的副本，最近鄰不可能是它自己（相似度 1.0）
+    label, confidence = model.predict("今天台北天氣如何")
+    assert label == "查詢"
+    assert confidence < 1.0
+
+
+def test_predict_and_classify_threshold():
+    model = LocalIntentClassifier(EXAMPLES, min_confidence=0.5)
+    assert model.predict("你好嗎")[0] == "聊天"
+    assert model.classify("幫我把便當拿給參賽者") == "行動"
+    assert model.classify("量子力學") is None
+    assert model.get_stats()["total"] == 2
+
+
+def test_learn_adds_example():
+    model = LocalIntentClassifier(EXAMPLES, min_confidence=0.5)
+    model.learn("打開客廳的燈", "行動")
+    assert model.predict("打開客廳的燈")[0] == "行動"
+    assert model.get_stats()["examples"] == len(EXAMPLES) + 1
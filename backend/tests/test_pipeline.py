@@ -0,0 +1,88 @@
+import time
+import threading
+from pipeline import Stage, Pipeline
+
+
+def collect(stage):
+    done = []
+    stage.on_done = lambda item, status: done.append((item, status))
+    return done
+
+
+def test_drop_oldest_counts_each_dropped_item_once():
+    stage = Stage("test", lambda item: None, maxsize=2)
+    done = collect(stage)
+
+    assert all(stage.put(i) for i in range(5))
+    assert stage.dropped == 3
+    assert done == [(0, "dropped"), (1, "dropped"), (2, "dropped")]
+    assert [stage.queue.get_nowait()[1] for _ in range(2)] == [3, 4]
+
+
+def test_drop_newest_rejects_new_item():
+    stage = Stage("test", lambda item: None, maxsize=1, drop_policy="drop_newest")
+    done = collect(stage)
+
+    assert stage.put("a")
+    assert not stage.put("b")
+    assert stage.dropped == 1
+    assert done == [("b", "dropped")]
+
+
+def test_block_times_out_then_drops():
+    stage = Stage("test", lambda item: None, maxsize=1, drop_policy="block", put_timeout=0.05)
+    collect(stage)
+    stage.put("a")
+
+    start = time.time()
+    assert not stage.put("b")
+    assert time.time() - start >= 0.05
+    assert stage.dropped == 1
+
+
+def test_stop_does_not_block_on_full_queue_without_workers():
+    stage = Stage("test", lambda item: None, maxsize=2)
+    done = collect(stage)
+    stage.put(1)
+    stage.put(2)
+
+    start = time.time()
+    stage.stop()
+    assert time.time() - start < 0.5
+    assert done == [(1, "dropped"), (2, "dropped")]
+
+
+def test_stop_with_busy_worker_returns_immediately():
+    release = threading.Event()
+    stage = Stage("test", lambda item: release.wait(2), workers=1, maxsize=1)
+    done = collect(stage)
+    stage.start()
+    stage.put("running")
+    time.sleep(0.05)
+    stage.put("queued")
+    worker = stage._threads[0]
+
+    start = time.time()
+    stage.stop()
+    assert time.time() - start < 0.5
+    release.set()
+    worker.join(2)
+    assert not worker.is_alive()
+    assert ("queued", "dropped") in done
+
+
+def test_pipeline_passes_results_in_order():
+    finished = []
+    pipeline = Pipeline([
+        Stage("double", lambda item: item * 2, maxsize=8, drop_policy="block"),
+        Stage("last", lambda item: item, maxsize=8, drop_policy="block"),
+    ], on_complete=lambda item, status: finished.append((item, status)))
+    pipeline.start()
+    for i in range(5):
+        pipeline.submit(i)
+
+    deadline = time.time() + 2
+    while len(finished) < 5 and time.time() < deadline:
+        time.sleep(0.01)
+    pipeline.stop()
+    assert finished == [(i * 2, "done") for i in range(5)]
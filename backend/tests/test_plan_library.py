@@ -0,0 +1,105 @@
+import json
+import pytest
+from prompt_templates import AssetFile
+from plan_library import PlanLibrary, build_template, is_learnable, task_key
+
+ACTIONS = {"1": "從 A 走到 B", "2": "拿起 A 物體", "3": "放下 A 物體", "6": "按下 A 按鈕",
+           "7": "放開 A 按鈕", "8": "說話，說話內容為 A"}
+
+
+def deliver(item, recipient):
+    return {
+        "動作順序": ["1", "2", "1", "3", "8"],
+        "說明": ["從原點走到使用者位置", f"拿起{item}", f"從使用者位置走到{recipient}位置",
+               f"放下{item}", f"說話，通知{recipient}已送達{item}"],
+    }
+
+
+@pytest.fixture
+def asset(tmp_path):
+    path = tmp_path / "movement_deployment.json"
+    path.write_text(json.dumps({"動作清單": ACTIONS, "任務拆解": []}, ensure_ascii=False), encoding="utf-8")
+    return AssetFile(str(path))
+
+
+def test_task_key_strips_fillers_demonstratives_and_stutters():
+    assert task_key("請幫我把這個便當送給那邊的參賽者好嗎") == "把便當送給參賽者"
+    assert task_key("我把这个便当拿给那边的参赛者") == "把便當拿給參賽者"
+    assert task_key("幫我把杯子拿到拿到床上") == "把杯子拿到床上"
+
+
+def test_build_template_slots_object_and_recipient():
+    template = build_template("把便當送給參賽者", deliver("便當", "參賽者"))
+
+    assert template["signature"] == "把{object}送給{recipient}"
+    assert template["steps"][1] == "拿起{object}"
+    assert template["steps"][2] == "從使用者位置走到{recipient}位置"
+
+
+def test_object_used_as_walk_target_is_not_slotted():
+    plan = {"動作順序": ["1", "2", "1", "3"],
+            "說明": ["從原點走到杯子位置", "拿起杯子", "從杯子位置走到床的位置", "放下杯子"]}
+    template = build_template("把杯子拿到床上", plan)
+
+    assert template["signature"] == "把杯子拿到{destination}上"
+    assert template["steps"][0] == "從原點走到杯子位置"
+
+
+def test_slotted_template_needs_a_literal_verb():
+    plan = {"動作順序": ["1", "2", "1", "3"],
+            "說明": ["從原點走到使用者位置", "拿起杯子", "從使用者位置走到床的位置", "放下杯子"]}
+    assert build_template("杯子床上", plan)["signature"] == "杯子床上"
+
+
+@pytest.mark.parametrize("text, plan", [
+    ("保存", {"動作順序": ["8"], "說明": ["說話，回應用戶'我已收到'"]}),
+    ("寫企業", {"動作順序": ["1", "8"], "說明": ["從原點走到使用者位置", "說話，告知用戶'抱歉，我無法理解這個任務'"]}),
+    (" off.", {"動作順序": ["1", "6"], "說明": ["從當前位置走到控制面板位置", "按下關機按鈕"]}),
+    ("把便當送給參賽者", {**deliver("便當", "參賽者"), "範本": "把{object}送給{recipient}"}),
+])
+def test_failure_and_served_plans_are_not_learnable(text, plan):
+    assert not is_learnable(text, plan)
+
+
+def test_lookup_requires_agreeing_plans(asset):
+    library = PlanLibrary(asset, [("把便當送給參賽者", deliver("便當", "參賽者"))])
+    assert library.lookup("把文件送給老師") is None
+
+    library.learn("把咖啡送給經理", deliver("咖啡", "經理"))
+    plan = library.lookup("請幫我把這份文件送給老師")
+    assert plan["動作順序"] == ["1", "2", "1", "3", "8"]
+    assert plan["說明"][1] == "拿起文件"
+    assert plan["說明"][2] == "從使用者位置走到老師位置"
+    assert plan["範本"] == "把{object}送給{recipient}"
+    assert library.get_stats()["hits"] == 1
+
+
+def test_conflicting_action_orders_disable_template(asset):
+    fetch_water = {"動作順序": ["1", "2", "1", "6", "7", "2", "1", "3", "8"],
+                   "說明": ["從原點走到使用者位置", "拿起水杯", "從使用者位置走到飲水機位置", "按下溫開水按鈕",
+                          "放開溫開水按鈕", "拿起水杯", "從飲水機位置走到床的位置", "放下水杯", "說話，通知使用者"]}
+    carry_water = {"動作順序": ["1", "2", "1", "3", "8"],
+                   "說明": ["從原點走到飲水機位置", "拿起水杯", "從飲水機位置走到床的位置", "放下水杯", "說話，通知使用者"]}
+    library = PlanLibrary(asset, [("把水拿到床上", carry_water), ("把水拿到床上", carry_water)])
+    assert library.lookup("把水拿到床上") is not None
+
+    library.learn("把水拿到床上", fetch_water)
+    library.learn("把水拿到床上", fetch_water)
+    assert library.lookup("把水拿到床上") is None
+
+
+def test_examples_from_asset_are_trusted(tmp_path):
+    path = tmp_path / "movement_deployment.json"
+    example = {"任務": "幫我送這張購買單去給工讀生", **deliver("購買單", "工讀生")}
+    path.write_text(json.dumps({"動作清單": ACTIONS, "任務拆解": [example]}, ensure_ascii=False), encoding="utf-8")
+    library = PlanLibrary(AssetFile(str(path)))
+
+    plan = library.lookup("幫我送這張請購單去給主管")
+    assert plan["說明"][2] == "從使用者位置走到主管位置"
+
+
+def test_lookup_rejects_codes_outside_action_list(asset):
+    plan = {"動作順序": ["1", "9"], "說明": ["從原點走到使用者位置", "跳舞"]}
+    library = PlanLibrary(asset, [("去跳舞", plan), ("去跳舞", plan)])
+    assert library.get_stats()["templates"] == 0
+    assert library.lookup("去跳舞") is None
@@ -0,0 +1,99 @@
+import numpy as np
+from recorder import RingBuffer, RingSlice, UtteranceSegmenter
+from vad import START, END
+
+
+def samples(start, count):
+    return np.arange(start, start + count, dtype=np.int16)
+
+
+def test_view_is_contiguous_across_wrap_around():
+    ring = RingBuffer(8)
+    ring.write(samples(0, 5))
+    ring.write(samples(5, 6))
+
+    assert ring.position == 11
+    assert ring.oldest == 3
+    view = ring.view(3, 11)
+    assert view.tolist() == list(range(3, 11))
+    # 零複製：切片直接指向內部緩衝區
+    assert np.shares_memory(view, ring._buffer)
+
+
+def test_view_clamps_to_retained_samples():
+    ring = RingBuffer(8)
+    ring.write(samples(0, 12))
+
+    assert ring.view(0, 100).tolist() == list(range(4, 12))
+    assert len(ring.view(10, 5)) == 0
+
+
+def test_write_longer_than_capacity_keeps_the_tail():
+    ring = RingBuffer(4)
+    ring.write(samples(0, 10))
+
+    assert ring.position == 10
+    assert ring.view(ring.oldest, ring.position).tolist() == [6, 7, 8, 9]
+
+
+def test_slice_stays_valid_until_overwritten():
+    ring = RingBuffer(8)
+    ring.write(samples(0, 4))
+    utterance = RingSlice(ring, 1, 4)
+
+    ring.write(samples(4, 5))      # 位置 9：從 1 開始的切片剛好還沒被覆蓋
+    assert utterance.valid()
+    assert utterance.data.tolist() == [1, 2, 3]
+
+    ring.write(samples(9, 1))
+    assert not utterance.valid()
+
+
+def test_reset_keeps_positions_monotonic():
+    ring = RingBuffer(8)
+    ring.write(samples(0, 6))
+    old = RingSlice(ring, 0, 6)
+    ring.reset()
+
+    assert ring.position == 6
+    assert ring.oldest == 6
+    assert len(ring.view(0, 6)) == 0
+    ring.write(samples(6, 3))
+    # reset 前交出的切片仍依絕對位置判斷是否被覆蓋
+    assert not old.valid()
+
+
+class ScriptedVad:
+    """依音框編號回傳預先排好的 VAD 事件（位置從 VAD 自己 reset 起算）"""
+
+    chunk_duration = 0.01
+
+    def __init__(self, script):
+        self.script = script
+        self.frames = 0
+
+    def process(self, frame):
+        events = self.script.get(self.frames, [])
+        self.frames += 1
+        return events
+
+
+def test_segmenter_reports_utterance_in_ring_positions():
+    ring = RingBuffer(16000)
+    ring.write(np.zeros(1000, dtype=np.int16))       # 前一個切分器留下的位置
+    vad = ScriptedVad({3: [(START, 480)], 7: [(END, 1120)]})
+    segmenter = UtteranceSegmenter(vad, sample_rate=16000, pre_roll=0.01, ring=ring)
+
+    events = []
+    for i in range(10):
+        events += segmenter.push(np.full(160, i, dtype=np.int16))
+
+    kinds = [kind for kind, _ in events]
+    assert kinds[0] == "start" and kinds[-1] == "end"
+    utterance = segmenter.last_utterance
+    # VAD 位置加上切分器建立時的 origin；句首往前多取 pre_roll（160 個樣本）
+    assert utterance.start == 1000 + 480 - 160
+    assert len(utterance) == 1120 - 480 + 160
+    assert utterance.data.tolist() == ring.view(1320, 2120).tolist()
+    assert np.shares_memory(events[-1][1], utterance.data)
+    assert utterance.valid()
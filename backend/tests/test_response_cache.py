@@ -0,0 +1,90 @@
+import pytest
+import response_cache
+from response_cache import ResponseCache, parse_ttl
+from command_classifier_claude import CommandClassifier
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(response_cache.time, "time", clock)
+    return clock
+
+
+def test_exact_and_normalized_hits(clock):
+    cache = ResponseCache()
+    cache.store("你好嗎？", "聊天", "我很好")
+
+    assert cache.lookup("你好嗎？") == ("聊天", "我很好", "exact")
+    # 簡體、去掉標點後相同
+    assert cache.lookup("你好吗") == ("聊天", "我很好", "normalized")
+    assert cache.lookup("今天天氣") == (None, None, "miss")
+
+
+def test_entries_expire_by_type_ttl(clock):
+    cache = ResponseCache(ttl={"聊天": 100, "查詢": 10, "行動": 0})
+    cache.store("講個笑話", "聊天", "笑話")
+    cache.store("台北天氣", "查詢", "晴天")
+    cache.store("去廚房", "行動", "好")
+
+    clock.now += 11
+    assert cache.lookup("台北天氣")[2] == "miss"
+    assert cache.lookup("講個笑話")[2] == "exact"
+    assert cache.lookup("去廚房")[2] == "miss"
+    clock.now += 100
+    assert cache.lookup("講個笑話")[2] == "miss"
+
+
+def test_near_duplicate_matching(clock):
+    cache = ResponseCache(similarity=0.5)
+    cache.store("告訴我一個關於貓的笑話", "聊天", "貓的笑話")
+
+    assert cache.lookup("告訴我一個關於貓咪的笑話") == ("聊天", "貓的笑話", "similar")
+    assert cache.lookup("今天台北的天氣如何")[2] == "miss"
+    assert ResponseCache(similarity=0.0).lookup("告訴我一個關於貓咪的笑話")[2] == "miss"
+
+
+def test_parse_ttl_overrides_defaults():
+    ttl = parse_ttl("查詢=60, 行動=5")
+    assert ttl["查詢"] == 60 and ttl["行動"] == 5 and ttl["聊天"] == 24 * 3600
+
+
+class History:
+    def __init__(self):
+        self.records = []
+
+    def append(self, kind, record):
+        self.records.append((kind, record))
+
+
+@pytest.fixture
+def classifier(clock):
+    classifier = CommandClassifier.__new__(CommandClassifier)
+    classifier.response_cache = ResponseCache()
+    classifier.history = History()
+    return classifier
+
+
+def test_turn_history_fills_cache_on_miss(classifier):
+    classifier.save_turn_history("講個笑話", "笑話一則", "聊天", {"cache": "miss"})
+    assert classifier.response_cache.lookup("講個笑話")[1] == "笑話一則"
+    assert classifier.history.records[0][0] == "chat"
+
+
+@pytest.mark.parametrize("response, extra", [
+    ("前半句", {"cache": "miss", "cancelled": True}),
+    ("好的，我來說。無法獲取模型回應", {"cache": "miss"}),
+])
+def test_cancelled_or_failed_replies_are_not_cached(classifier, response, extra):
+    classifier.save_turn_history("講個笑話", response, "聊天", extra)
+    assert classifier.response_cache.lookup("講個笑話")[2] == "miss"
+    # 歷史紀錄仍然保存
+    assert classifier.history.records[0][1]["response"] == response
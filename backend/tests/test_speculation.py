@@ -0,0 +1,63 @@
+from speculation import SpeculativeClassifier
+
+
+class FakeClassifier:
+    def __init__(self):
+        self.calls = []
+
+    def classify_command(self, text, learn=True, mode="two_call"):
+        self.calls.append((text, learn, mode))
+        return "查詢" if "天氣" in text else "聊天"
+
+    def retrieve(self, text):
+        return [text]
+
+
+def speculator(classifier):
+    return SpeculativeClassifier(classifier, min_chars=4, stable_ratio=0.9, match_ratio=0.8, max_attempts=3)
+
+
+def test_speculative_classify_is_recorded_under_its_own_mode():
+    classifier = FakeClassifier()
+    spec = speculator(classifier)
+    spec.observe("今天台北", 1)
+    spec.observe("今天台北天氣", 1)
+
+    speculation = spec.take("今天台北天氣", 1)
+    assert spec.command_type(speculation) == "查詢"
+    assert classifier.calls == [("今天台北天氣", False, "speculative")]
+
+
+def test_next_utterance_partials_do_not_replace_pending_speculation():
+    spec = speculator(FakeClassifier())
+    spec.observe("今天台北", 1)
+    spec.observe("今天台北天氣", 1)
+    # 第 1 句還在收尾執行緒上等最終辨識，第 2 句的部分結果已經送達
+    spec.observe("講個笑話", 2)
+    spec.observe("講個笑話給我聽", 2)
+
+    first = spec.take("今天台北天氣", 1)
+    assert first is not None and first.text == "今天台北天氣"
+    second = spec.take("講個笑話給我聽", 2)
+    assert second is not None and second.text == "講個笑話給我聽"
+    assert spec.get_stats()["hits"] == 2
+
+
+def test_take_does_not_hand_out_another_utterances_speculation():
+    spec = speculator(FakeClassifier())
+    spec.observe("講個笑話", 2)
+    spec.observe("講個笑話給我聽", 2)
+
+    assert spec.take("講個笑話給我聽", 1) is None
+    assert spec.take("講個笑話給我聽", 2) is not None
+
+
+def test_take_clears_older_abandoned_utterances():
+    spec = speculator(FakeClassifier())
+    spec.observe("今天台北", 1)
+    spec.observe("今天台北天氣", 1)
+    spec.observe("講個笑話", 2)
+    spec.observe("講個笑話給我聽", 2)
+
+    spec.take("講個笑話給我聽", 2)
+    assert spec.take("今天台北天氣", 1) is None
@@ -0,0 +1,54 @@
+import os
+import pytest
+from tts_cache import AudioCache
+
+
+def key(text):
+    return AudioCache.make_key(text, "Zhiyu", "cmn-CN", "100%")
+
+
+def test_put_writes_final_file_without_leftovers(tmp_path):
+    cache = AudioCache(str(tmp_path))
+    cache.put(key("你好"), b"mp3-data")
+
+    assert os.listdir(tmp_path) == [f"tts_{key('你好')}.mp3"]
+    assert AudioCache(str(tmp_path)).get(key("你好")) == b"mp3-data"
+
+
+def test_failed_write_keeps_previous_file(tmp_path, monkeypatch):
+    cache = AudioCache(str(tmp_path))
+    cache.put(key("你好"), b"old")
+
+    def fail(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail)
+    cache.put(key("你好"), b"new-but-truncated")
+
+    # 舊檔完整保留，暫存檔已清掉
+    assert os.listdir(tmp_path) == [f"tts_{key('你好')}.mp3"]
+    assert (tmp_path / f"tts_{key('你好')}.mp3").read_bytes() == b"old"
+
+
+def test_leftover_temp_files_are_removed_and_not_indexed(tmp_path):
+    (tmp_path / f".tts_{key('你好')}.abc.part").write_bytes(b"half")
+    cache = AudioCache(str(tmp_path))
+
+    assert os.listdir(tmp_path) == []
+    assert cache.get(key("你好")) is None
+
+
+def test_disk_eviction_removes_least_recently_used(tmp_path):
+    cache = AudioCache(str(tmp_path), max_disk_bytes=10)
+    cache.put(key("一"), b"123456")
+    cache.put(key("二"), b"123456")
+
+    assert cache.evictions == 1
+    assert os.listdir(tmp_path) == [f"tts_{key('二')}.mp3"]
+
+
+@pytest.mark.parametrize("audio", [b"", None])
+def test_empty_audio_is_not_cached(tmp_path, audio):
+    cache = AudioCache(str(tmp_path))
+    cache.put(key("你好"), audio)
+    assert os.listdir(tmp_path) == []
@@ -1,28 +1,51 @@
 import os
 import io
+import time
 import json
+import queue
+import threading
 import requests
+import numpy as np
 from datetime import datetime
 import pygame
-from dotenv import load_dotenv
 import base64
-import boto3
+from aws_clients import get_client
+from tts_cache import AudioCache
+from time_stretch import StretchPlayer
+import contextvars
+import tracing
+import startup
 
 
 
 # ✅ 加載環境變量（正確路徑）
-env_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'config', '.env'))
-load_dotenv(env_path)
+startup.load_env()
+
+SENTENCE_ENDINGS = "。！？!?；\n"
+
+
+def split_sentences(chunks, min_length=4):
+    """把逐段產生的文字切成句子：遇到中文句尾標點就送出一句
+
+    太短的句子（如「好。」）會與下一句合併，避免過多零碎的 Polly 呼叫。
+    """
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        start = 0
+        for i, ch in enumerate(buffer):
+            if ch in SENTENCE_ENDINGS and len(buffer[start:i + 1].strip()) >= min_length:
+                yield buffer[start:i + 1].strip()
+                start = i + 1
+        buffer = buffer[start:]
+    if buffer.strip():
+        yield buffer.strip()
+
 
 class ResponseSpeaker:
     def __init__(self):
-        # 設置 AWS Polly 客戶端
-        self.client = boto3.client(
-            "polly",
-            region_name="us-east-1",
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-        )
+        # 設置 AWS Polly 客戶端（共用連線池）
+        self.client = get_client("polly", "us-east-1")
 
         self.voice_id = "Zhiyu"  # 中文女聲
         self.language_code = "cmn-CN"
@@ -30,46 +53,220 @@ class ResponseSpeaker:
         self.current_rate = "100%"
 
         pygame.mixer.init()
+        self._cancel = threading.Event()
+        self.last_first_audio_latency = None
+        # 目前播放的 mp3 與開始時間；回音抑制用它的能量包絡當參考訊號（第一次用到時才解碼）
+        self._playing = (0.0, None)
+        self._reference = (None, None)
+        # 本地變速：Polly 一律以正常語速合成，語速在播放端以 WSOLA 調整，播放中改語速立即生效
+        self.stretch = StretchPlayer() if os.getenv('TTS_TIME_STRETCH', '1') == '1' else None
+        self._stretching = False
 
-        # ✅ 設定 audio_output 資料夾為絕對路徑
+        # ✅ 設定 audio_output 資料夾為絕對路徑，作為語音快取的磁碟層
         self.audio_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'audio_output'))
         os.makedirs(self.audio_dir, exist_ok=True)
+        self.cache = None
+        if os.getenv('TTS_CACHE', '1') == '1':
+            self.cache = AudioCache(
+                self.audio_dir,
+                max_memory_bytes=int(os.getenv('TTS_CACHE_MEMORY_MB', '16')) * 1024 * 1024,
+                max_disk_bytes=int(os.getenv('TTS_CACHE_DISK_MB', '200')) * 1024 * 1024,
+            )
 
     def set_rate(self, rate):
-        """設定播放速度"""
+        """設定播放速度（本地變速時連正在播放的這句也一起改）"""
         self.current_rate = rate
+        if self.stretch:
+            self.stretch.set_rate(rate)
         print(f"🎚️ 已設定播放速度為：{rate}")
 
     
     def speak(self, text):
         """用 Polly 直接朗讀文字，不存檔"""
+        audio_stream = self.synthesize(text)
+        if audio_stream:
+            self.play(audio_stream, text)
+
+    def synthesize(self, text, rate=None):
+        """呼叫 Polly 合成語音，回傳 mp3 位元組（先查快取）"""
         if not text:
             print("⚠️ 沒有文字內容，跳過朗讀")
-            return
+            return None
+
+        rate = rate or ("100%" if self.stretch else self.current_rate)
+        key = None
+        if self.cache:
+            key = AudioCache.make_key(text, self.voice_id, self.language_code, rate)
+            audio_stream = self.cache.get(key)
+            if audio_stream:
+                return audio_stream
         try:
-            ssml_text = f'<speak><prosody rate="{self.current_rate}">{text}</prosody></speak>'
-            response = self.client.synthesize_speech(
-                Text=ssml_text,
-                OutputFormat=self.output_format,
-                VoiceId=self.voice_id,
-                LanguageCode=self.language_code,
-                TextType="ssml"
-            )
-            audio_stream = response["AudioStream"].read()
-            pygame.mixer.music.load(io.BytesIO(audio_stream))
-            pygame.mixer.music.play()
-            print(f"🔊 Polly 開始朗讀（語速 {self.current_rate}）：{text}")
+            ssml_text = f'<speak><prosody rate="{rate}">{text}</prosody></speak>'
+            with tracing.span("polly", chars=len(text)):
+                response = self.client.synthesize_speech(
+                    Text=ssml_text,
+                    OutputFormat=self.output_format,
+                    VoiceId=self.voice_id,
+                    LanguageCode=self.language_code,
+                    TextType="ssml"
+                )
+                audio_stream = response["AudioStream"].read()
+            if self.cache:
+                self.cache.put(key, audio_stream)
+            return audio_stream
         except Exception as e:
             print(f"⚠️ Polly 語音合成錯誤：{e}")
+            return None
+
+    def synthesize_pcm(self, text, rate=None, sample_rate=16000):
+        """合成 16-bit 單聲道 PCM（numpy int16），供本地關鍵字範本等不經播放的用途；不走快取"""
+        try:
+            ssml_text = f'<speak><prosody rate="{rate or self.current_rate}">{text}</prosody></speak>'
+            with tracing.span("polly", chars=len(text), format="pcm"):
+                response = self.client.synthesize_speech(
+                    Text=ssml_text,
+                    OutputFormat="pcm",
+                    SampleRate=str(sample_rate),
+                    VoiceId=self.voice_id,
+                    LanguageCode=self.language_code,
+                    TextType="ssml"
+                )
+                data = response["AudioStream"].read()
+            return np.frombuffer(data[:len(data) - len(data) % 2], dtype=np.int16)
+        except Exception as e:
+            print(f"⚠️ Polly PCM 合成錯誤：{e}")
+            return None
+
+    def play(self, audio_stream, text=""):
+        """播放已合成的 mp3 位元組"""
+        if self.stretch:
+            try:
+                with tracing.span("playback_start", stretch=True):
+                    self.stretch.play(audio_stream)
+                self._stretching = True
+                print(f"🔊 Polly 開始朗讀（語速 {self.current_rate}）：{text}")
+                return
+            except Exception as e:
+                print(f"⚠️ 無法解碼為 PCM，改用一般播放：{e}")
+        self._stretching = False
+        try:
+            with tracing.span("playback_start"):
+                pygame.mixer.music.load(io.BytesIO(audio_stream))
+                pygame.mixer.music.set_volume(1.0)
+                pygame.mixer.music.play()
+                self._playing = (time.time(), audio_stream)
+            # 回音抑制的參考包絡在背景解碼，不佔用錄音執行緒
+            threading.Thread(target=self._decode_reference, args=(audio_stream,), daemon=True).start()
+            print(f"🔊 Polly 開始朗讀（語速 {self.current_rate}）：{text}")
+        except Exception as e:
+            print(f"⚠️ 音訊播放錯誤：{e}")
+
+    def wait_until_done(self, poll_interval=0.05):
+        """阻塞直到目前的音訊播放完畢"""
+        while self.check_audio():
+            time.sleep(poll_interval)
+
+    def speak_stream(self, sentences, on_first_audio=None):
+        """邊生成邊朗讀：背景合成下一句的同時播放目前這句
+
+        sentences 為逐句產生的文字（例如 split_sentences 的輸出）；
+        第一句開始播放時呼叫 on_first_audio(秒數)。回傳 (完整生成文字, 是否被中止)：
+        被「停」或插話中止時，剩下的句子只收集文字、不再合成，回傳的仍是模型生成的完整回覆。
+        """
+        self._cancel.clear()
+        start = time.time()
+        audio_queue = queue.Queue(maxsize=2)
+        generated = []
+
+        def synthesize_all():
+            for sentence in sentences:
+                generated.append(sentence)
+                if not self._cancel.is_set():
+                    audio_queue.put((sentence, self.synthesize(sentence)))
+            audio_queue.put(None)
+
+        # 合成執行緒沿用呼叫端的追蹤內容，LLM／Polly 的 span 才會記在同一輪
+        threading.Thread(target=contextvars.copy_context().run, args=(synthesize_all,), daemon=True).start()
+
+        first = True
+        while True:
+            item = audio_queue.get()
+            if item is None:
+                break
+            sentence, audio_stream = item
+            if self._cancel.is_set() or not audio_stream:
+                continue
+            self.wait_until_done()
+            if self._cancel.is_set():
+                continue
+            self.play(audio_stream, sentence)
+            if first:
+                first = False
+                self.last_first_audio_latency = time.time() - start
+                print(f"⏱️ 首句開始播放：{self.last_first_audio_latency:.2f}s")
+                if on_first_audio:
+                    on_first_audio(self.last_first_audio_latency)
+
+        return "".join(generated), self._cancel.is_set()
+
+    def prewarm(self, phrases, rates=("100%",)):
+        """預先合成常用句子放進快取（建議在背景執行緒呼叫）"""
+        if not self.cache:
+            return
+        for rate in rates:
+            for text in phrases:
+                self.synthesize(text, rate=rate)
+        print(f"🔥 語音快取預熱完成：{len(phrases) * len(rates)} 句")
 
     def stop_audio(self):
         """中止音訊播放"""
+        self._cancel.set()
+        if self.stretch and self.stretch.busy():
+            self.stretch.stop()
+            print("音訊播放已中止")
         if pygame.mixer.music.get_busy():
             pygame.mixer.music.stop()
             print("音訊播放已中止")
 
     def check_audio(self):
-        return pygame.mixer.music.get_busy()
+        return pygame.mixer.music.get_busy() or bool(self.stretch and self.stretch.busy())
+
+    def _decode_reference(self, audio_stream, hop=0.01):
+        """把一般播放的 mp3 解碼成每 hop 秒的能量包絡，供 playback_reference 使用"""
+        envelope = None
+        try:
+            sound = pygame.mixer.Sound(file=io.BytesIO(audio_stream))
+            frequency = pygame.mixer.get_init()[0]
+            samples = pygame.sndarray.array(sound).astype(np.float32)
+            samples = samples.reshape(len(samples), -1).mean(axis=1)
+            size = int(frequency * hop)
+            count = len(samples) // size
+            frames = samples[:count * size].reshape(count, size)
+            envelope = 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-6)
+        except Exception as e:
+            print(f"⚠️ 無法解碼播放參考訊號：{e}")
+        self._reference = (audio_stream, envelope)
+
+    def playback_reference(self, hop=0.01):
+        """回傳 (開始時間, 每 hop 秒的能量包絡 dB 或 None, hop)；背景解碼尚未完成或失敗時包絡為 None"""
+        if self._stretching:
+            return self.stretch.reference(hop)
+        start, audio_stream = self._playing
+        cached_stream, envelope = self._reference
+        if audio_stream is not cached_stream:
+            envelope = None
+        return start, envelope, hop
+
+    def duck(self, volume=0.2):
+        """暫時降低播放音量（插話時）"""
+        pygame.mixer.music.set_volume(volume)
+        if self.stretch:
+            self.stretch.set_volume(volume)
+
+    def restore_volume(self):
+        pygame.mixer.music.set_volume(1.0)
+        if self.stretch:
+            self.stretch.set_volume(1.0)
 
 def main():
     speaker = ResponseSpeaker()
@@ -0,0 +1,216 @@
+import os
+import io
+import time
+import threading
+import numpy as np
+import pygame
+
+
+def parse_rate(rate):
+    """把 "130%"、"1.3" 或 1.3 轉成播放速度倍率（限制在 0.5～2.0）"""
+    if isinstance(rate, str):
+        rate = rate.strip()
+        rate = float(rate[:-1]) / 100 if rate.endswith("%") else float(rate)
+    return min(2.0, max(0.5, float(rate)))
+
+
+class WSOLA:
+    """WSOLA（波形相似重疊相加）變速不變調：逐段產生輸出，每段都可以用不同的倍率
+
+    輸出以 hop（半個音框）為單位前進，輸入則前進 hop × 倍率；每個音框在目標位置前後 tolerance 內
+    找與上一框「自然延續」最相似的位置再重疊相加，波形才接得上，音高不變。
+    """
+
+    def __init__(self, samples, sample_rate, frame_ms=40, tolerance_ms=10, decimate=4):
+        self.samples = np.asarray(samples, dtype=np.float32)
+        self.sample_rate = sample_rate
+        self.frame = int(sample_rate * frame_ms / 1000) // 2 * 2
+        self.hop = self.frame // 2
+        self.tolerance = int(sample_rate * tolerance_ms / 1000)
+        # 相似度搜尋只看每 decimate 個樣本，運算量少一個數量級，對位誤差仍小於 0.1 ms
+        self.decimate = decimate
+        # 週期性 Hann 窗在 50% 重疊時總和恰為 1，倍率 1.0 時輸出與原音相同
+        self.window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(self.frame) / self.frame)).astype(np.float32)
+        pad = self.tolerance + self.frame
+        self._padded = np.concatenate([np.zeros(pad, np.float32), self.samples, np.zeros(pad + self.hop, np.float32)])
+        self._pad = pad
+        self.position = 0.0
+        self.finished = False
+        self._natural = None
+        self._tail = np.zeros(self.hop, np.float32)
+
+    def _segment(self, start):
+        start += self._pad
+        return self._padded[start:start + self.frame]
+
+    def _best_offset(self, target):
+        start = target - self.tolerance + self._pad
+        region = self._padded[start:start + self.frame + 2 * self.tolerance]
+        step = self.decimate
+        scores = np.correlate(region[::step], self._natural[::step], mode='valid')
+        return int(np.argmax(scores)) * step - self.tolerance
+
+    def read(self, count, rate=1.0):
+        """以倍率 rate 產生約 count 個輸出樣本（hop 的整數倍）；素材用完時回傳較短或空的陣列"""
+        out = []
+        produced = 0
+        while produced < count and not self.finished:
+            target = int(round(self.position))
+            if target >= len(self.samples):
+                out.append(self._tail)
+                self.finished = True
+                break
+            start = target if self._natural is None else target + self._best_offset(target)
+            frame = self._segment(start) * self.window
+            out.append(self._tail + frame[:self.hop])
+            self._tail = frame[self.hop:]
+            self._natural = self._segment(start + self.hop)
+            self.position += self.hop * rate
+            produced += self.hop
+        return np.concatenate(out) if out else np.zeros(0, np.float32)
+
+    def remaining(self, rate=1.0):
+        """以目前倍率估計還要播放的秒數"""
+        return max(0.0, len(self.samples) - self.position) / rate / self.sample_rate
+
+
+def decode_mp3(audio_stream):
+    """把 mp3 位元組解碼成混音器取樣率的單聲道 float32（-1～1）；需先 pygame.mixer.init()"""
+    sound = pygame.mixer.Sound(file=io.BytesIO(audio_stream))
+    samples = pygame.sndarray.array(sound).astype(np.float32)
+    return samples.reshape(len(samples), -1).mean(axis=1) / 32768.0
+
+
+class StretchPlayer:
+    """本地變速播放：mp3 只解碼一次，之後以 pygame Channel 逐段排隊播放
+
+    每段（chunk_ms）在送進佇列前才依目前倍率做 WSOLA，所以 set_rate 最晚在兩段之後生效，不必重新呼叫 Polly。
+    同時記下實際送出的音訊每 10 ms 的能量包絡，供插話的回音抑制當參考訊號。
+    """
+
+    def __init__(self, chunk_ms=None, channel=0):
+        self.chunk_s = (chunk_ms or int(os.getenv('TTS_STRETCH_CHUNK_MS', '100'))) / 1000
+        self.channel_id = channel
+        self.rate = 1.0
+        self.start_time = 0.0
+        self.underruns = 0
+        self._channel = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._envelope = []
+        self._level_rest = np.zeros(0, np.float32)
+
+    def set_rate(self, rate):
+        self.rate = parse_rate(rate)
+
+    def play(self, audio_stream):
+        """解碼 mp3 並開始播放（中止目前播放）；解碼失敗時拋出例外，由呼叫端改用一般播放"""
+        samples = decode_mp3(audio_stream)
+        self.stop()
+        if self._channel is None:
+            # 保留這個聲道給朗讀，其他 Sound.play() 不會搶走
+            pygame.mixer.set_reserved(self.channel_id + 1)
+            self._channel = pygame.mixer.Channel(self.channel_id)
+        self._channel.set_volume(1.0)
+        self._envelope = []
+        self._level_rest = np.zeros(0, np.float32)
+        self._stop = threading.Event()
+        stretcher = WSOLA(samples, pygame.mixer.get_init()[0])
+        self._thread = threading.Thread(target=self._feed, args=(stretcher, self._stop), daemon=True)
+        self._thread.start()
+
+    def _feed(self, stretcher, stop):
+        channels = pygame.mixer.get_init()[2]
+        chunk = int(stretcher.sample_rate * self.chunk_s)
+        emitted = 0.0
+        while not stop.is_set():
+            # 正在播放且佇列已有下一段：等它開始播再產生，讓語速變更儘快生效
+            if self._channel.get_busy() and self._channel.get_queue() is not None:
+                time.sleep(0.01)
+                continue
+            block = stretcher.read(chunk, self.rate)
+            if not len(block):
+                break
+            self._track_level(block, stretcher.sample_rate)
+            pcm = (np.clip(block, -1.0, 1.0) * 32767).astype(np.int16)
+            sound = pygame.sndarray.make_sound(np.ascontiguousarray(np.repeat(pcm[:, None], channels, axis=1)))
+            if stop.is_set():
+                break
+            if self._channel.get_busy():
+                self._channel.queue(sound)
+            else:
+                if emitted:
+                    self.underruns += 1
+                # 時間軸以實際開播時間對齊（中途斷音時也跟著平移）
+                self.start_time = time.time() - emitted
+                self._channel.play(sound)
+            emitted += len(block) / stretcher.sample_rate
+
+    def _track_level(self, block, sample_rate, hop=0.01):
+        samples = np.concatenate([self._level_rest, block])
+        size = int(sample_rate * hop)
+        count = len(samples) // size
+        frames = samples[:count * size].reshape(count, size) * 32768.0
+        self._envelope.extend(10 * np.log10(np.mean(frames * frames, axis=1) + 1e-6))
+        self._level_rest = samples[count * size:]
+
+    def reference(self, hop=0.01):
+        """回傳 (開始時間, 已送出音訊每 hop 秒的能量包絡 dB, hop)"""
+        return self.start_time, np.array(self._envelope), hop
+
+    def busy(self):
+        return (self._thread is not None and self._thread.is_alive()) or \
+            (self._channel is not None and self._channel.get_busy())
+
+    def set_volume(self, volume):
+        if self._channel is not None:
+            self._channel.set_volume(volume)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=1.0)
+        if self._channel is not None:
+            self._channel.stop()
+
+
+def main():
+    """python time_stretch.py [mp3 ...]：量測各倍率的 WSOLA 處理速度；加 --play 時播放並在中途切換語速"""
+    import argparse
+    parser = argparse.ArgumentParser(description="本地變速不變調播放測試")
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('--rates', type=float, nargs='+', default=[0.8, 1.0, 1.3])
+    parser.add_argument('--play', action='store_true', help="實際播放，播到一半時切換到下一個倍率")
+    args = parser.parse_args()
+
+    audio_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'audio_output'))
+    files = args.files or sorted(os.path.join(audio_dir, name) for name in os.listdir(audio_dir) if name.endswith('.mp3'))[:3]
+    pygame.mixer.init()
+    frequency = pygame.mixer.get_init()[0]
+    for path in files:
+        with open(path, 'rb') as f:
+            audio_stream = f.read()
+        samples = decode_mp3(audio_stream)
+        duration = len(samples) / frequency
+        for rate in args.rates:
+            stretcher = WSOLA(samples, frequency)
+            start = time.perf_counter()
+            output = stretcher.read(len(samples) * 4, rate)
+            elapsed = time.perf_counter() - start
+            print(f"{os.path.basename(path)} ×{rate}: {duration:.2f}s → {len(output) / frequency:.2f}s，"
+                  f"處理 {elapsed * 1000:.0f} ms（{duration / elapsed:.0f} 倍即時）")
+
+        if args.play:
+            player = StretchPlayer()
+            player.play(audio_stream)
+            for rate in args.rates:
+                print(f"▶️ 語速 ×{rate}")
+                player.set_rate(rate)
+                time.sleep(duration / len(args.rates))
+            while player.busy():
+                time.sleep(0.05)
+            print(f"斷音次數：{player.underruns}")
+
+
+if __name__ == "__main__":
+    main()
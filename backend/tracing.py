@@ -0,0 +1,184 @@
+import os
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+from history_store import get_writer
+
+# 直方圖的桶邊界（秒）：涵蓋 1 ms 的本地運算到數秒的模型呼叫
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current = contextvars.ContextVar("turn_trace", default=None)
+
+
+class Trace:
+    """一輪對話（一句話）的追蹤紀錄：turn_id 與依序完成的各個 span"""
+
+    def __init__(self, turn_id=None, **attrs):
+        self.turn_id = turn_id or uuid.uuid4().hex[:12]
+        self.start = time.time()
+        self.attrs = attrs
+        self.spans = []
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def add(self, name, duration, offset=None, **attrs):
+        """加入一個已完成的 span；offset 為相對於本輪開始的秒數"""
+        if offset is None:
+            offset = time.time() - self.start - duration
+        with self._lock:
+            self.spans.append({"name": name, "offset": round(offset, 4), "duration": round(duration, 4), **attrs})
+
+    def to_dict(self, status):
+        return {
+            "turn_id": self.turn_id,
+            "start": self.start,
+            "duration": round(time.time() - self.start, 4),
+            "status": status,
+            **self.attrs,
+            "spans": list(self.spans),
+        }
+
+    def summary(self):
+        """依耗時排序的一行摘要，方便看出慢的一輪時間花在哪"""
+        parts = sorted(self.spans, key=lambda span: -span["duration"])
+        return " | ".join(f"{span['name']} {span['duration']:.2f}s" for span in parts)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+    """行程內的指標：各 span 與整輪的延遲直方圖、錯誤與結果計數；以 Prometheus 文字格式輸出"""
+
+    def __init__(self):
+        self.spans = {}
+        self.turns = {}
+        self.turn_latency = Histogram()
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def observe_span(self, name, duration, error=False):
+        with self._lock:
+            self.spans.setdefault(name, Histogram()).observe(duration)
+            if error:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def observe_turn(self, duration, status):
+        with self._lock:
+            self.turns[status] = self.turns.get(status, 0) + 1
+            if status == "done":
+                self.turn_latency.observe(duration)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            lines += ["# HELP voice_span_seconds 各處理步驟的耗時", "# TYPE voice_span_seconds histogram"]
+            for name, histogram in sorted(self.spans.items()):
+                lines += _histogram_lines("voice_span_seconds", histogram, f'span="{name}"')
+            lines += ["# HELP voice_turn_seconds 一輪對話從句尾到處理完成的耗時", "# TYPE voice_turn_seconds histogram"]
+            lines += _histogram_lines("voice_turn_seconds", self.turn_latency)
+            lines += ["# HELP voice_turns_total 依結果分類的對話輪數", "# TYPE voice_turns_total counter"]
+            for status, count in sorted(self.turns.items()):
+                lines.append(f'voice_turns_total{{status="{status}"}} {count}')
+            lines += ["# HELP voice_span_errors_total 各步驟拋出例外的次數", "# TYPE voice_span_errors_total counter"]
+            for name, count in sorted(self.errors.items()):
+                lines.append(f'voice_span_errors_total{{span="{name}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(metric, histogram, labels=""):
+    prefix = f"{labels}," if labels else ""
+    lines = []
+    for bound, count in zip(BUCKETS, histogram.counts):
+        lines.append(f'{metric}_bucket{{{prefix}le="{bound}"}} {count}')
+    lines.append(f'{metric}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+    suffix = f"{{{labels}}}" if labels else ""
+    lines.append(f"{metric}_sum{suffix} {histogram.sum:.6f}")
+    lines.append(f"{metric}_count{suffix} {histogram.count}")
+    return lines
+
+
+def format_gauges(metric, help_text, samples, metric_type="gauge"):
+    """把 {標籤字串: 數值} 轉成 Prometheus 文字格式（供 app 附加管線佇列深度等指標）"""
+    lines = [f"# HELP {metric} {help_text}", f"# TYPE {metric} {metric_type}"]
+    lines += [f"{metric}{{{labels}}} {value}" for labels, value in samples.items()]
+    return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+# 追蹤紀錄寫到 data/history/trace.jsonl（TRACE_LOG=1 時）；超過 TRACE_SLOW_TURN 秒的一輪印出摘要
+trace_log = os.getenv('TRACE_LOG', '0') == '1'
+slow_turn = float(os.getenv('TRACE_SLOW_TURN', '3.0'))
+
+
+def start_turn(**attrs):
+    return Trace(**attrs)
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def activate(trace):
+    """在這個執行緒（或協程）中把 trace 設為目前的一輪；之後的 span 都記在它底下"""
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name, **attrs):
+    """計時一個步驟：一定記入指標；有目前的一輪時同時記入該輪的追蹤紀錄"""
+    trace = _current.get()
+    start = time.perf_counter()
+    error = False
+    try:
+        yield attrs
+    except GeneratorExit:
+        # 串流產生器被提早關閉（例如「停」中斷朗讀）不算錯誤
+        raise
+    except BaseException:
+        error = True
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        metrics.observe_span(name, duration, error)
+        if trace is not None:
+            trace.add(name, duration, **({"error": True, **attrs} if error else attrs))
+
+
+def record(name, duration, trace=None, offset=None, **attrs):
+    """記錄在別處量好的耗時（例如 VAD 句尾判定延遲）：記入指標，並加到 trace（預設為目前的一輪）"""
+    metrics.observe_span(name, duration)
+    trace = trace or _current.get()
+    if trace is not None:
+        trace.add(name, duration, offset=offset, **attrs)
+
+
+def finish(trace, status="done"):
+    """結束一輪：記入整輪延遲、視設定寫入追蹤紀錄；重複呼叫只算第一次"""
+    if trace is None or trace.finished:
+        return
+    trace.finished = True
+    data = trace.to_dict(status)
+    metrics.observe_turn(data["duration"], status)
+    if status == "done" and data["duration"] >= slow_turn:
+        print(f"🐢 [{trace.turn_id}] 這輪花了 {data['duration']:.2f}s：{trace.summary()}")
+    if trace_log:
+        get_writer().append('trace', data)
@@ -0,0 +1,143 @@
+import os
+import glob
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class AudioCache:
+    """Polly 語音快取：記憶體 LRU + 磁碟兩層，以 (文字, 聲音, 語言, 語速) 為鍵
+
+    磁碟檔案存成 data/audio_output/tts_<sha256>.mp3，總容量超過 max_disk_bytes 時
+    刪除最久未使用的檔案；記憶體層超過 max_memory_bytes 時淘汰最久未使用的項目。
+    """
+
+    def __init__(self, cache_dir, max_memory_bytes=16 * 1024 * 1024, max_disk_bytes=200 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        # 上次中斷時留下的暫存檔
+        for path in glob.glob(os.path.join(cache_dir, '.tts_*.part')):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        # 依最後存取時間重建磁碟索引（舊→新）
+        files = glob.glob(os.path.join(cache_dir, 'tts_*.mp3'))
+        for path in sorted(files, key=os.path.getmtime):
+            size = os.path.getsize(path)
+            self._disk[os.path.basename(path)[4:-4]] = size
+            self._disk_bytes += size
+
+    @staticmethod
+    def make_key(text, voice_id, language_code, rate):
+        raw = f"{voice_id}|{language_code}|{rate}|{text}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"tts_{key}.mp3")
+
+    def get(self, key):
+        """回傳快取的 mp3 位元組，沒有則回傳 None"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+            on_disk = key in self._disk
+
+        if on_disk:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    audio = f.read()
+                os.utime(self._path(key))
+            except OSError:
+                audio = None
+            if audio:
+                with self._lock:
+                    self.disk_hits += 1
+                    if key in self._disk:
+                        self._disk.move_to_end(key)
+                    self._remember(key, audio)
+                return audio
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, audio):
+        """寫入兩層快取"""
+        if not audio:
+            return
+        # 先寫到同一資料夾的暫存檔再 os.replace：其他執行緒或行程不會讀到寫一半的 mp3，中斷也不會留下截斷的快取
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=f".tts_{key}.", suffix=".part", dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(audio)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            print(f"⚠️ 語音快取寫入失敗：{e}")
+            if tmp_path and os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return
+
+        with self._lock:
+            self._remember(key, audio)
+            if key in self._disk:
+                self._disk_bytes -= self._disk.pop(key)
+            self._disk[key] = len(audio)
+            self._disk_bytes += len(audio)
+            stale = []
+            while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+                old_key, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                self.evictions += 1
+                stale.append(old_key)
+
+        for old_key in stale:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def _remember(self, key, audio):
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = audio
+        self._memory_bytes += len(audio)
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            _, old = self._memory.popitem(last=False)
+            self._memory_bytes -= len(old)
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,240 @@
+import os
+import sys
+import glob
+import numpy as np
+
+# 事件種類：說話開始、說話中出現停頓、停頓後恢復、句尾確定
+START, PAUSE, RESUME, END = "start", "pause", "resume", "end"
+
+
+class EnergyVAD:
+    """舊版判斷方式：整個音框的 L2 能量超過固定門檻即視為說話，靜音持續 silence_duration 秒判定句尾"""
+
+    # 門檻是以 0.3 秒音框的 L2 能量訂的，錄音端須以相同長度讀取
+    chunk_duration = 0.3
+
+    def __init__(self, sample_rate=16000, silence_threshold=70000, silence_duration=1.5):
+        self.sample_rate = sample_rate
+        self.silence_threshold = silence_threshold
+        self.hangover = int(silence_duration * sample_rate)
+        self.reset()
+
+    def reset(self):
+        self.position = 0
+        self.speaking = False
+        self._paused = False
+        self._last_voice = 0
+
+    def process(self, chunk):
+        """輸入一段 int16 PCM，回傳 [(事件, 絕對樣本位置)]"""
+        chunk = chunk.reshape(-1)
+        start, self.position = self.position, self.position + len(chunk)
+        events = []
+        if np.linalg.norm(chunk) > self.silence_threshold:
+            if not self.speaking:
+                self.speaking = True
+                events.append((START, start))
+            elif self._paused:
+                events.append((RESUME, start))
+            self._paused = False
+            self._last_voice = self.position
+        elif self.speaking:
+            if not self._paused:
+                self._paused = True
+                events.append((PAUSE, self._last_voice))
+            if self.position - self._last_voice > self.hangover:
+                self.speaking = False
+                self._paused = False
+                events.append((END, self._last_voice))
+        return events
+
+
+class SpectralVAD:
+    """以 10–30 ms 子音框批次計算能量、過零率與頻譜平坦度的 VAD
+
+    - 噪音底：非說話子音框的對數能量以指數平均追蹤（下降快、上升慢），吵雜環境自動調高門檻
+    - 判定：能量高於噪音底 margin_db，且頻譜不平坦（像語音而非白噪音）或能量遠高於噪音底
+    - 起點需連續 onset_ms 的語音子音框；句尾在連續 hangover_ms 靜音後確定，
+      回報的句尾位置為最後一個語音子音框後加 tail_ms
+    """
+
+    # 以 30 ms 為單位讀取，句尾判定延遲只多一個讀取區塊
+    chunk_duration = 0.03
+
+    def __init__(self, sample_rate=16000, subframe_ms=20, hangover_ms=500, onset_ms=60, tail_ms=100,
+                 margin_db=10.0, min_energy_db=35.0, flatness_threshold=0.45, zcr_threshold=0.35,
+                 noise_adapt=0.05, initial_floor_db=45.0):
+        self.sample_rate = sample_rate
+        self.subframe = int(sample_rate * subframe_ms / 1000)
+        self.hangover = max(1, int(hangover_ms / subframe_ms))
+        self.onset = max(1, int(onset_ms / subframe_ms))
+        self.tail = int(sample_rate * tail_ms / 1000)
+        self.margin_db = margin_db
+        self.min_energy_db = min_energy_db
+        self.flatness_threshold = flatness_threshold
+        self.zcr_threshold = zcr_threshold
+        self.noise_adapt = noise_adapt
+        self.initial_floor_db = initial_floor_db
+        self._window = np.hanning(self.subframe).astype(np.float32)
+        self.reset()
+
+    def reset(self):
+        self.position = 0
+        self.speaking = False
+        self.noise_floor = None
+        self._remainder = np.zeros(0, dtype=np.int16)
+        self._voiced_run = 0
+        self._silent_run = 0
+        self._last_voice = 0
+
+    def features(self, subframes):
+        """回傳每個子音框的 (對數能量 dB, 過零率, 頻譜平坦度)"""
+        x = subframes.astype(np.float32)
+        energy_db = 10 * np.log10(np.mean(x * x, axis=1) + 1e-6)
+        signs = np.signbit(x)
+        zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+        spectrum = np.abs(np.fft.rfft(x * self._window, axis=1)) ** 2 + 1e-10
+        flatness = np.exp(np.mean(np.log(spectrum), axis=1)) / np.mean(spectrum, axis=1)
+        return energy_db, zcr, flatness
+
+    def classify(self, energy_db, zcr, flatness):
+        """逐子音框判定是否為語音（同時更新噪音底）"""
+        if self.noise_floor is None:
+            # 一開口就錄到語音時，避免把語音當成噪音底
+            self.noise_floor = min(float(np.min(energy_db)), self.initial_floor_db)
+
+        decisions = np.zeros(len(energy_db), dtype=bool)
+        for i in range(len(energy_db)):
+            above = energy_db[i] - self.noise_floor
+            speech_like = flatness[i] < self.flatness_threshold or zcr[i] < self.zcr_threshold
+            voiced = energy_db[i] > self.min_energy_db and above > self.margin_db and (speech_like or above > 2 * self.margin_db)
+            decisions[i] = voiced
+            if not voiced:
+                rate = self.noise_adapt if energy_db[i] > self.noise_floor else 0.5
+                self.noise_floor += rate * (energy_db[i] - self.noise_floor)
+        return decisions
+
+    def process(self, chunk):
+        """輸入一段 int16 PCM，回傳 [(事件, 絕對樣本位置)]"""
+        samples = np.concatenate([self._remainder, chunk.reshape(-1)])
+        count = len(samples) // self.subframe
+        self._remainder = samples[count * self.subframe:]
+        if count == 0:
+            return []
+
+        subframes = samples[:count * self.subframe].reshape(count, self.subframe)
+        decisions = self.classify(*self.features(subframes))
+
+        events = []
+        for voiced in decisions:
+            begin = self.position
+            self.position += self.subframe
+            if voiced:
+                self._voiced_run += 1
+                if self.speaking and self._silent_run:
+                    events.append((RESUME, begin))
+                self._silent_run = 0
+                self._last_voice = self.position
+                if not self.speaking and self._voiced_run >= self.onset:
+                    self.speaking = True
+                    events.append((START, begin - (self.onset - 1) * self.subframe))
+            else:
+                self._voiced_run = 0
+                if self.speaking:
+                    self._silent_run += 1
+                    if self._silent_run == 1:
+                        events.append((PAUSE, self._last_voice))
+                    if self._silent_run >= self.hangover:
+                        self.speaking = False
+                        self._silent_run = 0
+                        events.append((END, self._last_voice + self.tail))
+        return events
+
+
+VAD_ENGINES = {
+    "energy": EnergyVAD,
+    "spectral": SpectralVAD,
+}
+
+
+def make_vad(name=None, sample_rate=16000, **kwargs):
+    """依名稱建立 VAD 引擎（預設讀取環境變數 VAD_ENGINE）；kwargs 中該引擎不認得的參數會被忽略"""
+    name = name or os.getenv('VAD_ENGINE', 'energy')
+    if name not in VAD_ENGINES:
+        raise ValueError(f"未知的 VAD 引擎：{name}（可用：{', '.join(VAD_ENGINES)}）")
+    engine = VAD_ENGINES[name]
+    accepted = engine.__init__.__code__.co_varnames
+    return engine(sample_rate=sample_rate, **{k: v for k, v in kwargs.items() if k in accepted})
+
+
+def reference_end(pcm, sample_rate, floor_db=-35.0, window_ms=10):
+    """離線參考句尾：最後一個能量高於全檔峰值 floor_db 的 10 ms 視窗結尾"""
+    window = int(sample_rate * window_ms / 1000)
+    count = len(pcm) // window
+    x = pcm[:count * window].reshape(count, window).astype(np.float32)
+    energy_db = 10 * np.log10(np.mean(x * x, axis=1) + 1e-6)
+    active = np.nonzero(energy_db > energy_db.max() + floor_db)[0]
+    return int((active[-1] + 1) * window) if len(active) else 0
+
+
+def evaluate(engine_names, corpus_dir, trailing_silence=2.0, snr_db=None):
+    """重播語料（每個引擎以其讀取區塊長度送入），統計句尾判定延遲（判定當下的樣本位置 − 參考句尾）"""
+    from scipy.io import wavfile
+
+    paths = sorted(glob.glob(os.path.join(corpus_dir, 'recording_*.wav')))
+    rng = np.random.default_rng(0)
+    report = {}
+    for name in engine_names:
+        delays, clipped, missed, extra = [], [], 0, 0
+        for path in paths:
+            sample_rate, pcm = wavfile.read(path)
+            pcm = pcm.reshape(-1).astype(np.int16)
+            ref = reference_end(pcm, sample_rate)
+            stream = np.concatenate([pcm, np.zeros(int(sample_rate * trailing_silence), dtype=np.int16)])
+            if snr_db is not None:
+                signal_power = np.mean(pcm.astype(np.float32) ** 2)
+                noise = rng.normal(0, np.sqrt(signal_power / 10 ** (snr_db / 10)), len(stream))
+                stream = np.clip(stream + noise, -32768, 32767).astype(np.int16)
+
+            vad = make_vad(name, sample_rate)
+            chunk = int(sample_rate * vad.chunk_duration)
+            ends = []
+            for offset in range(0, len(stream), chunk):
+                for event, position in vad.process(stream[offset:offset + chunk]):
+                    if event == END:
+                        # 判定時間 = 這個 chunk 讀完的時刻
+                        ends.append((min(offset + chunk, len(stream)), position))
+            if not ends:
+                missed += 1
+                continue
+            extra += len(ends) - 1
+            detected_at, end_position = ends[-1]
+            delays.append((detected_at - ref) / sample_rate)
+            clipped.append(max(0, ref - end_position) / sample_rate)
+
+        delays = np.array(delays) if delays else np.zeros(1)
+        report[name] = {
+            "files": len(paths),
+            "missed": missed,
+            "extra_segments": extra,
+            "endpoint_p50": round(float(np.percentile(delays, 50)), 3),
+            "endpoint_p95": round(float(np.percentile(delays, 95)), 3),
+            "endpoint_mean": round(float(np.mean(delays)), 3),
+            "clipped_mean": round(float(np.mean(clipped)) if clipped else 0.0, 3),
+        }
+    return report
+
+
+def main():
+    """python vad.py [snr_db]：比較各引擎在 data/audio 語料上的句尾延遲"""
+    corpus_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'audio'))
+    snr_db = float(sys.argv[1]) if len(sys.argv) > 1 else None
+    report = evaluate(list(VAD_ENGINES), corpus_dir, snr_db=snr_db)
+    print(f"語料：{corpus_dir}" + (f"（加入白噪音 SNR {snr_db} dB）" if snr_db is not None else ""))
+    for name, stats in report.items():
+        print(f"[{name}] 句尾延遲 p50 {stats['endpoint_p50']}s / p95 {stats['endpoint_p95']}s / 平均 {stats['endpoint_mean']}s，"
+              f"截斷平均 {stats['clipped_mean']}s，未偵測 {stats['missed']}/{stats['files']}，多切 {stats['extra_segments']} 段")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+import os
+import time
+import uuid
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from event_stream import EventChannel
+import tracing
+
+
+class VoiceSession:
+    """單一語音裝置（機台／機器人）的對話狀態，取代 app.py 的模組層全域變數
+
+    每個工作階段有自己的語句切分器、語速、回覆與狀態，以及兩個協程：辨識協程依序轉文字並立即處理
+    「停」等控制指令，回應協程依序執行分類→回覆→合成；
+    Bedrock／SageMaker／Polly 的同步呼叫交給管理器的執行緒池，不會卡住事件迴圈。
+    local=True 的工作階段使用伺服器本機的麥克風與喇叭（與舊版 app.py 行為相同）。
+    """
+
+    def __init__(self, manager, session_id, local=False, max_pending=4):
+        self.manager = manager
+        self.id = session_id
+        self.local = local
+        self.max_pending = max_pending
+
+        self.state = "idle"
+        self.rate = "100%"
+        self.latest_response_text = ""
+        self.has_new_response = False
+        self.reply_audio = None
+        self.reply_version = 0
+        self.turns = 0
+        self.dropped = 0
+        self.created_at = time.time()
+        self.last_active = self.created_at
+
+        self.segmenter = manager.recorder.make_segmenter()
+        # 這個工作階段的狀態／辨識／回覆推播頻道
+        self.events = EventChannel()
+        self._asr_queue = asyncio.Queue()
+        self._queue = asyncio.Queue()
+        self._workers = []
+        self._current = None
+
+    def start(self):
+        self._workers = [asyncio.ensure_future(self._run_asr()), asyncio.ensure_future(self._run())]
+        if self.local:
+            self._workers.append(asyncio.ensure_future(self._watch_playback()))
+
+    async def close(self):
+        for task in [self._current] + self._workers:
+            if task:
+                task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    def touch(self):
+        self.last_active = time.time()
+
+    # ====== 輸入 ======
+
+    def feed_audio(self, pcm):
+        """送入一段 int16 PCM（任意長度）；VAD 判定句尾時把整句排入處理佇列"""
+        self.touch()
+        for kind, audio in self.segmenter.push(pcm):
+            if kind == "end" and len(audio):
+                # 交出零複製切片（RingSlice），辨識協程使用前後確認沒有被之後的音訊覆蓋
+                self.submit({"utterance": self.segmenter.last_utterance,
+                             "endpoint_delay": self.segmenter.last_endpoint_delay})
+
+    def submit(self, turn):
+        """排入一輪對話（音訊或文字）；佇列已滿時丟棄最舊的一筆（與管線擷取端相同的策略）"""
+        self.touch()
+        turn.setdefault("t0", time.time())
+        turn["trace"] = tracing.start_turn(session=self.id)
+        if "endpoint_delay" in turn:
+            tracing.record("vad_endpoint", turn["endpoint_delay"], trace=turn["trace"], offset=-turn["endpoint_delay"])
+        self._enqueue(self._asr_queue, turn)
+
+    def _enqueue(self, queue, turn):
+        while queue.qsize() >= self.max_pending:
+            tracing.finish(queue.get_nowait().get("trace"), "dropped")
+            self.dropped += 1
+        queue.put_nowait(turn)
+
+    # ====== 處理 ======
+
+    async def _run_asr(self):
+        m = self.manager
+        while True:
+            turn = await self._asr_queue.get()
+            trace = turn["trace"]
+            transcript_text = turn.get("transcript")
+            if transcript_text is None:
+                utterance = turn.get("utterance")
+                try:
+                    if utterance is not None and not utterance.valid():
+                        raise RuntimeError("語句已被之後的音訊覆蓋")
+                    with tracing.activate(trace), tracing.span("stage_asr"):
+                        audio = utterance.data if utterance is not None else turn["audio"]
+                        transcript_text = await self.call(m.transcriber.transcribe_pcm, audio,
+                                                          m.recorder.sample_rate)
+                    if utterance is not None and not utterance.valid():
+                        raise RuntimeError("語句在辨識期間被之後的音訊覆蓋")
+                except Exception as e:
+                    print(f"❌ 工作階段 {self.id} 辨識錯誤: {e}")
+                    tracing.finish(trace, "error")
+                    continue
+            if not transcript_text or self.process_command(transcript_text):
+                tracing.finish(trace, "skipped")
+                continue
+            if self.local and m.speaker.check_audio():
+                tracing.finish(trace, "skipped")
+                continue
+            turn["transcript"] = transcript_text
+            self.events.publish("transcript", text=transcript_text)
+            self._enqueue(self._queue, turn)
+
+    async def _run(self):
+        while True:
+            turn = await self._queue.get()
+            self._current = asyncio.ensure_future(self.run_turn(turn))
+            try:
+                # 用 wait 而不是直接 await：「停」取消的是這一輪，處理協程本身繼續執行
+                await asyncio.wait({self._current})
+                if self._current.cancelled():
+                    tracing.finish(turn["trace"], "cancelled")
+                elif self._current.exception():
+                    print(f"❌ 工作階段 {self.id} 處理錯誤: {self._current.exception()}")
+                    tracing.finish(turn["trace"], "error")
+                    self.set_state("idle")
+                else:
+                    tracing.finish(turn["trace"], "done")
+            except asyncio.CancelledError:
+                self._current.cancel()
+                raise
+            finally:
+                self._current = None
+
+    async def call(self, func, *args):
+        return await self.manager.call(func, *args)
+
+    async def run_turn(self, turn):
+        # 這一輪（以及送進執行緒池的呼叫）中的 span 都記在該輪的追蹤紀錄底下
+        with tracing.activate(turn["trace"]):
+            await self._respond(turn)
+
+    async def _respond(self, turn):
+        m = self.manager
+        transcript_text = turn["transcript"]
+        self.set_state("thinking")
+        command_type, response, extra = None, None, {"mode": "two_call"}
+        with tracing.span("stage_classify"):
+            cache = m.classifier.response_cache
+            if cache:
+                command_type, response, decision = cache.lookup(transcript_text)
+                extra["cache"] = decision
+                if response is not None:
+                    extra["mode"] = "cache"
+
+            if response is None:
+                if m.classifier.fused_enabled:
+                    command_type, response = await self.call(m.classifier.classify_and_respond, transcript_text)
+                    if response is not None:
+                        extra["mode"] = "fused"
+                else:
+                    command_type = await self.call(m.classifier.classify_command, transcript_text)
+
+        with tracing.span("stage_respond"):
+            if response is None:
+                start = time.time()
+                handler = {
+                    '聊天': m.classifier.chat_with_gemini,
+                    '查詢': m.classifier.handle_query,
+                    '行動': m.classifier.handle_movement,
+                }.get(command_type)
+                if handler:
+                    response = await self.call(handler, transcript_text)
+                m.classifier.record_mode("two_call", command_type, time.time() - start)
+
+            response_text = m.classifier.format_response(command_type, response)
+            m.classifier.save_turn_history(transcript_text, response, command_type, extra)
+
+        with tracing.span("stage_tts"):
+            # 本機播放且開啟本地變速時，語速在播放端調整（見 process_command）
+            rate = "100%" if self.local and m.speaker.stretch else self.rate
+            audio = await self.call(m.speaker.synthesize, response_text, rate)
+        if self.local and audio:
+            with tracing.span("stage_playback"):
+                await self.call(m.speaker.wait_until_done)
+                m.speaker.play(audio, response_text)
+
+        self.turns += 1
+        self.reply_audio = audio
+        self.reply_version += 1
+        self.latest_response_text = response_text
+        self.has_new_response = True
+        self.set_state("talking")
+        self.events.publish("reply", text=response_text, reply_version=self.reply_version)
+        print(f"⏱️ [{self.id}] 句尾到回覆：{time.time() - turn['t0']:.2f}s")
+
+    def _apply_local_rate(self):
+        if self.local and self.manager.speaker.stretch:
+            self.manager.speaker.set_rate(self.rate)
+
+    def process_command(self, text):
+        """語速／中斷控制指令只影響這個工作階段"""
+        if "停" in text:
+            # 取消進行中與排隊中的回應（執行緒池中已送出的 SDK 呼叫會跑完，但結果被丟棄）
+            while not self._queue.empty():
+                tracing.finish(self._queue.get_nowait().get("trace"), "cancelled")
+            if self._current:
+                self._current.cancel()
+            if self.local:
+                self.manager.speaker.stop_audio()
+            self.set_state("idle")
+            return True
+        elif "慢一點" in text:
+            self.rate = "80%"
+            self._apply_local_rate()
+            return True
+        elif "快一點" in text:
+            self.rate = "130%"
+            self._apply_local_rate()
+            return True
+        elif "正常" in text or "恢復正常" in text:
+            self.rate = "100%"
+            self._apply_local_rate()
+            return True
+        return False
+
+    # ====== 狀態 ======
+
+    def set_state(self, state):
+        """切換狀態並推播（狀態沒變時不送事件）"""
+        if state != self.state:
+            self.state = state
+            self.events.publish("state", state=state)
+
+    async def _watch_playback(self, interval=0.2):
+        """本機喇叭播完時主動切回 idle"""
+        while True:
+            if self.state == "talking" and not self.manager.speaker.check_audio():
+                self.set_state("idle")
+            await asyncio.sleep(interval)
+
+    def mark_played(self):
+        """遠端裝置播完回覆後通知，狀態回到待命"""
+        self.touch()
+        if self.state == "talking":
+            self.set_state("idle")
+
+    def poll_status(self):
+        """與舊版 /audio_status 相同的格式；讀取後清除 has_new"""
+        self.touch()
+        if self.local and self.state == "talking" and not self.manager.speaker.check_audio():
+            self.set_state("idle")
+        status = {
+            "session_id": self.id,
+            "state": self.state,
+            "has_new": self.has_new_response,
+            "reply": self.latest_response_text,
+            "reply_version": self.reply_version,
+        }
+        self.has_new_response = False
+        self.latest_response_text = ""
+        return status
+
+    def stats(self):
+        return {
+            "session_id": self.id,
+            "local": self.local,
+            "state": self.state,
+            "rate": self.rate,
+            "turns": self.turns,
+            "pending": self._asr_queue.qsize() + self._queue.qsize(),
+            "dropped": self.dropped,
+            "idle_seconds": round(time.time() - self.last_active, 1),
+        }
+
+
+class SessionManager:
+    """管理同一行程內的多個語音工作階段，共用 AWS 客戶端、快取與分類器
+
+    同步 SDK 呼叫在有上限的執行緒池中執行（預設與 AWS 連線池同大小），
+    閒置超過 idle_timeout 秒的工作階段會被回收。
+    """
+
+    def __init__(self, recorder, transcriber, classifier, speaker, max_sessions=None, idle_timeout=None, workers=None):
+        self.recorder = recorder
+        self.transcriber = transcriber
+        self.classifier = classifier
+        self.speaker = speaker
+        self.max_sessions = max_sessions or int(os.getenv('SESSION_MAX', '64'))
+        self.idle_timeout = idle_timeout or float(os.getenv('SESSION_IDLE_TIMEOUT', '600'))
+        workers = workers or int(os.getenv('SESSION_WORKERS', os.getenv('AWS_MAX_POOL_CONNECTIONS', '20')))
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="session-io")
+        self.sessions = {}
+        self._loop = None
+        self._mic_stop = None
+        self._reaper = None
+
+    def start(self):
+        self._loop = asyncio.get_event_loop()
+        self._reaper = asyncio.ensure_future(self._reap())
+
+    async def call(self, func, *args):
+        # run_in_executor 不會帶上 contextvars，手動複製才能讓執行緒中的 span 記到目前這一輪
+        context = contextvars.copy_context()
+        return await asyncio.get_event_loop().run_in_executor(self.executor, context.run, func, *args)
+
+    def create(self, session_id=None, local=False):
+        if len(self.sessions) >= self.max_sessions:
+            raise RuntimeError(f"工作階段已達上限（{self.max_sessions}）")
+        session_id = session_id or uuid.uuid4().hex[:12]
+        if session_id in self.sessions:
+            return self.sessions[session_id]
+        session = VoiceSession(self, session_id, local=local)
+        session.start()
+        self.sessions[session_id] = session
+        print(f"🆕 建立工作階段 {session_id}{'（本機麥克風）' if local else ''}")
+        return session
+
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+
+    async def close(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return False
+        if session.local:
+            self.stop_microphone()
+        await session.close()
+        print(f"👋 關閉工作階段 {session_id}")
+        return True
+
+    async def close_all(self):
+        if self._reaper:
+            self._reaper.cancel()
+        for session_id in list(self.sessions):
+            await self.close(session_id)
+        self.executor.shutdown(wait=False)
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(min(60.0, self.idle_timeout))
+            now = time.time()
+            for session_id, session in list(self.sessions.items()):
+                if not session.local and now - session.last_active > self.idle_timeout:
+                    await self.close(session_id)
+
+    def start_microphone(self, session):
+        """本機麥克風由一條讀取執行緒擷取，音框交回事件迴圈給該工作階段切句"""
+        if self._mic_stop is not None:
+            return False
+        stop = threading.Event()
+        self._mic_stop = stop
+        frame_size = session.segmenter.frame_size
+
+        def capture():
+            print("🎧 進入持續監聽模式（非同步工作階段）...")
+            for frame in self.recorder.mic_frames(frame_size):
+                if stop.is_set():
+                    break
+                self._loop.call_soon_threadsafe(session.feed_audio, frame)
+
+        threading.Thread(target=capture, name="mic-capture", daemon=True).start()
+        return True
+
+    def stop_microphone(self):
+        if self._mic_stop is not None:
+            self._mic_stop.set()
+            self._mic_stop = None
+
+    def stats(self):
+        return {
+            "sessions": [session.stats() for session in self.sessions.values()],
+            "max_sessions": self.max_sessions,
+            "idle_timeout": self.idle_timeout,
+        }
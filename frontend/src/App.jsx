@@ -17,6 +17,10 @@ export default function App() {
   const sweat = useRef()
   const mouth = useRef()
   const questions = useRef([])
+  const eventSource = useRef(null)
+
+  // ✅ 元件卸載時關閉推播連線
+  useEffect(() => () => eventSource.current && eventSource.current.close(), [])
 
   useEffect(() => {
     const handleKeyDown = (e) => {
@@ -130,15 +134,16 @@ export default function App() {
   
     try {
       await axios.post("http://localhost:5001/process_audio")
-  
-      const intervalId = setInterval(async () => {
-        const status = await axios.get("http://localhost:5001/audio_status")
-        console.log(status.data)  // ✅ 正確 debug
-        setState(status.data.state)
-        if (status.data.has_new) {
-          setFullText(status.data.reply)
-        }
-      }, 1000)
+
+      // ✅ 改用 Server-Sent Events 接收狀態與回覆；斷線時瀏覽器會帶 Last-Event-ID 自動重連並補送
+      if (!eventSource.current) {
+        const source = new EventSource("http://localhost:5001/events")
+        source.addEventListener('state', (e) => setState(JSON.parse(e.data).state))
+        source.addEventListener('partial', (e) => setFullText(`🎙️ ${JSON.parse(e.data).text}`))
+        source.addEventListener('reply', (e) => setFullText(JSON.parse(e.data).text))
+        source.onerror = (e) => console.error("推播連線中斷，自動重連中", e)
+        eventSource.current = source
+      }
     } catch (err) {
       console.error(err)
       setFullText("❌ 發生錯誤，請稍後再試")